@@ -0,0 +1,710 @@
+# FOR TEMPORARY BENCHMARK DATABASES
+import os
+# FOR OPTIONAL TRANSACTIONS
+import contextlib
+# FOR SYNTHETIC DELIVERY FILES
+import csv
+# FOR THE MULTI-TERMINAL STRESS TEST
+import concurrent.futures
+import random
+import sqlite3
+# FOR TIMING THE COMMAND LINE IN A FRESH INTERPRETER
+import subprocess
+import sys
+import tempfile
+# FOR TIMING
+import time
+import statistics
+# FOR MACHINE-READABLE SUITE RESULTS
+import json
+import platform
+# FOR EXPIRY DATES
+from datetime import date, datetime, timedelta
+
+import nurse_aid
+
+
+# CREATE AN EMPTY DATABASE IN A TEMPORARY DIRECTORY AND RETURN ITS POOL
+def make_benchmark_database(directory):
+    pool = nurse_aid.ConnectionPool(os.path.join(directory, 'benchmark.db'))
+    nurse_aid.DatabaseManager(pool=pool).create_tables()
+    return pool
+
+
+# ADD ONE RESIDENT OWNING instance_count MEDICATION INSTANCES SPREAD OVER medication_count MEDICATIONS
+def add_synthetic_resident(database, resident_number, instance_count, medication_count=20):
+    today = datetime.now().date()
+
+    database.cursor.execute("INSERT INTO resident (first_name, last_name, dob) VALUES (?, ?, ?)",
+                            ('Resident', f'Number{resident_number}', '1940-01-01'))
+    resident_id = database.cursor.lastrowid
+
+    medication_ids = []
+    for medication_number in range(medication_count):
+        database.cursor.execute("INSERT INTO medication (name, other_name, resident_id) VALUES (?, ?, ?)",
+                                (f'Medication{medication_number}', f'Brand{medication_number}', resident_id))
+        medication_ids.append(database.cursor.lastrowid)
+
+    instances = []
+    for instance_number in range(instance_count):
+        expiry = (today + timedelta(days=instance_number % 400 - 100)).isoformat()
+        instances.append((expiry, 28, 500, 'Tablets', medication_ids[instance_number % medication_count],
+                          'Pharmacy', 'mg'))
+    database.cursor.executemany("INSERT INTO medication_info (expiry, quantity, strength, medication_type, "
+                                "medication_id, supplier, measurement) VALUES (?, ?, ?, ?, ?, ?, ?)", instances)
+    database.connection.commit()
+    return resident_id
+
+
+# NAMES, MEDICATIONS (name, other_name, strength, form) AND SUPPLIERS FOR THE SYNTHETIC CARE HOMES
+FIRST_NAMES = ('Margaret', 'Joan', 'Dorothy', 'Betty', 'Jean', 'Arthur', 'Albert', 'Harold', 'Kenneth', 'Stanley')
+LAST_NAMES = ('Smith', 'Jones', 'Taylor', 'Brown', 'Williams', 'Wilson', 'Johnson', 'Davies', 'Robinson', 'Wright')
+MEDICATIONS = (('Paracetamol', 'Panadol', 500, 'Tablets'), ('Amlodipine', 'Istin', 5, 'Tablets'),
+               ('Atorvastatin', 'Lipitor', 20, 'Tablets'), ('Lansoprazole', 'Zoton', 30, 'Capsules'),
+               ('Metformin', 'Glucophage', 500, 'Tablets'), ('Ramipril', 'Tritace', 5, 'Capsules'),
+               ('Bisoprolol', 'Cardicor', 2.5, 'Tablets'), ('Sertraline', 'Lustral', 50, 'Tablets'),
+               ('Donepezil', 'Aricept', 10, 'Tablets'), ('Furosemide', 'Lasix', 40, 'Tablets'),
+               ('Levothyroxine', 'Eltroxin', 100, 'Tablets'), ('Lactulose', 'Duphalac', 3335, 'Solution'),
+               ('Senna', 'Senokot', 7.5, 'Tablets'), ('Codeine', 'Codipar', 30, 'Tablets'),
+               ('Warfarin', 'Marevan', 1, 'Tablets'), ('Mirtazapine', 'Zispin', 15, 'Tablets'))
+SUPPLIERS = ('Boots', 'Lloyds', 'Well', 'Rowlands')
+
+
+# BUILD A SYNTHETIC CARE HOME THROUGH create_tables AND THE BULK WRITERS AND RETURN ITS POOL. EACH RESIDENT HAS
+# medication_count MEDICATIONS WITH instance_count DELIVERIES EACH, AND EVERY INSTANCE ONE OR TWO DOSES
+def make_care_home_database(directory, resident_count, medication_count=8, instance_count=4, seed=0):
+    generator = random.Random(seed)
+    today = datetime.now().date()
+    pool = make_benchmark_database(directory)
+    database = nurse_aid.DatabaseManager(pool=pool)
+
+    database.add_residents_to_database(
+        (generator.choice(FIRST_NAMES), generator.choice(LAST_NAMES),
+         (date(1925, 1, 1) + timedelta(days=generator.randrange(40 * 365))).isoformat())
+        for _ in range(resident_count))
+    resident_ids = [resident_id for resident_id, in database.cursor.execute("SELECT id FROM resident ORDER BY id")]
+
+    medication_strengths = {}
+    for resident_id in resident_ids:
+        for name, other_name, strength, form in generator.sample(MEDICATIONS, medication_count):
+            database.cursor.execute("INSERT INTO medication (name, other_name, resident_id) VALUES (?, ?, ?)",
+                                    (name, other_name, resident_id))
+            medication_strengths[database.cursor.lastrowid] = (strength, form)
+    database.connection.commit()
+
+    database.add_medication_instances_to_database(
+        ((today + timedelta(days=generator.randrange(-60, 720))).isoformat(), generator.choice((14, 28, 56, 100)),
+         strength, form, medication_id, generator.choice(SUPPLIERS), 'mg')
+        for medication_id, (strength, form) in medication_strengths.items() for _ in range(instance_count))
+
+    database.add_medication_instance_doses_to_database(
+        (strength * generator.choice((0.5, 1, 2)), 'mg', frequency_per_day, regularity, medication_info_id)
+        for medication_info_id, strength in database.cursor.execute("SELECT id, strength FROM medication_info")
+        .fetchall()
+        for frequency_per_day, regularity in generator.sample(((1, 'Regular'), (2, 'Regular'), (4, 'PRN')),
+                                                              generator.randint(1, 2)))
+    return pool
+
+
+# MIN AND MEDIAN MILLISECONDS OVER repeats CALLS OF operation()
+def time_operation(operation, repeats):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        operation()
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'min_ms': round(min(timings), 4), 'median_ms': round(statistics.median(timings), 4)}
+
+
+# TIME THE CORE OPERATIONS BEHIND EACH CLICK AGAINST SYNTHETIC CARE HOMES OF EACH SIZE IN resident_counts
+# THE RESIDENT, MEDICATION AND INSTANCE USED ARE THE MIDDLE ONES, SO THEY SIT AMONG OTHER RESIDENTS' DATA
+def benchmark_suite(resident_counts=(10, 100, 1000), repeats=7):
+    results = {}
+    for resident_count in resident_counts:
+        with tempfile.TemporaryDirectory() as directory:
+            with make_care_home_database(directory, resident_count) as pool:
+                database = nurse_aid.DatabaseManager(pool=pool)
+                resident_id = database.cursor.execute(
+                    "SELECT id FROM resident ORDER BY id LIMIT 1 OFFSET (?)", (resident_count // 2,)).fetchone()[0]
+                medication_id = database.collect_resident_medication_page(resident_id, None, 1)[0][0]
+                medication_info_id = database.collect_medication_instances_page(medication_id, None, 1)[0][0]
+                report_path = os.path.join(directory, 'benchmark.pdf')
+
+                def dose_list():
+                    quantity, strength = database.collect_quantity_and_strength(medication_info_id)
+                    return [nurse_aid.calculate_days_remaining(quantity, strength, dose[1], dose[3], dose[4])
+                            for dose in database.collect_medication_instance_doses(medication_info_id)]
+
+                operations = {
+                    'resident list, first page': lambda: database.collect_resident_identifiers_page(None, 100),
+                    'resident list, all': database.collect_resident_identifiers,
+                    'medication list': lambda: database.collect_resident_medication_page(resident_id, None, 100),
+                    'instance list': lambda: database.collect_medication_instances_page(medication_id, None, 100),
+                    'dose list + days remaining': dose_list,
+                    'low stock, whole home': lambda: database.collect_instances_running_out(
+                        nurse_aid.LOW_STOCK_ALERT_DAYS),
+                    'stock modification': lambda: database.modify_medication_instance_quantity(28, medication_info_id),
+                    'resident expiry PDF': lambda: nurse_aid.ExpiryReport(
+                        database.stream_resident_expiry_report_rows(resident_id)).write_pdf('Benchmark', report_path),
+                    'home expiry report, query + buckets': lambda: nurse_aid.HomeExpiryReport(
+                        database.stream_home_expiry_report_rows()),
+                    'reorder forecast, whole home': lambda: nurse_aid.StockForecast(
+                        *database.collect_forecast_rows()).reorder_list(),
+                }
+                results[str(resident_count)] = {operation_name: time_operation(operation, repeats)
+                                                for operation_name, operation in operations.items()}
+    return results
+
+
+# WRITE SUITE RESULTS AS JSON WITH ENOUGH ABOUT THE MACHINE TO TELL RUNS APART
+def write_suite_json(results, file_path):
+    with open(file_path, 'w') as json_file:
+        json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+                   'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(), 'results': results},
+                  json_file, indent=2)
+
+
+# PRINT OPERATIONS WHOSE MEDIAN IS OVER threshold TIMES THE BASELINE RUN'S, RETURNING HOW MANY THERE WERE
+# SLOWDOWNS OF UNDER minimum_ms ARE TIMER NOISE ON SUB-MILLISECOND QUERIES AND ARE IGNORED
+def compare_suite(results, baseline_path, threshold=1.25, minimum_ms=0.1):
+    with open(baseline_path) as baseline_file:
+        baseline_results = json.load(baseline_file)['results']
+
+    regression_count = 0
+    for resident_count, operations in results.items():
+        for operation_name, timing in operations.items():
+            baseline_timing = baseline_results.get(resident_count, {}).get(operation_name)
+            if baseline_timing is None or baseline_timing['median_ms'] <= 0:
+                continue
+            ratio = timing['median_ms'] / baseline_timing['median_ms']
+            if ratio > threshold and timing['median_ms'] - baseline_timing['median_ms'] >= minimum_ms:
+                regression_count += 1
+                print(f'REGRESSION {resident_count} residents, {operation_name}: '
+                      f'{baseline_timing["median_ms"]:.3f} -> {timing["median_ms"]:.3f} ms ({ratio:.2f}x)')
+    return regression_count
+
+
+def print_suite(results):
+    print(f'{"operation":>36}' + ''.join(f'{resident_count + " residents":>16}' for resident_count in results))
+    for operation_name in next(iter(results.values())):
+        print(f'{operation_name:>36}' + ''.join(f'{operations[operation_name]["median_ms"]:>13.3f} ms'
+                                               for operations in results.values()))
+
+
+# TIME THE RESIDENT EXPIRY REPORT ENGINE AS THE RESIDENT'S INSTANCE COUNT GROWS
+def benchmark_resident_expiry_report(instance_counts=(10, 100, 1000, 5000), repeats=5):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for instance_count in instance_counts:
+            with make_benchmark_database(directory) as pool:
+                database = nurse_aid.DatabaseManager(pool=pool)
+                # OTHER RESIDENTS' HISTORY SHOULD NOT AFFECT THE SELECTED RESIDENT'S REPORT
+                for resident_number in range(10):
+                    add_synthetic_resident(database, resident_number, instance_count=1000)
+                resident_id = add_synthetic_resident(database, 10, instance_count=instance_count)
+
+                best_seconds = None
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    nurse_aid.ExpiryReport(database.collect_resident_expiry_report_rows(resident_id))
+                    elapsed = time.perf_counter() - start
+                    best_seconds = elapsed if best_seconds is None else min(best_seconds, elapsed)
+
+            os.remove(os.path.join(directory, 'benchmark.db'))
+            results.append((instance_count, best_seconds))
+    return results
+
+
+# TIME A RESIDENT EXPIRY PDF OF row_count ROWS FROM QUERY TO FILE: STREAMED ROWS, BUCKETING AND TABLE RENDERING
+def benchmark_report_rendering(row_count=10000, repeats=3):
+    with tempfile.TemporaryDirectory() as directory:
+        with make_benchmark_database(directory) as pool:
+            database = nurse_aid.DatabaseManager(pool=pool)
+            resident_id = add_synthetic_resident(database, 0, instance_count=row_count)
+
+            best_seconds = None
+            for _ in range(repeats):
+                start = time.perf_counter()
+                nurse_aid.ExpiryReport(database.stream_resident_expiry_report_rows(resident_id)).write_pdf(
+                    'Benchmark', os.path.join(directory, 'benchmark.pdf'))
+                elapsed = time.perf_counter() - start
+                best_seconds = elapsed if best_seconds is None else min(best_seconds, elapsed)
+            return best_seconds, os.path.getsize(os.path.join(directory, 'benchmark.pdf'))
+
+
+# TIME ASKING FOR THE SAME row_count-ROW RESIDENT REPORT TWICE THROUGH ReportCache, THEN AGAIN AFTER ONE WRITE
+def benchmark_report_cache(row_count=10000):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        with make_benchmark_database(directory) as pool:
+            database = nurse_aid.DatabaseManager(pool=pool)
+            resident_id = add_synthetic_resident(database, 0, instance_count=row_count)
+            report_cache = nurse_aid.ReportCache(os.path.join(directory, 'Reports'))
+            os.makedirs(report_cache.directory)
+
+            def write_report():
+                return nurse_aid.ExpiryReport(database.stream_resident_expiry_report_rows(resident_id)).write_pdf(
+                    'Benchmark', os.path.join(report_cache.directory, f'benchmark {time.perf_counter()}.pdf'))
+
+            for run in ('first request', 'unchanged', 'after a write'):
+                if run == 'after a write':
+                    database.cursor.execute("UPDATE medication_info SET quantity = 27 WHERE id == 1")
+                    database.connection.commit()
+                start = time.perf_counter()
+                report_cache.get_or_write('resident', resident_id, database.collect_data_version(), write_report)
+                results[run] = time.perf_counter() - start
+    return results
+
+
+# TIME THE HOME-WIDE EXPIRY REPORT FOR resident_count RESIDENTS SHARING instance_count INSTANCES
+def benchmark_home_expiry_report(resident_count=100, instance_count=5000):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        with make_benchmark_database(directory) as pool:
+            database = nurse_aid.DatabaseManager(pool=pool)
+            for resident_number in range(resident_count):
+                add_synthetic_resident(database, resident_number, instance_count=instance_count // resident_count,
+                                       medication_count=10)
+
+            start = time.perf_counter()
+            home_expiry_report = nurse_aid.HomeExpiryReport(database.collect_home_expiry_report_rows())
+            results['query + bucketing'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            home_expiry_report.write_combined_pdf(os.path.join(directory, 'combined.pdf'))
+            results['combined PDF'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for resident_report in home_expiry_report.resident_reports:
+                nurse_aid.write_resident_expiry_pdf(resident_report[4], 'benchmark',
+                                                    os.path.join(directory, f'serial {resident_report[0]}.pdf'))
+            results['per-resident PDFs, serial'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            home_expiry_report.write_resident_pdfs(os.path.join(directory, 'pool'))
+            results['per-resident PDFs, process pool'] = time.perf_counter() - start
+    return results
+
+
+# TIME A HEADLESS COMMAND LINE RUN FROM INTERPRETER START TO EXIT
+def benchmark_headless_startup(repeats=5):
+    with tempfile.TemporaryDirectory() as directory:
+        with make_benchmark_database(directory) as pool:
+            add_synthetic_resident(nurse_aid.DatabaseManager(pool=pool), 0, instance_count=10)
+
+        command = [sys.executable, nurse_aid.__file__, '--database', os.path.join(directory, 'benchmark.db'),
+                   'stock', 'set', '1', '28']
+        best_seconds = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+            elapsed = time.perf_counter() - start
+            best_seconds = elapsed if best_seconds is None else min(best_seconds, elapsed)
+    return best_seconds
+
+
+# TIME ENTERING A MONTHLY DELIVERY CYCLE, ONE INSTANCE AND ONE DOSE PER ITEM, THREE WAYS:
+# COMMIT PER ROW (THE OLD BEHAVIOUR), ONE transaction() AROUND THE SINGLE ROW METHODS, AND THE BULK executemany API
+def benchmark_delivery_commits(resident_count=60, items_per_resident=10):
+    expiry = (datetime.now().date() + timedelta(days=365)).isoformat()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for mode in ('commit per row', 'one transaction', 'bulk executemany'):
+            with make_benchmark_database(directory) as pool:
+                database = nurse_aid.DatabaseManager(pool=pool)
+                for resident_number in range(resident_count):
+                    add_synthetic_resident(database, resident_number, instance_count=0,
+                                           medication_count=items_per_resident)
+                medication_ids = [medication_id for medication_id, in database.cursor.execute(
+                    "SELECT id FROM medication").fetchall()]
+
+                start = time.perf_counter()
+                if mode == 'bulk executemany':
+                    database.add_medication_instances_to_database(
+                        (expiry, 28, 500, 'Tablets', medication_id, 'Pharmacy', 'mg')
+                        for medication_id in medication_ids)
+                    database.add_medication_instance_doses_to_database(
+                        (500, 'mg', 2, 'Regular', medication_info_id) for medication_info_id, in
+                        database.cursor.execute("SELECT id FROM medication_info").fetchall())
+                else:
+                    with (database.transaction() if mode == 'one transaction' else contextlib.nullcontext()):
+                        for medication_id in medication_ids:
+                            medication_info_id = database.add_medication_instance_to_database(
+                                expiry, 28, 500, 'Tablets', medication_id, 'Pharmacy', 'mg')
+                            database.add_medication_instance_dose_to_database(500, 'mg', 2, 'Regular',
+                                                                              medication_info_id)
+                results[mode] = time.perf_counter() - start
+
+            os.remove(os.path.join(directory, 'benchmark.db'))
+    return results
+
+
+# TIME IMPORTING A line_count LINE DELIVERY CSV FOR resident_count RESIDENTS
+def benchmark_delivery_import(line_count=10000, resident_count=100):
+    expiry = (datetime.now().date() + timedelta(days=365)).isoformat()
+    with tempfile.TemporaryDirectory() as directory:
+        file_path = os.path.join(directory, 'delivery.csv')
+        with open(file_path, 'w', newline='') as delivery_file:
+            writer = csv.writer(delivery_file)
+            writer.writerow(nurse_aid.DELIVERY_COLUMNS)
+            for line_number in range(line_count):
+                writer.writerow(('Resident', f'Number{line_number % resident_count}', '1940-01-01',
+                                 f'Medication{line_number % 40}', 'Brand', expiry, 28, 500, 'Tablets', 'Pharmacy', 'mg',
+                                 500, 'mg', 2, 'Regular'))
+
+        with make_benchmark_database(directory) as pool:
+            start = time.perf_counter()
+            delivery_importer = nurse_aid.DeliveryImporter(nurse_aid.DatabaseManager(pool=pool)).import_file(file_path)
+            seconds = time.perf_counter() - start
+    return seconds, delivery_importer.imported_count
+
+
+# TIME RECORDING A MEDICATION ROUND OF administration_count DOSES, ONE COMMIT EACH AGAINST ONE BATCH
+def benchmark_medication_round(administration_count=300):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        with make_benchmark_database(directory) as pool:
+            database = nurse_aid.DatabaseManager(pool=pool)
+            for resident_number in range(60):
+                add_synthetic_resident(database, resident_number, instance_count=5, medication_count=5)
+            database.add_medication_instance_doses_to_database(
+                (500, 'mg', 2, 'Regular', medication_info_id) for medication_info_id, in
+                database.cursor.execute("SELECT id FROM medication_info").fetchall())
+            dose_info_ids = [dose_info_id for dose_info_id, in
+                             database.cursor.execute("SELECT id FROM dose_info").fetchall()]
+            dose_info_ids = (dose_info_ids * (administration_count // len(dose_info_ids) + 1))[:administration_count]
+
+            start = time.perf_counter()
+            for dose_info_id in dose_info_ids:
+                database.administer_dose(dose_info_id, 'Benchmark')
+            results['one commit per dose'] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            database.administer_doses((dose_info_id, 'Benchmark', None, None) for dose_info_id in dose_info_ids)
+            results['one batch per round'] = time.perf_counter() - start
+    return results
+
+
+# TIME FILLING THE INSTANCE LISTBOX FOR ONE MEDICATION WITH A LONG HISTORY: THE WHOLE HISTORY AT ONCE AGAINST THE
+# FIRST KEYSET PAGE PagedListbox LOADS, FORMATTING ROWS AS THE WINDOW WOULD
+def benchmark_instance_listbox(instance_count=20000, page_size=100, repeats=5):
+    format_row = nurse_aid.ResidentMedicationWindow.format_medication_instance_row
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        with make_benchmark_database(directory) as pool:
+            database = nurse_aid.DatabaseManager(pool=pool)
+            add_synthetic_resident(database, 0, instance_count=instance_count, medication_count=1)
+            medication_id = database.cursor.execute("SELECT id FROM medication").fetchone()[0]
+
+            start = time.perf_counter()
+            for _ in range(repeats):
+                [format_row(i, row) for i, row in enumerate(database.collect_medication_instances(medication_id))]
+            results['whole history'] = (time.perf_counter() - start) / repeats
+
+            start = time.perf_counter()
+            for _ in range(repeats):
+                [format_row(i, row) for i, row in
+                 enumerate(database.collect_medication_instances_page(medication_id, None, page_size))]
+            results['first page'] = (time.perf_counter() - start) / repeats
+    return results
+
+
+# TIME FIRST-EXPIRY-FIRST-OUT ALLOCATIONS FOR ONE MEDICATION WITH A LONG DELIVERY HISTORY, MOST OF IT USED UP,
+# EACH ALLOCATION SPLITTING ACROSS THE EARLIEST TWO IN-STOCK INSTANCES
+def benchmark_fefo_allocation(instance_count=20000, in_stock_count=20, repeats=10):
+    with tempfile.TemporaryDirectory() as directory:
+        with make_benchmark_database(directory) as pool:
+            database = nurse_aid.DatabaseManager(pool=pool)
+            add_synthetic_resident(database, 0, instance_count=instance_count, medication_count=1)
+            medication_id = database.cursor.execute("SELECT id FROM medication").fetchone()[0]
+            database.cursor.execute("UPDATE medication_info SET quantity = 0 WHERE id NOT IN "
+                                    "(SELECT id FROM medication_info ORDER BY expiry DESC LIMIT (?))",
+                                    (in_stock_count,))
+            database.connection.commit()
+
+            start = time.perf_counter()
+            for _ in range(repeats):
+                database.allocate_medication_fefo(medication_id, 30)
+            return (time.perf_counter() - start) / repeats
+
+
+# TIME EACH KEYSTROKE OF THE TYPE-AHEAD SEARCHES AGAINST resident_count RESIDENTS WITH 20 MEDICATIONS EACH
+def benchmark_search(resident_count=1000, typed_text='Number999', repeats=20):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        with make_benchmark_database(directory) as pool:
+            database = nurse_aid.DatabaseManager(pool=pool)
+            for resident_number in range(resident_count):
+                resident_id = add_synthetic_resident(database, resident_number, instance_count=0)
+
+            for typed_count in range(1, len(typed_text) + 1):
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    database.search_residents_page(typed_text[:typed_count], None, 100)
+                    database.search_resident_medication_page(resident_id, 'Medication1'[:typed_count], None, 100)
+                results[typed_text[:typed_count]] = (time.perf_counter() - start) / repeats
+    return results
+
+
+# TIME THE REORDER FORECAST FOR A HOME WITH instance_count INSTANCES AND dose_count REGULAR DOSES: LOADING THE COLUMNS,
+# THE VECTORISED FORECAST, AND THE PER-DOSE PYTHON LOOP THE DOSE LISTBOX USES, FOR COMPARISON
+def benchmark_forecast(instance_count=50000, dose_count=100000, repeats=5):
+    generator = random.Random(0)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        with make_benchmark_database(directory) as pool:
+            database = nurse_aid.DatabaseManager(pool=pool)
+            add_synthetic_resident(database, 0, instance_count=instance_count, medication_count=100)
+            medication_info_ids = [row[0] for row in database.cursor.execute("SELECT id FROM medication_info")]
+            database.add_medication_instance_doses_to_database(
+                (generator.choice((250, 500, 1000)), 'mg', generator.choice((1, 2, 3)), 'Regular',
+                 generator.choice(medication_info_ids)) for _ in range(dose_count))
+
+            start = time.perf_counter()
+            for _ in range(repeats):
+                instance_rows, dose_rows = database.collect_forecast_rows()
+            results['load columns'] = (time.perf_counter() - start) / repeats
+
+            start = time.perf_counter()
+            for _ in range(repeats):
+                nurse_aid.StockForecast(instance_rows, dose_rows).reorder_list()
+            results['forecast + reorder list'] = (time.perf_counter() - start) / repeats
+
+            instances = {row[0]: row for row in instance_rows}
+            start = time.perf_counter()
+            for _ in range(repeats):
+                [nurse_aid.calculate_days_remaining(instances[dose[0]][1], instances[dose[0]][2], dose[1], dose[2],
+                                                   'Regular') for dose in dose_rows]
+            results['per-dose python loop'] = (time.perf_counter() - start) / repeats
+    return results
+
+
+# ONE SIMULATED NURSING STATION: RECORD ROUNDS, CHANGE STOCK AND BROWSE UNTIL deadline, COUNTING LOCK FAILURES
+def run_terminal(database_path, pool_settings, terminal_number, deadline):
+    pool = nurse_aid.ConnectionPool(database_path, **pool_settings)
+    database = nurse_aid.DatabaseManager(pool=pool)
+    dose_info_ids = [dose_info_id for dose_info_id, in database.cursor.execute("SELECT id FROM dose_info").fetchall()]
+    randomiser = random.Random(terminal_number)
+
+    operation_count = 0
+    locked_count = 0
+    while time.time() < deadline:
+        try:
+            operation = randomiser.random()
+            if operation < 0.4:
+                database.administer_doses((dose_info_id, f'Terminal{terminal_number}', None, None)
+                                          for dose_info_id in randomiser.sample(dose_info_ids, 20))
+            elif operation < 0.6:
+                database.modify_medication_instance_quantity(28, randomiser.randint(1, len(dose_info_ids)))
+            else:
+                resident_id = randomiser.randint(1, 20)
+                for medication in database.collect_resident_medication(resident_id):
+                    database.collect_medication_instances(medication[0])
+                database.collect_resident_expiry_report_rows(resident_id)
+            operation_count += 1
+        except nurse_aid.NotEnoughStock:
+            # A ROUND REFUSED FOR AN EMPTY INSTANCE STILL TOOK AND RELEASED THE WRITE LOCK
+            operation_count += 1
+        except sqlite3.OperationalError as error:
+            if not nurse_aid.is_busy_error(error):
+                raise
+            database.connection.rollback()
+            locked_count += 1
+    pool.close_all()
+    return operation_count, locked_count
+
+
+# RUN terminal_count PROCESSES AGAINST ONE DATABASE FOR seconds, ONCE WITH THE OLD CONNECTION SETTINGS AND ONCE WITH
+# THE CONCURRENCY SETTINGS, RETURNING {settings name: (operations, "database is locked" failures)}
+def stress_test_terminals(terminal_count=4, seconds=5):
+    settings = {
+        'rollback journal, no busy timeout': dict(journal_mode='DELETE', busy_timeout=0, busy_retries=0,
+                                                  synchronous='FULL', cache_size=-2000),
+        'WAL, busy timeout, retry': {},
+    }
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for settings_name, pool_settings in settings.items():
+            database_path = os.path.join(directory, 'benchmark.db')
+            with make_benchmark_database(directory) as pool:
+                database = nurse_aid.DatabaseManager(pool=pool)
+                database.cursor.execute(f"PRAGMA journal_mode = {pool_settings.get('journal_mode', 'WAL')}")
+                for resident_number in range(20):
+                    add_synthetic_resident(database, resident_number, instance_count=10, medication_count=5)
+                database.add_medication_instance_doses_to_database(
+                    (500, 'mg', 2, 'Regular', medication_info_id) for medication_info_id, in
+                    database.cursor.execute("SELECT id FROM medication_info").fetchall())
+
+            deadline = time.time() + seconds
+            with concurrent.futures.ProcessPoolExecutor(max_workers=terminal_count) as executor:
+                outcomes = list(executor.map(run_terminal, [database_path] * terminal_count,
+                                             [pool_settings] * terminal_count, range(terminal_count),
+                                             [deadline] * terminal_count))
+            results[settings_name] = (sum(outcome[0] for outcome in outcomes), sum(outcome[1] for outcome in outcomes))
+
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(database_path + suffix):
+                    os.remove(database_path + suffix)
+    return results
+
+
+# MODULES THAT MUST NOT BE IMPORTED BEFORE THE FIRST WINDOW, AND THE IMPORT TIME BUDGET FOR nurse_aid
+DEFERRED_MODULES = ('fpdf', 'tkcalendar', 'babel', 'webbrowser', 'copy', 'concurrent.futures', 'multiprocessing',
+                    'argparse', 'numpy')
+IMPORT_TIME_BUDGET_MS = 100
+
+
+# IMPORT nurse_aid IN A FRESH INTERPRETER UNDER -X importtime, RETURNING (cumulative ms, imported module names)
+def benchmark_import_time(repeats=5):
+    best_milliseconds = None
+    imported_modules = set()
+    for _ in range(repeats):
+        completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import nurse_aid'], check=True,
+                                   cwd=os.path.dirname(os.path.abspath(nurse_aid.__file__)), capture_output=True,
+                                   text=True)
+        for line in completed.stderr.splitlines():
+            if not line.startswith('import time:') or '|' not in line or 'self [us]' in line:
+                continue
+            self_time, cumulative_time, module_name = line[len('import time:'):].split('|')
+            imported_modules.add(module_name.strip())
+            if module_name.strip() == 'nurse_aid':
+                milliseconds = int(cumulative_time) / 1000
+                best_milliseconds = milliseconds if best_milliseconds is None else min(best_milliseconds,
+                                                                                       milliseconds)
+    return best_milliseconds, imported_modules
+
+
+# FAIL IF A DEFERRED MODULE IS IMPORTED AT STARTUP OR nurse_aid GOES OVER ITS IMPORT TIME BUDGET
+def check_import_time():
+    milliseconds, imported_modules = benchmark_import_time()
+    eager_modules = sorted(module_name for module_name in imported_modules
+                           if module_name.split('.')[0] in DEFERRED_MODULES or module_name in DEFERRED_MODULES)
+
+    print(f'nurse_aid import: {milliseconds:.2f} ms (budget {IMPORT_TIME_BUDGET_MS} ms)')
+    if eager_modules:
+        print(f'Imported at startup but should be deferred: {", ".join(eager_modules)}')
+    return 1 if eager_modules or milliseconds > IMPORT_TIME_BUDGET_MS else 0
+
+
+# FAIL IF PROFILING BREAKS THE WINDOWS: WITH instrumentation ENABLED, THE STATIC ROW FORMATTERS MUST STILL WORK
+# CALLED THROUGH AN INSTANCE, AS PagedListbox CALLS THEM, AND MUST BE TIMED
+def check_profiling():
+    with tempfile.TemporaryDirectory() as directory:
+        with make_benchmark_database(directory) as pool:
+            nurse_aid.instrumentation.enable(pool)
+            resident_window = object.__new__(nurse_aid.ResidentSelectionWindow)
+            medication_window = object.__new__(nurse_aid.ResidentMedicationWindow)
+            try:
+                resident_window.format_resident_row(0, (1, 'Resident', 'Number0', '1940-01-01'))
+                medication_window.format_medication_row(0, (1, 'Medication0', 'Brand0', 1, '', 0.0, 0.0, None, None,
+                                                            None))
+                medication_window.format_medication_instance_row(
+                    0, (1, '2030-01-01', 28, 500, 'Tablets', '', 1, 'Pharmacy', 'mg'))
+            except TypeError as error:
+                print(f'Row formatter broken by profiling: {error}')
+                return 1
+
+    timed_names = nurse_aid.instrumentation.timings['handlers']
+    missing_names = [name for name in ('ResidentSelectionWindow.format_resident_row',
+                                       'ResidentMedicationWindow.format_medication_row',
+                                       'ResidentMedicationWindow.format_medication_instance_row')
+                     if name not in timed_names]
+    if missing_names:
+        print(f'Not timed while profiling: {", ".join(missing_names)}')
+        return 1
+    print('Profiling: row formatters work and are timed')
+    return 0
+
+
+def main():
+    print('Resident expiry report (query + bucketing)')
+    print(f'{"instances":>10} {"total ms":>10} {"us/instance":>12}')
+    for instance_count, seconds in benchmark_resident_expiry_report():
+        print(f'{instance_count:>10} {seconds * 1000:>10.2f} {seconds * 1e6 / instance_count:>12.2f}')
+
+    print()
+    seconds, file_size = benchmark_report_rendering()
+    print(f'Resident expiry PDF, 10,000 rows: {seconds * 1000:.2f} ms, {file_size // 1024} KiB')
+
+    print()
+    print('Cached resident expiry PDF, 10,000 rows')
+    for run, seconds in benchmark_report_cache().items():
+        print(f'{run:>32} {seconds * 1000:>10.2f} ms')
+
+    print()
+    print('Home expiry report (100 residents, 5,000 instances)')
+    for operation, seconds in benchmark_home_expiry_report().items():
+        print(f'{operation:>32} {seconds * 1000:>10.2f} ms')
+
+    print()
+    print('Monthly delivery, 60 residents x 10 items (600 instances + 600 doses)')
+    for mode, seconds in benchmark_delivery_commits().items():
+        print(f'{mode:>32} {seconds * 1000:>10.2f} ms')
+
+    print()
+    print('Medication round, 300 administrations (WAL)')
+    for mode, seconds in benchmark_medication_round().items():
+        print(f'{mode:>32} {seconds * 1000:>10.2f} ms')
+
+    print()
+    print('Instance listbox fill, one medication with 20,000 instances')
+    for mode, seconds in benchmark_instance_listbox().items():
+        print(f'{mode:>32} {seconds * 1000:>10.2f} ms')
+
+    print()
+    print(f'First-expiry-first-out allocation, 20,000 instances, 20 in stock: '
+          f'{benchmark_fefo_allocation() * 1000:.2f} ms')
+
+    print()
+    print('Type-ahead search per keystroke, 1,000 residents and 20,000 medications (residents + medications)')
+    for typed_text, seconds in benchmark_search().items():
+        print(f'{typed_text:>32} {seconds * 1000:>10.2f} ms')
+
+    print()
+    print('Reorder forecast, 50,000 instances and 100,000 regular doses')
+    for operation, seconds in benchmark_forecast().items():
+        print(f'{operation:>32} {seconds * 1000:>10.2f} ms')
+
+    print()
+    seconds, imported_count = benchmark_delivery_import()
+    print(f'Delivery CSV import: {imported_count} lines in {seconds * 1000:.2f} ms')
+
+    print()
+    print(f'Headless "stock set" from interpreter start: {benchmark_headless_startup() * 1000:.2f} ms')
+    print(f'nurse_aid import (-X importtime): {benchmark_import_time()[0]:.2f} ms')
+
+
+def run_suite(arguments):
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='benchmark.py --suite')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000], help='resident counts to build')
+    parser.add_argument('--repeats', type=int, default=7)
+    parser.add_argument('--json', metavar='PATH', help='write the results to PATH as JSON')
+    parser.add_argument('--compare', metavar='PATH', help='report operations slower than an earlier --json run')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown counted as a regression')
+    parser.add_argument('--minimum-ms', type=float, default=0.1, help='smallest slowdown counted as a regression')
+    arguments = parser.parse_args(arguments)
+
+    results = benchmark_suite(arguments.sizes, arguments.repeats)
+    print_suite(results)
+    if arguments.json:
+        write_suite_json(results, arguments.json)
+    if arguments.compare:
+        return 1 if compare_suite(results, arguments.compare, arguments.threshold, arguments.minimum_ms) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--suite']:
+        sys.exit(run_suite(sys.argv[2:]))
+    if '--check-imports' in sys.argv[1:]:
+        sys.exit(check_import_time())
+    if '--check-profiling' in sys.argv[1:]:
+        sys.exit(check_profiling())
+    if '--stress' in sys.argv[1:]:
+        print('4 terminals for 5 seconds')
+        for settings_name, (operation_count, locked_count) in stress_test_terminals().items():
+            print(f'{settings_name:>36}: {operation_count} operations, {locked_count} "database is locked" failures')
+        sys.exit(0)
+    main()
@@ -4,25 +4,874 @@ import tkinter as tk
 import tkinter.messagebox
 # FOR COMBO BOXES
 import tkinter.ttk
-# FOR DATE PICKER
-import tkcalendar
 # FOR DATABASE
 import sqlite3
-# FOR COPYING OBJECTS
-import copy
-# FOR MEDICATION LOOKUP
-import webbrowser
+# FOR SHARING DATABASE CONNECTIONS BETWEEN THREADS
+import threading
+# FOR TRANSACTION CONTEXT MANAGERS
+import contextlib
+# FOR CHANGE EVENTS
+import collections
+# FOR KEYED LISTBOX ROW -> PRIMARY KEY ARRAYS
+import array
+# FOR FLATTENING ROWS INTO FORECAST ARRAYS
+import itertools
+# FOR RETRYING WRITES WHEN ANOTHER TERMINAL HOLDS THE DATABASE
+import functools
+import random
+import time
+# FOR REPORT DIRECTORIES
+import os
+# FOR PHARMACY DELIVERY FILES
+import csv
+import json
+import math
 # FOR DATES COMPARISON
-from datetime import datetime
-# FOR PDF
-import fpdf
+from datetime import date, datetime
+# FOR THE HEADLESS COMMAND LINE
+import sys
+
+
+DATABASE_PATH = 'nurse_aid.db'
+LOW_STOCK_ALERT_DAYS = 7
+REPORT_MAX_AGE_DAYS = 30
+REPORT_MAX_BYTES = 200 * 1024 * 1024
+REORDER_LEAD_DAYS = 14
+# HOW OFTEN MedicationCache LOOKS FOR WRITES FROM OTHER TERMINALS
+DATA_VERSION_CHECK_SECONDS = 1.0
+
+
+# SHARED DATABASE CONNECTIONS, ONE PER THREAD, BOUNDED TO max_connections
+# THE REMAINING ARGUMENTS TUNE THE DATABASE FOR SEVERAL NURSING STATIONS SHARING ONE FILE:
+# journal_mode 'WAL' LETS READERS CARRY ON DURING COMMITS, busy_timeout IS HOW MANY MILLISECONDS A STATEMENT WAITS
+# FOR ANOTHER TERMINAL'S LOCK, busy_retries IS HOW MANY TIMES A WRITE IS RETRIED WITH BACKOFF AFTER THAT, synchronous
+# 'NORMAL' IS CRASH SAFE IN WAL MODE WITH FAR FEWER FSYNCS, AND cache_size IS IN PAGES OR, WHEN NEGATIVE, KIB
+class ConnectionPool:
+    def __init__(self, database_path, max_connections=4, journal_mode='WAL', busy_timeout=5000, busy_retries=5,
+                 synchronous='NORMAL', cache_size=-8000):
+        self.database_path = database_path
+        self.max_connections = max_connections
+        self.journal_mode = journal_mode
+        self.busy_timeout = busy_timeout
+        self.busy_retries = busy_retries
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.connections = {}
+        self.transaction_depths = {}
+        self.condition = threading.Condition()
+
+    # GET THE CALLING THREAD'S CONNECTION, OPENING ONE IF NEEDED
+    def get_connection(self):
+        thread = threading.current_thread()
+        with self.condition:
+            if thread in self.connections:
+                return self.connections[thread]
+
+            while True:
+                self.close_dead_thread_connections()
+                if len(self.connections) < self.max_connections:
+                    break
+                self.condition.wait(timeout=0.5)
+
+            # THREAD AFFINITY IS ENFORCED BY THE POOL, SO close_all MAY CLOSE CONNECTIONS FROM ANY THREAD
+            connection = sqlite3.connect(self.database_path, check_same_thread=False,
+                                         timeout=self.busy_timeout / 1000)
+            connection.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+            connection.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+            connection.execute(f"PRAGMA synchronous = {self.synchronous}")
+            connection.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+            if instrumentation.enabled:
+                connection.set_trace_callback(instrumentation.trace)
+            self.connections[thread] = connection
+            return connection
+
+    # TRACK HOW DEEPLY THE CALLING THREAD IS NESTED IN DatabaseManager.transaction()
+    def transaction_depth(self):
+        return self.transaction_depths.get(threading.current_thread(), 0)
+
+    def change_transaction_depth(self, change):
+        thread = threading.current_thread()
+        self.transaction_depths[thread] = self.transaction_depths.get(thread, 0) + change
+        return self.transaction_depths[thread]
+
+    # CLOSE AND FORGET THE CALLING THREAD'S CONNECTION
+    def release_connection(self):
+        with self.condition:
+            self.transaction_depths.pop(threading.current_thread(), None)
+            connection = self.connections.pop(threading.current_thread(), None)
+            if connection is not None:
+                connection.close()
+            self.condition.notify()
+
+    # CLOSE CONNECTIONS OWNED BY THREADS THAT HAVE FINISHED
+    def close_dead_thread_connections(self):
+        for thread in [thread for thread in self.connections if not thread.is_alive()]:
+            self.transaction_depths.pop(thread, None)
+            self.connections.pop(thread).close()
+
+    # CLOSE EVERY CONNECTION IN THE POOL
+    def close_all(self):
+        with self.condition:
+            for connection in self.connections.values():
+                connection.close()
+            self.connections.clear()
+            self.transaction_depths.clear()
+            self.condition.notify_all()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_all()
+
+
+connection_pool = ConnectionPool(DATABASE_PATH)
+
+
+# TRUE FOR THE SQLITE_BUSY / "database is locked" ERRORS RAISED WHILE ANOTHER CONNECTION HOLDS A LOCK
+def is_busy_error(error):
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    if getattr(error, 'sqlite_errorcode', None) is not None:
+        return error.sqlite_errorcode & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return 'database is locked' in str(error) or 'database is busy' in str(error)
+
+
+# RUN operation(), RETRYING WITH JITTERED EXPONENTIAL BACKOFF WHILE THE DATABASE IS BUSY
+def retry_when_busy(operation, retries, on_retry=None, first_delay=0.05):
+    for attempt in range(retries + 1):
+        try:
+            return operation()
+        except sqlite3.OperationalError as error:
+            if not is_busy_error(error) or attempt == retries:
+                raise
+            if on_retry is not None:
+                on_retry()
+            time.sleep(first_delay * 2 ** attempt * random.uniform(0.5, 1.5))
+
+
+# DECORATOR FOR SINGLE STATEMENT DatabaseManager WRITES. INSIDE A transaction() THE ERROR IS LEFT TO THE CALLER,
+# AS RETRYING ONE STATEMENT THERE WOULD REPLAY IT ON TOP OF A ROLLED BACK TRANSACTION
+def retry_write_when_busy(method):
+    @functools.wraps(method)
+    def retrying_method(self, *args, **kwargs):
+        if self.pool.transaction_depth() > 0:
+            return method(self, *args, **kwargs)
+        return retry_when_busy(lambda: method(self, *args, **kwargs), self.pool.busy_retries,
+                               on_retry=self.connection.rollback)
+    return retrying_method
+
+
+# HISTOGRAM BUCKET UPPER BOUNDS, IN MILLISECONDS, FOR Timing
+TIMING_BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, float('inf'))
+
+
+# COUNT, TOTAL, WORST CASE, ROWS AND A LATENCY HISTOGRAM FOR ONE SQL STATEMENT, METHOD OR HANDLER
+class Timing:
+    def __init__(self):
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.buckets = [0] * len(TIMING_BUCKETS_MS)
+        self.call_sites = {}
+        # THE LAST PARAMETERS SEEN, SO EXPLAIN QUERY PLAN CAN BE RUN ON THE STATEMENT LATER
+        self.parameters = None
+
+    def add(self, milliseconds, rows=0, call_site=None, parameters=None):
+        self.count += 1
+        self.total_ms += milliseconds
+        self.max_ms = max(self.max_ms, milliseconds)
+        self.rows += rows
+        for bucket_index, upper_bound in enumerate(TIMING_BUCKETS_MS):
+            if milliseconds <= upper_bound:
+                self.buckets[bucket_index] += 1
+                break
+        if call_site is not None:
+            self.call_sites[call_site] = self.call_sites.get(call_site, 0) + 1
+        if parameters is not None:
+            self.parameters = parameters
+
+    # THE UPPER BOUND OF THE HISTOGRAM BUCKET HOLDING THE GIVEN FRACTION OF CALLS, e.g. 0.95 FOR p95
+    def percentile_ms(self, fraction):
+        running_count = 0
+        for upper_bound, bucket_count in zip(TIMING_BUCKETS_MS, self.buckets):
+            running_count += bucket_count
+            if running_count >= fraction * self.count:
+                return min(upper_bound, self.max_ms)
+        return self.max_ms
+
+    def format_histogram(self):
+        return ' '.join(f'<={upper_bound:g}ms:{bucket_count}'
+                        for upper_bound, bucket_count in zip(TIMING_BUCKETS_MS, self.buckets) if bucket_count)
+
+
+# CURSOR USED BY DatabaseManager WHILE Instrumentation IS ENABLED. EACH STATEMENT IS TIMED FROM execute() UNTIL ITS
+# LAST ROW IS FETCHED, SINCE SQLITE DOES MOST OF A SELECT'S WORK WHILE ROWS ARE STEPPED THROUGH
+class InstrumentedCursor(sqlite3.Cursor):
+    statement = None
+
+    def execute(self, sql, parameters=()):
+        self.finish_statement()
+        self.start_statement(sql, parameters, sys._getframe(1))
+        try:
+            super().execute(sql, parameters)
+        finally:
+            self.pause_statement()
+        if self.description is None:
+            self.finish_statement(max(self.rowcount, 0))
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self.finish_statement()
+        self.start_statement(sql, None, sys._getframe(1))
+        try:
+            super().executemany(sql, seq_of_parameters)
+        finally:
+            self.pause_statement()
+        self.finish_statement(max(self.rowcount, 0))
+        return self
+
+    def fetchone(self):
+        row = self.timed_fetch(super().fetchone)
+        self.count_rows(0 if row is None else 1, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self.timed_fetch(lambda: super(InstrumentedCursor, self).fetchmany(size or self.arraysize))
+        self.count_rows(len(rows), len(rows) < (size or self.arraysize))
+        return rows
+
+    def fetchall(self):
+        rows = self.timed_fetch(super().fetchall)
+        self.count_rows(len(rows), True)
+        return rows
+
+    def __next__(self):
+        try:
+            row = self.timed_fetch(super().__next__)
+        except StopIteration:
+            self.finish_statement()
+            raise
+        self.count_rows(1, False)
+        return row
+
+    def close(self):
+        self.finish_statement()
+        super().close()
+
+    def start_statement(self, sql, parameters, caller_frame):
+        self.statement = ' '.join(sql.split())
+        self.statement_parameters = parameters
+        self.statement_call_site = f'{caller_frame.f_code.co_name}:{caller_frame.f_lineno}'
+        self.statement_ms = 0.0
+        self.statement_rows = 0
+        self.statement_started = time.perf_counter()
+
+    def pause_statement(self):
+        self.statement_ms += (time.perf_counter() - self.statement_started) * 1000
+
+    def timed_fetch(self, fetch):
+        self.statement_started = time.perf_counter()
+        try:
+            return fetch()
+        finally:
+            if self.statement is not None:
+                self.pause_statement()
+
+    def count_rows(self, row_count, exhausted):
+        if self.statement is not None:
+            self.statement_rows += row_count
+            if exhausted:
+                self.finish_statement()
+
+    def finish_statement(self, rows=None):
+        if self.statement is not None:
+            instrumentation.record('queries', self.statement, self.statement_ms,
+                                   self.statement_rows if rows is None else rows, self.statement_call_site,
+                                   self.statement_parameters)
+            self.statement = None
+
+
+# OPT-IN PROFILER, TURNED ON WITH THE --profile OPTION OR THE NURSE_AID_PROFILE ENVIRONMENT VARIABLE. ONCE ENABLED,
+# EVERY STATEMENT RUN THROUGH A DatabaseManager CURSOR IS TIMED WITH ITS ROW COUNT AND CALL SITE, set_trace_callback
+# COUNTS EVERY STATEMENT SQLITE RUNS INCLUDING TRIGGER BODIES, AND DatabaseManager METHODS AND WINDOW HANDLERS ARE
+# WRAPPED IN TIMERS. NOTHING IS WRAPPED OR TRACED UNTIL enable() IS CALLED
+class Instrumentation:
+    # METHODS THAT RETURN GENERATORS OR CONTEXT MANAGERS, WHOSE CALLS TAKE NO TIME OF THEIR OWN
+    UNTIMED_METHODS = ('transaction', 'stream_rows', 'stream_resident_expiry_report_rows',
+                       'stream_home_expiry_report_rows')
+
+    def __init__(self):
+        self.enabled = False
+        self.cursor_class = sqlite3.Cursor
+        self.lock = threading.Lock()
+        self.timings = {'queries': {}, 'methods': {}, 'handlers': {}}
+        self.traced_statements = {}
+        self.events = {}
+
+    # START PROFILING. WINDOWS CREATED BEFORE THIS KEEP THEIR UNTIMED BUTTON COMMANDS, SO CALL IT AT START UP
+    def enable(self, pool=None):
+        if self.enabled:
+            return
+        self.enabled = True
+        self.cursor_class = InstrumentedCursor
+
+        self.wrap_methods(DatabaseManager, 'methods', self.UNTIMED_METHODS + ('close',))
+        window_classes = [WindowManager]
+        while window_classes:
+            window_class = window_classes.pop()
+            self.wrap_methods(window_class, 'handlers', ('center_window',))
+            window_classes.extend(window_class.__subclasses__())
+
+        with (pool or connection_pool).condition:
+            for connection in (pool or connection_pool).connections.values():
+                connection.set_trace_callback(self.trace)
+
+    # STATIC AND CLASS METHODS ARE TIMED THROUGH THEIR __func__ AND REWRAPPED IN THE SAME DESCRIPTOR, SO THEY ARE STILL
+    # CALLED WITHOUT self
+    def wrap_methods(self, owner_class, category, skipped_names):
+        for name, method in list(vars(owner_class).items()):
+            if name.startswith('__') or name.startswith('make_') or name in skipped_names:
+                continue
+            if isinstance(method, (staticmethod, classmethod)):
+                setattr(owner_class, name, type(method)(
+                    self.make_timer(method.__func__, category, f'{owner_class.__name__}.{name}')))
+            elif callable(method) and not isinstance(method, type):
+                setattr(owner_class, name, self.make_timer(method, category, f'{owner_class.__name__}.{name}'))
+
+    def make_timer(self, method, category, name):
+        @functools.wraps(method)
+        def timed_method(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.record(category, name, (time.perf_counter() - start) * 1000)
+        return timed_method
+
+    def record(self, category, name, milliseconds, rows=0, call_site=None, parameters=None):
+        with self.lock:
+            timings = self.timings[category]
+            if name not in timings:
+                timings[name] = Timing()
+            timings[name].add(milliseconds, rows, call_site, parameters)
+
+    # set_trace_callback TARGET. TRIGGER BODIES ARRIVE AS "-- TRIGGER name", OTHER STATEMENTS ARE COUNTED BY THEIR
+    # FIRST 100 CHARACTERS, CAPPED SO STATEMENTS WITH INLINED VALUES CANNOT GROW THE TABLE WITHOUT LIMIT
+    def trace(self, statement):
+        statement = ' '.join(statement.split())[:100]
+        with self.lock:
+            if statement not in self.traced_statements and len(self.traced_statements) >= 500:
+                statement = '(other statements)'
+            self.traced_statements[statement] = self.traced_statements.get(statement, 0) + 1
+
+    # COUNT A TK EVENT RECEIVED BY A WINDOW HANDLER
+    def record_event(self, event):
+        if self.enabled:
+            event_name = f'{event.type} on {event.widget}'
+            with self.lock:
+                self.events[event_name] = self.events.get(event_name, 0) + 1
+
+    def format_report(self, limit=15):
+        lines = []
+        titles = {'queries': 'SQL statements', 'methods': 'DatabaseManager methods', 'handlers': 'Window handlers'}
+        with self.lock:
+            for category, title in titles.items():
+                lines.append(f'{title}, highest total time first')
+                lines.append(f'{"count":>7} {"total ms":>10} {"mean ms":>9} {"p95 ms":>8} {"max ms":>9} '
+                             f'{"rows":>8}  name')
+                for name, timing in sorted(self.timings[category].items(),
+                                           key=lambda item: -item[1].total_ms)[:limit]:
+                    lines.append(f'{timing.count:>7} {timing.total_ms:>10.2f} {timing.total_ms / timing.count:>9.3f} '
+                                 f'{timing.percentile_ms(0.95):>8.2f} {timing.max_ms:>9.2f} {timing.rows:>8}  {name}')
+                    lines.append(f'{"":>9}{timing.format_histogram()}')
+                    if timing.call_sites:
+                        lines.append(f'{"":>9}from ' + ', '.join(
+                            f'{call_site} x{count}' for call_site, count in
+                            sorted(timing.call_sites.items(), key=lambda item: -item[1])[:3]))
+                lines.append('')
+
+            lines.append('Statements seen by set_trace_callback, including trigger bodies, most frequent first')
+            for statement, count in sorted(self.traced_statements.items(), key=lambda item: -item[1])[:limit]:
+                lines.append(f'{count:>7}  {statement}')
+            lines.append('')
+
+            if self.events:
+                lines.append('Tk events')
+                for event_name, count in sorted(self.events.items(), key=lambda item: -item[1])[:limit]:
+                    lines.append(f'{count:>7}  {event_name}')
+                lines.append('')
+        return '\n'.join(lines)
+
+    # EXPLAIN QUERY PLAN FOR THE limit STATEMENTS WITH THE WORST SINGLE RUN, USING THE LAST PARAMETERS EACH RAN WITH
+    def format_slowest_query_plans(self, database, limit=5):
+        with self.lock:
+            slowest = sorted(((timing.max_ms, statement, timing.parameters) for statement, timing in
+                              self.timings['queries'].items() if timing.parameters is not None), reverse=True)[:limit]
+
+        lines = []
+        for max_ms, statement, parameters in slowest:
+            lines.append(f'{max_ms:.2f} ms worst: {statement}')
+            try:
+                for plan_row in database.connection.execute(f'EXPLAIN QUERY PLAN {statement}', parameters):
+                    lines.append(f'    {plan_row[-1]}')
+            except sqlite3.Error as error:
+                lines.append(f'    (no plan: {error})')
+        return '\n'.join(lines)
+
+    # WRITE THE PROFILE AND THE SLOWEST STATEMENTS' PLANS TO file_path, OR TO stderr WHEN file_path IS '-'
+    def write_report(self, file_path, pool=None):
+        database = DatabaseManager(pool=pool)
+        report = f'{self.format_report()}\nSlowest statements\n{self.format_slowest_query_plans(database)}\n'
+        if file_path == '-':
+            sys.stderr.write(report)
+        else:
+            with open(file_path, 'w') as report_file:
+                report_file.write(report)
+
+
+instrumentation = Instrumentation()
+
+
+# PROFILE EVERYTHING RUN INSIDE THE with BLOCK AND WRITE THE REPORT TO file_path AT THE END, WHEN file_path IS SET
+@contextlib.contextmanager
+def profiling(file_path, pool=None):
+    if not file_path:
+        yield
+        return
+
+    instrumentation.enable(pool)
+    try:
+        yield
+    finally:
+        instrumentation.write_report(file_path, pool)
+
+
+# ONE COMMITTED WRITE: THE TABLE WRITTEN, THE ROW'S ID, AND A DICTIONARY OF THE COLUMNS WRITTEN. entity_id IS None
+# FOR A BULK WRITE WHOSE ROWS ARE NOT LISTED, WHICH SUBSCRIBERS TREAT AS "ANYTHING IN THIS TABLE MAY HAVE CHANGED"
+ChangeEvent = collections.namedtuple('ChangeEvent', ('entity', 'entity_id', 'fields'))
+
+
+# PUBLISHES DatabaseManager WRITES AS ChangeEvents ONCE THEY ARE COMMITTED. EVENTS WRITTEN INSIDE A transaction() WAIT
+# FOR ITS OUTERMOST COMMIT AND ARE DROPPED ON ROLLBACK. EACH CALLBACK GETS A LIST OF THE EVENTS FOR ITS ENTITIES
+# subscribe() CALLBACKS RUN STRAIGHT AWAY ON THE WRITING THREAD, SO THEY MUST BE THREAD SAFE, LIKE MedicationCache
+# subscribe_window() CALLBACKS RUN ON THE TK THREAD: WRITES MADE THERE ARE DELIVERED STRAIGHT AWAY, AND WRITES FROM
+# WORKER THREADS ARE QUEUED FOR AN after() POLL, LIKE TaskRunner'S, AND DELIVERED TOGETHER. WINDOWS ARE UNSUBSCRIBED
+# ONCE THEY HAVE BEEN DESTROYED
+class ChangeFeed:
+    def __init__(self, poll_milliseconds=50):
+        self.poll_milliseconds = poll_milliseconds
+        self.lock = threading.Lock()
+        self.subscribers = []
+        self.window_subscribers = []
+        self.uncommitted_events = {}
+        self.undelivered_events = []
+        self.tk_thread = None
+        self.root = None
+
+    def subscribe(self, entities, callback):
+        self.subscribers.append((entities, callback))
+
+    # THE POLL RUNS ON THE ROOT WINDOW, WHICH OUTLIVES EVERY SUBSCRIBER, WHILE ANY WINDOW IS SUBSCRIBED
+    def subscribe_window(self, window_manager, entities, callback):
+        self.tk_thread = threading.current_thread()
+        self.window_subscribers.append((window_manager, entities, callback))
+        if self.root is None:
+            self.root = window_manager.window.nametowidget('.')
+            self.root.after(self.poll_milliseconds, self.poll)
+
+    def publish(self, event, in_transaction=False):
+        if in_transaction:
+            with self.lock:
+                self.uncommitted_events.setdefault(threading.current_thread(), []).append(event)
+        else:
+            self.deliver([event])
+
+    # THE CALLING THREAD'S OUTERMOST transaction() HAS COMMITTED OR ROLLED BACK
+    def commit(self):
+        with self.lock:
+            events = self.uncommitted_events.pop(threading.current_thread(), None)
+        if events:
+            self.deliver(events)
+
+    def rollback(self):
+        with self.lock:
+            self.uncommitted_events.pop(threading.current_thread(), None)
+
+    def deliver(self, events):
+        for entities, callback in self.subscribers:
+            subscribed_events = [event for event in events if event.entity in entities]
+            if subscribed_events:
+                callback(subscribed_events)
+
+        with self.lock:
+            if not self.window_subscribers:
+                return
+            self.undelivered_events.extend(events)
+        if threading.current_thread() is self.tk_thread:
+            self.deliver_to_windows()
+
+    def deliver_to_windows(self):
+        with self.lock:
+            events, self.undelivered_events = self.undelivered_events, []
+        self.window_subscribers = [window_subscriber for window_subscriber in self.window_subscribers
+                                   if window_subscriber[0].window.winfo_exists()]
+        for window_manager, entities, callback in list(self.window_subscribers):
+            subscribed_events = [event for event in events if event.entity in entities]
+            if subscribed_events and window_manager.window.winfo_exists():
+                callback(subscribed_events)
+
+    def poll(self):
+        self.deliver_to_windows()
+        if self.window_subscribers:
+            self.root.after(self.poll_milliseconds, self.poll)
+        else:
+            self.root = None
+
+
+change_feed = ChangeFeed()
+
+
+# AN INSTANCE IS IN-DATE STOCK WHILE IT HAS SOME QUANTITY LEFT AND NO YYYY-MM-DD EXPIRY BEFORE TODAY, THE SAME RULE
+# AS collect_instances_running_out AND StockForecast
+IN_DATE_STOCK = "medication_info.quantity > 0 AND (medication_info.expiry IS NULL " \
+                "OR NOT (medication_info.expiry < date('now', 'localtime') " \
+                "AND medication_info.expiry GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'))"
+# IN-DATE STOCK ROLLED UP OVER A MEDICATION'S INSTANCES: TOTAL quantity x strength, TOTAL quantity, THE INSTANCES'
+# measurement, THE EARLIEST EXPIRY, AND COMBINED DAYS REMAINING, THE SUM OF EACH INSTANCE'S DAYS AS THEY ARE USED UP
+# ONE AFTER ANOTHER, 0 WHEN NONE IS IN DATE AND NULL WHEN NOTHING IS TAKEN REGULARLY. GROUPED BY medication.id OVER
+# MEDICATION_STOCK_JOINS, WHICH WALK medication_info_medication_id_index AND medication_info_stock'S PRIMARY KEY
+MEDICATION_STOCK_COLUMNS = f"TOTAL(CASE WHEN {IN_DATE_STOCK} " \
+                           f"THEN medication_info.quantity * medication_info.strength END), " \
+                           f"TOTAL(CASE WHEN {IN_DATE_STOCK} THEN medication_info.quantity END), " \
+                           f"MIN(medication_info.measurement), " \
+                           f"MIN(CASE WHEN {IN_DATE_STOCK} THEN medication_info.expiry END), " \
+                           f"SUM(CASE WHEN {IN_DATE_STOCK} THEN medication_info_stock.days_remaining " \
+                           f"WHEN medication_info_stock.days_remaining IS NOT NULL THEN 0 END)"
+MEDICATION_STOCK_JOINS = "LEFT JOIN medication_info ON medication_info.medication_id = medication.id " \
+                         "LEFT JOIN medication_info_stock " \
+                         "ON medication_info_stock.medication_info_id = medication_info.id"
+
+
+# SCHEMA MIGRATIONS, RUN IN ORDER ONCE EACH. PRAGMA user_version RECORDS HOW MANY HAVE BEEN APPLIED
+# 1: INDEX THE FOREIGN KEYS USED TO WALK RESIDENT -> MEDICATION -> INSTANCE -> DOSE
+def migrate_index_foreign_keys(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS medication_resident_id_index ON medication (resident_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS medication_info_medication_id_index ON medication_info (medication_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS dose_info_medication_info_id_index ON dose_info (medication_info_id)")
+
+
+# 2: INDEX EXPIRY DATES, COVERING THE EXPIRY -> MEDICATION LOOKUP
+def migrate_index_expiry(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS medication_info_expiry_index ON medication_info (expiry, medication_id)")
+
+
+# 3: REWRITE DATE PICKER '%m/%d/%y' EXPIRY AND DOB TEXT AS SORTABLE ISO-8601 DATES
+def migrate_iso_dates(cursor):
+    cursor.execute("SELECT id, expiry FROM medication_info")
+    cursor.executemany("UPDATE medication_info SET expiry=? WHERE id=?",
+                       [(to_iso_date(expiry), medication_info_id) for medication_info_id, expiry in cursor.fetchall()
+                        if to_iso_date(expiry) not in (None, expiry)])
+
+    cursor.execute("SELECT id, dob FROM resident")
+    cursor.executemany("UPDATE resident SET dob=? WHERE id=?",
+                       [(to_iso_date(dob, past_only=True), resident_id) for resident_id, dob in cursor.fetchall()
+                        if to_iso_date(dob, past_only=True) not in (None, dob)])
+
+
+# RECOMPUTE ONE INSTANCE'S medication_info_stock ROW. DAILY USAGE IS THE SUM OF dose x frequency_per_day OVER ITS
+# REGULAR DOSES, DAYS REMAINING IS strength x quantity / DAILY USAGE, OR NULL WHEN NOTHING IS TAKEN REGULARLY
+REFRESH_MEDICATION_INFO_STOCK = """
+    INSERT OR REPLACE INTO medication_info_stock (medication_info_id, daily_usage, days_remaining)
+    SELECT medication_info.id, usage.daily_usage,
+           CASE WHEN usage.daily_usage > 0
+                THEN medication_info.strength * medication_info.quantity / usage.daily_usage END
+    FROM medication_info,
+         (SELECT TOTAL(dose * frequency_per_day) AS daily_usage FROM dose_info
+          WHERE medication_info_id = {medication_info_id} AND regular_or_prn != 'PRN') AS usage
+    WHERE medication_info.id = {medication_info_id};"""
+
+
+# 4: MATERIALISE DAYS OF STOCK REMAINING PER INSTANCE, KEPT CURRENT BY TRIGGERS
+def migrate_medication_info_stock(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS medication_info_stock (
+                          medication_info_id integer PRIMARY KEY,
+                          daily_usage real,
+                          days_remaining real,
+                          FOREIGN KEY (medication_info_id) REFERENCES medication_info(id)
+                      )""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS medication_info_stock_days_remaining_index "
+                   "ON medication_info_stock (days_remaining)")
+
+    triggers = {
+        'medication_info_stock_after_medication_info_insert': (
+            'AFTER INSERT ON medication_info', ['NEW.id']),
+        'medication_info_stock_after_medication_info_update': (
+            'AFTER UPDATE OF quantity, strength ON medication_info', ['NEW.id']),
+        'medication_info_stock_after_dose_info_insert': (
+            'AFTER INSERT ON dose_info', ['NEW.medication_info_id']),
+        'medication_info_stock_after_dose_info_update': (
+            'AFTER UPDATE ON dose_info', ['OLD.medication_info_id', 'NEW.medication_info_id']),
+        'medication_info_stock_after_dose_info_delete': (
+            'AFTER DELETE ON dose_info', ['OLD.medication_info_id']),
+    }
+    for trigger_name, (trigger_event, medication_info_ids) in triggers.items():
+        cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS {trigger_name} {trigger_event} BEGIN
+                           {"".join(REFRESH_MEDICATION_INFO_STOCK.format(medication_info_id=medication_info_id)
+                                    for medication_info_id in medication_info_ids)}
+                           END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS medication_info_stock_after_medication_info_delete
+                      AFTER DELETE ON medication_info BEGIN
+                          DELETE FROM medication_info_stock WHERE medication_info_id = OLD.id;
+                      END""")
+
+    cursor.execute("SELECT id FROM medication_info")
+    for medication_info_id, in cursor.fetchall():
+        cursor.execute(REFRESH_MEDICATION_INFO_STOCK.format(medication_info_id='?'),
+                       (medication_info_id, medication_info_id))
+
+
+# 5: APPEND-ONLY DOSE ADMINISTRATION LOG. INSERTING A ROW DECREMENTS THE INSTANCE'S STOCK AND STAMPS THE QUANTITY
+# LEFT AFTERWARDS IN THE SAME STATEMENT, SO A BATCH OF ADMINISTRATIONS CAN BE WRITTEN WITH ONE executemany
+def migrate_dose_administration(cursor):
+    cursor.execute("""CREATE TABLE IF NOT EXISTS dose_administration (
+                          id integer PRIMARY KEY,
+                          dose_info_id integer,
+                          medication_info_id integer,
+                          administered_by text,
+                          administered_at text,
+                          quantity_used real,
+                          quantity_after real,
+                          FOREIGN KEY (dose_info_id) REFERENCES dose_info(id),
+                          FOREIGN KEY (medication_info_id) REFERENCES medication_info(id)
+                      )""")
+    cursor.execute("CREATE INDEX IF NOT EXISTS dose_administration_medication_info_id_index "
+                   "ON dose_administration (medication_info_id, administered_at)")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS dose_administration_after_insert
+                      AFTER INSERT ON dose_administration BEGIN
+                          UPDATE medication_info SET quantity = quantity - NEW.quantity_used
+                          WHERE id = NEW.medication_info_id;
+                          UPDATE dose_administration
+                          SET quantity_after = (SELECT quantity FROM medication_info WHERE id = NEW.medication_info_id)
+                          WHERE id = NEW.id;
+                      END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS dose_administration_before_update
+                      BEFORE UPDATE OF dose_info_id, medication_info_id, administered_by, administered_at,
+                                       quantity_used ON dose_administration BEGIN
+                          SELECT RAISE(ABORT, 'dose_administration is append-only');
+                      END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS dose_administration_before_delete
+                      BEFORE DELETE ON dose_administration BEGIN
+                          SELECT RAISE(ABORT, 'dose_administration is append-only');
+                      END""")
+
+
+# LOG ONE ADMINISTRATION OF A dose_info DOSE, PARAMETERS ARE (administered_by, administered_at, quantity_used OR
+# None FOR dose / strength UNITS, dose_info_id). THE dose_administration_after_insert TRIGGER DECREMENTS THE STOCK
+ADMINISTER_DOSE = """
+    INSERT INTO dose_administration (dose_info_id, medication_info_id, administered_by, administered_at, quantity_used)
+    SELECT dose_info.id, dose_info.medication_info_id, (?), (?),
+           COALESCE((?), CASE WHEN medication_info.strength > 0 THEN dose_info.dose / medication_info.strength
+                              ELSE 1 END)
+    FROM dose_info
+    JOIN medication_info ON medication_info.id = dose_info.medication_info_id
+    WHERE dose_info.id == (?);"""
+
+
+# THE dose_administration_before_insert ERROR, AND THE EXCEPTION administer_dose AND administer_doses TURN IT INTO
+NOT_ENOUGH_STOCK = 'not enough stock for this dose'
+
+
+class NotEnoughStock(Exception):
+    pass
+
+
+# RAISE NotEnoughStock INSTEAD OF THE dose_administration_before_insert TRIGGER'S sqlite3.IntegrityError
+@contextlib.contextmanager
+def raising_not_enough_stock():
+    try:
+        yield
+    except sqlite3.IntegrityError as error:
+        if NOT_ENOUGH_STOCK not in str(error):
+            raise
+        raise NotEnoughStock('There is not enough stock left to administer this dose.') from error
+
+
+# FULL TEXT SEARCH INDEXES FOR THE TYPE-AHEAD SEARCH BOXES, EXTERNAL CONTENT TABLES KEPT IN STEP BY TRIGGERS. prefix
+# ADDS PREFIX INDEXES SO THE FIRST FEW CHARACTERS TYPED MATCH WITHOUT SCANNING THE WHOLE TERM LIST
+SEARCH_INDEXES = {
+    'resident_search': ('resident', ('first_name', 'last_name', 'dob')),
+    'medication_search': ('medication', ('name', 'other_name', 'notes')),
+}
+
+
+# 6: BUILD THE SEARCH_INDEXES AND THE TRIGGERS THAT KEEP THEM IN STEP, SKIPPED ON AN SQLITE WITHOUT FTS5
+def migrate_search_index(cursor):
+    for search_table, (content_table, columns) in SEARCH_INDEXES.items():
+        column_list = ', '.join(columns)
+        new_values = ', '.join(f'NEW.{column}' for column in columns)
+        old_values = ', '.join(f'OLD.{column}' for column in columns)
+        try:
+            cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {search_table} USING fts5({column_list}, "
+                           f"content='{content_table}', content_rowid='id', prefix='1 2 3')")
+        except sqlite3.OperationalError as error:
+            # AN SQLITE BUILT WITHOUT FTS5 KEEPS WORKING, SEARCHES FALL BACK TO LIKE
+            if 'fts5' in str(error):
+                return
+            raise
+        cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS {search_table}_after_insert
+                          AFTER INSERT ON {content_table} BEGIN
+                              INSERT INTO {search_table} (rowid, {column_list}) VALUES (NEW.id, {new_values});
+                          END""")
+        cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS {search_table}_after_delete
+                          AFTER DELETE ON {content_table} BEGIN
+                              INSERT INTO {search_table} ({search_table}, rowid, {column_list})
+                              VALUES ('delete', OLD.id, {old_values});
+                          END""")
+        cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS {search_table}_after_update
+                          AFTER UPDATE OF {column_list} ON {content_table} BEGIN
+                              INSERT INTO {search_table} ({search_table}, rowid, {column_list})
+                              VALUES ('delete', OLD.id, {old_values});
+                              INSERT INTO {search_table} (rowid, {column_list}) VALUES (NEW.id, {new_values});
+                          END""")
+        cursor.execute(f"INSERT INTO {search_table} ({search_table}) VALUES ('rebuild')")
+
+
+# A SINGLE COUNTER BUMPED BY TRIGGERS ON EVERY WRITE TO THE TABLES A REPORT READS, INCLUDING WRITES FROM OTHER
+# TERMINALS, SO A CACHED REPORT CAN TELL WHETHER ANYTHING HAS CHANGED SINCE IT WAS WRITTEN
+DATA_VERSION_TABLES = ('resident', 'medication', 'medication_info', 'dose_info')
+
+
+# 7: CREATE THE data_version COUNTER AND THE TRIGGERS ON DATA_VERSION_TABLES THAT BUMP IT
+def migrate_data_version(cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS data_version (id integer PRIMARY KEY CHECK (id == 1), version integer)")
+    cursor.execute("INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 0)")
+    for table in DATA_VERSION_TABLES:
+        for trigger_event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_data_version_after_{trigger_event.lower()}
+                              AFTER {trigger_event} ON {table} BEGIN
+                                  UPDATE data_version SET version = version + 1 WHERE id == 1;
+                              END""")
+
+
+# 8: INDEX EACH MEDICATION'S IN-STOCK INSTANCES BY EXPIRY FOR allocate_medication_fefo. PARTIAL ON quantity > 0,
+# SO USED-UP DELIVERIES DROP OUT OF THE INDEX AND A LONG DELIVERY HISTORY DOES NOT LENGTHEN THE SCAN
+def migrate_index_medication_expiry(cursor):
+    cursor.execute("CREATE INDEX IF NOT EXISTS medication_info_medication_id_expiry_index "
+                   "ON medication_info (medication_id, expiry) WHERE quantity > 0")
+
+
+# 9: REFUSE A DOSE THAT WOULD TAKE ITS INSTANCE'S STOCK BELOW ZERO, AND KEEP quantity_after APPEND-ONLY TOO. IT IS
+# NULL UNTIL dose_administration_after_insert STAMPS IT, SO ONLY UPDATES AFTER THAT ARE REFUSED
+def migrate_dose_administration_guards(cursor):
+    cursor.execute(f"""CREATE TRIGGER IF NOT EXISTS dose_administration_before_insert
+                       BEFORE INSERT ON dose_administration
+                       WHEN (SELECT quantity FROM medication_info WHERE id = NEW.medication_info_id) < NEW.quantity_used
+                       BEGIN
+                           SELECT RAISE(ABORT, '{NOT_ENOUGH_STOCK}');
+                       END""")
+    cursor.execute("""CREATE TRIGGER IF NOT EXISTS dose_administration_before_update_quantity_after
+                      BEFORE UPDATE OF quantity_after ON dose_administration
+                      WHEN OLD.quantity_after IS NOT NULL BEGIN
+                          SELECT RAISE(ABORT, 'dose_administration is append-only');
+                      END""")
+
+
+# TURN TYPED TEXT INTO AN FTS5 QUERY MATCHING ROWS THAT CONTAIN EVERY WORD AS A PREFIX, e.g. 'jo smi' -> "jo"* "smi"*
+# RETURNS None WHEN THERE IS NOTHING TO SEARCH FOR
+def make_search_query(text):
+    words = ''.join(character if character.isalnum() else ' ' for character in text).split()
+    if not words:
+        return None
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+MIGRATIONS = [
+    migrate_index_foreign_keys,
+    migrate_index_expiry,
+    migrate_iso_dates,
+    migrate_medication_info_stock,
+    migrate_dose_administration,
+    migrate_search_index,
+    migrate_data_version,
+    migrate_index_medication_expiry,
+    migrate_dose_administration_guards,
+]
+
+
+# CONVERT A date, AN ISO DATE OR A DATE PICKER '%m/%d/%y' DATE TO ISO-8601 TEXT, None IF IT CANNOT BE READ
+# past_only MOVES TWO DIGIT YEARS THAT WOULD LAND IN THE FUTURE BACK A CENTURY, FOR DATES OF BIRTH
+def to_iso_date(value, past_only=False):
+    if isinstance(value, date):
+        return value.isoformat()
+    if not isinstance(value, str):
+        return None
+
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        pass
+
+    try:
+        parsed_date = datetime.strptime(value, '%m/%d/%y').date()
+    except ValueError:
+        return None
+
+    if past_only and parsed_date > date.today():
+        try:
+            parsed_date = parsed_date.replace(year=parsed_date.year - 100)
+        except ValueError:
+            parsed_date = parsed_date.replace(year=parsed_date.year - 100, day=28)
+    return parsed_date.isoformat()
 
 
 # DATABASE CREATION AND MANAGEMENT
 class DatabaseManager:
-    def __init__(self):
-        self.connection = sqlite3.connect('nurse_aid.db')
-        self.cursor = self.connection.cursor()
+    def __init__(self, pool=None):
+        self.pool = pool or connection_pool
+        self.connection = self.pool.get_connection()
+        self.cursor = self.connection.cursor(instrumentation.cursor_class)
+
+    # CLOSE THIS MANAGER'S CURSOR, THE SHARED CONNECTION STAYS OPEN FOR OTHER WINDOWS
+    def close(self):
+        self.cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # UNIT OF WORK, e.g. "with database.transaction(): ..." COMMITS EVERY WRITE INSIDE IT ONCE, OR ROLLS THEM ALL
+    # BACK IF AN EXCEPTION ESCAPES. NESTED transaction() BLOCKS JOIN THE OUTERMOST ONE
+    # THE OUTERMOST BLOCK TAKES THE WRITE LOCK UP FRONT WITH BEGIN IMMEDIATE, WAITING AND RETRYING WHILE ANOTHER
+    # TERMINAL HOLDS IT, SO THE BLOCK CANNOT FAIL HALFWAY WITH "database is locked"
+    @contextlib.contextmanager
+    def transaction(self):
+        if self.pool.transaction_depth() == 0 and not self.connection.in_transaction:
+            retry_when_busy(lambda: self.cursor.execute("BEGIN IMMEDIATE"), self.pool.busy_retries)
+        self.pool.change_transaction_depth(+1)
+        try:
+            yield self
+        except BaseException:
+            if self.pool.change_transaction_depth(-1) == 0:
+                self.connection.rollback()
+                change_feed.rollback()
+            raise
+        else:
+            if self.pool.change_transaction_depth(-1) == 0:
+                self.connection.commit()
+                change_feed.commit()
+
+    # PUBLISH A WRITE TO change_feed, ONCE THE transaction() IT IS PART OF COMMITS. CALLED AFTER commit()
+    def publish_change(self, entity, entity_id, **fields):
+        change_feed.publish(ChangeEvent(entity, entity_id, fields), in_transaction=self.pool.transaction_depth() > 0)
+
+    # COMMIT A SINGLE WRITE, UNLESS IT IS PART OF A transaction()
+    def commit(self):
+        if self.pool.transaction_depth() == 0:
+            self.connection.commit()
 
     # CREATE TABLES
     def create_tables(self):
@@ -67,38 +916,134 @@ class DatabaseManager:
 
         self.connection.commit()
 
+        self.migrate()
+
+    # UPGRADE AN EXISTING DATABASE IN PLACE, ONE TRANSACTION PER MIGRATION
+    # THE VERSION IS RE-READ UNDER THE WRITE LOCK, SO TERMINALS STARTING TOGETHER APPLY EACH MIGRATION ONCE
+    def migrate(self):
+        while True:
+            retry_when_busy(lambda: self.cursor.execute("BEGIN IMMEDIATE"), self.pool.busy_retries)
+            try:
+                schema_version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+                if schema_version >= len(MIGRATIONS):
+                    self.connection.commit()
+                    return
+                MIGRATIONS[schema_version](self.cursor)
+                self.cursor.execute(f"PRAGMA user_version = {schema_version + 1}")
+            except sqlite3.Error:
+                self.connection.rollback()
+                raise
+            self.connection.commit()
+
     # COLLECT RESIDENT IDENTIFIERS
     def collect_resident_identifiers(self):
         self.cursor.execute("SELECT id, first_name, last_name, dob FROM resident")
-        self.connection.commit()
+        return self.cursor.fetchall()
+
+    # KEYSET PAGES FOR PagedListbox: UP TO limit ROWS WITH AN ID AFTER after_id, IN ID ORDER
+    def collect_resident_identifiers_page(self, after_id, limit):
+        self.cursor.execute("SELECT id, first_name, last_name, dob FROM resident WHERE id > (?) ORDER BY id LIMIT (?);",
+                            (after_id or 0, limit))
+        return self.cursor.fetchall()
+
+    # MEDICATION PAGES ARE medication.* FOLLOWED BY THE MEDICATION_STOCK_COLUMNS ROLLUP OF ITS INSTANCES
+    def collect_resident_medication_page(self, resident_id, after_id, limit):
+        self.cursor.execute(f"SELECT medication.*, {MEDICATION_STOCK_COLUMNS} FROM medication {MEDICATION_STOCK_JOINS} "
+                            f"WHERE medication.resident_id == (?) AND medication.id > (?) GROUP BY medication.id "
+                            f"ORDER BY medication.id LIMIT (?);", (int(resident_id), after_id or 0, limit))
+        return self.cursor.fetchall()
+
+    # ONE MEDICATION IN THE SAME SHAPE AS ITS collect_resident_medication_page ROW, OR None
+    def collect_medication_with_stock(self, medication_id):
+        self.cursor.execute(f"SELECT medication.*, {MEDICATION_STOCK_COLUMNS} FROM medication {MEDICATION_STOCK_JOINS} "
+                            f"WHERE medication.id == (?) GROUP BY medication.id;", (int(medication_id),))
+        return self.cursor.fetchone()
+
+    # KEYSET PAGES OF SEARCH RESULTS, EVERY WORD OF text MUST START A WORD IN THE NAME, DOB OR NOTES
+    def search_residents_page(self, text, after_id, limit):
+        return self.search_page(
+            "SELECT resident.id, resident.first_name, resident.last_name, resident.dob FROM resident_search "
+            "JOIN resident ON resident.id = resident_search.rowid "
+            "WHERE resident_search MATCH (?) AND resident_search.rowid > (?) ORDER BY resident_search.rowid LIMIT (?);",
+            "SELECT id, first_name, last_name, dob FROM resident WHERE id > (?) AND ({}) ORDER BY id LIMIT (?);",
+            ('first_name', 'last_name', 'dob'), (), text, after_id, limit)
+
+    def search_resident_medication_page(self, resident_id, text, after_id, limit):
+        return self.search_page(
+            f"SELECT medication.*, {MEDICATION_STOCK_COLUMNS} FROM medication_search "
+            f"JOIN medication ON medication.id = medication_search.rowid {MEDICATION_STOCK_JOINS} "
+            f"WHERE medication_search MATCH (?) AND medication.resident_id == (?) AND medication_search.rowid > (?) "
+            f"GROUP BY medication.id ORDER BY medication.id LIMIT (?);",
+            f"SELECT medication.*, {MEDICATION_STOCK_COLUMNS} FROM medication {MEDICATION_STOCK_JOINS} "
+            f"WHERE medication.resident_id == (?) AND medication.id > (?) AND ({{}}) GROUP BY medication.id "
+            f"ORDER BY medication.id LIMIT (?);",
+            ('medication.name', 'medication.other_name', 'medication.notes'), (int(resident_id),), text, after_id,
+            limit)
+
+    def search_page(self, search_sql, fallback_sql, columns, parameters, text, after_id, limit):
+        search_query = make_search_query(text)
+        if search_query is None:
+            return []
+        try:
+            self.cursor.execute(search_sql, (search_query,) + parameters + (after_id or 0, limit))
+        except sqlite3.OperationalError as error:
+            if 'no such table' not in str(error):
+                raise
+            # NO FTS5 IN THIS SQLITE, SO SCAN WITH LIKE INSTEAD
+            words = search_query.replace('"', '').replace('*', '').split()
+            matches = ' AND '.join('(' + ' OR '.join(f"{column} LIKE (?)" for column in columns) + ')'
+                                   for _ in words)
+            self.cursor.execute(fallback_sql.format(matches), parameters + (after_id or 0,) + tuple(
+                f'%{word}%' for word in words for _ in columns) + (limit,))
+        return self.cursor.fetchall()
+
+    def collect_medication_instances_page(self, medication_id, after_id, limit):
+        self.cursor.execute("SELECT * FROM medication_info WHERE medication_id == (?) AND id > (?) ORDER BY id "
+                            "LIMIT (?);", (int(medication_id), after_id or 0, limit))
         return self.cursor.fetchall()
 
     # ADD RESIDENT TO DATABASE
+    @retry_write_when_busy
     def add_resident_to_database(self, first_name, last_name, dob):
-        self.cursor.execute("INSERT INTO resident (first_name, last_name, dob) VALUES (?, ?, ?)", (first_name,
-                                                                                                   last_name, dob))
-        self.connection.commit()
+        dob = to_iso_date(dob, past_only=True) or dob
+        self.cursor.execute("INSERT INTO resident (first_name, last_name, dob) VALUES (?, ?, ?)", (
+            first_name, last_name, dob))
+        self.commit()
+        resident_id = self.cursor.lastrowid
+        self.publish_change('resident', resident_id, first_name=first_name, last_name=last_name, dob=dob)
+        return resident_id
 
     # ADD MEDICATION TO DATABASE
+    @retry_write_when_busy
     def add_medication_to_database(self, medication_name, medication_other_name, resident_id):
         self.cursor.execute("INSERT INTO medication (name, other_name, resident_id) VALUES (?, ?, ?)", (
             medication_name, medication_other_name, resident_id))
-        self.connection.commit()
+        self.commit()
+        medication_id = self.cursor.lastrowid
+        self.publish_change('medication', medication_id, name=medication_name, other_name=medication_other_name,
+                            resident_id=int(resident_id))
+        return medication_id
 
     # ADD MEDICATION INSTANCE TO DATABASE
+    @retry_write_when_busy
     def add_medication_instance_to_database(self, instance_expiry, instance_quantity, instance_strength,
                                             instance_medication_type, instance_medication_id, instance_supplier,
                                             instance_measurement):
         self.cursor.execute("INSERT INTO medication_info (expiry, quantity, strength, medication_type, medication_id, "
                             "supplier, measurement) VALUES (?, ?, ?, ?, ?, ?, ?)",
-                            (instance_expiry, instance_quantity,
+                            (to_iso_date(instance_expiry) or instance_expiry, instance_quantity,
                              instance_strength,
                              instance_medication_type,
                              instance_medication_id,
                              instance_supplier, instance_measurement))
-        self.connection.commit()
+        self.commit()
+        medication_info_id = self.cursor.lastrowid
+        self.publish_change('medication_info', medication_info_id, quantity=instance_quantity,
+                            strength=instance_strength, medication_id=int(instance_medication_id))
+        return medication_info_id
 
     # ADD MEDICATION INSTANCE DOSE TO DATABASE
+    @retry_write_when_busy
     def add_medication_instance_dose_to_database(self, dose_amount, dose_measurement, dose_frequency, dose_regularity,
                                                  dose_medication_info_id,):
         self.cursor.execute("INSERT INTO dose_info (dose, measurement, frequency_per_day, regular_or_prn,"
@@ -108,76 +1053,1301 @@ class DatabaseManager:
                                 dose_frequency,
                                 dose_regularity,
                                 dose_medication_info_id))
-        self.connection.commit()
+        self.commit()
+        dose_info_id = self.cursor.lastrowid
+        self.publish_change('dose_info', dose_info_id, dose=dose_amount, frequency_per_day=dose_frequency,
+                            regular_or_prn=dose_regularity, medication_info_id=int(dose_medication_info_id))
+        return dose_info_id
 
     # ADD MEDICATION NOTES TO DATABASE
+    @retry_write_when_busy
     def add_medication_notes_to_database(self, notes_text_box, medication_id):
         self.cursor.execute('UPDATE medication SET notes=? WHERE id=?', [notes_text_box, medication_id])
-        self.connection.commit()
+        self.commit()
+        self.publish_change('medication', int(medication_id), notes=notes_text_box)
+
+    # BULK INSERTS, ONE executemany AND ONE COMMIT PER CALL. EACH TAKES AN ITERABLE OF TUPLES IN THE SAME ORDER
+    # AS THE MATCHING SINGLE ROW add_*_to_database METHOD
+    def add_residents_to_database(self, residents):
+        with self.transaction():
+            self.cursor.executemany("INSERT INTO resident (first_name, last_name, dob) VALUES (?, ?, ?)",
+                                    ((first_name, last_name, to_iso_date(dob, past_only=True) or dob)
+                                     for first_name, last_name, dob in residents))
+            self.publish_change('resident', None)
+
+    def add_medications_to_database(self, medications):
+        with self.transaction():
+            self.cursor.executemany("INSERT INTO medication (name, other_name, resident_id) VALUES (?, ?, ?)",
+                                    medications)
+            self.publish_change('medication', None)
+
+    def add_medication_instances_to_database(self, instances):
+        with self.transaction():
+            self.cursor.executemany("INSERT INTO medication_info (expiry, quantity, strength, medication_type, "
+                                    "medication_id, supplier, measurement) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    ((to_iso_date(expiry) or expiry, *instance) for expiry, *instance in instances))
+            self.publish_change('medication_info', None)
+
+    def add_medication_instance_doses_to_database(self, doses):
+        with self.transaction():
+            self.cursor.executemany("INSERT INTO dose_info (dose, measurement, frequency_per_day, regular_or_prn,"
+                                    " medication_info_id) VALUES (?, ?, ?, ?, ?)", doses)
+            self.publish_change('dose_info', None)
+
+    # COLLECT ONE RESIDENT'S IDENTIFIERS
+    def collect_resident(self, resident_id):
+        self.cursor.execute("SELECT id, first_name, last_name, dob FROM resident WHERE id == (?);", (resident_id,))
+        return self.cursor.fetchone()
+
+    # COLLECT ONE MEDICATION
+    def collect_medication(self, medication_id):
+        self.cursor.execute("SELECT * FROM medication WHERE id == (?);", (medication_id,))
+        return self.cursor.fetchone()
 
     # COLLECT RESIDENT MEDICATION
     def collect_resident_medication(self, resident_id):
         self.cursor.execute("SELECT * FROM medication WHERE resident_id == (?);", (str(resident_id),))
-        self.connection.commit()
         return self.cursor.fetchall()
 
     # COLLECT MEDICATION INSTANCES
     def collect_medication_instances(self, medication_id):
         self.cursor.execute("SELECT * FROM medication_info WHERE medication_id == (?);", (str(medication_id),))
-        self.connection.commit()
         return self.cursor.fetchall()
 
     # COLLECT MEDICATION INSTANCE DOSES
     def collect_medication_instance_doses(self, medication_info_id):
         self.cursor.execute("SELECT * FROM dose_info WHERE medication_info_id == (?);", (str(medication_info_id),))
-        self.connection.commit()
         return self.cursor.fetchall()
 
+    # COLLECT ONE MEDICATION INSTANCE
+    def collect_medication_instance(self, medication_info_id):
+        self.cursor.execute("SELECT * FROM medication_info WHERE id == (?);", (medication_info_id,))
+        return self.cursor.fetchone()
+
     # COLLECT QUANTITY AND STRENGTH
     def collect_quantity_and_strength(self, medication_info_id):
         self.cursor.execute("SELECT quantity, strength FROM medication_info WHERE id == (?);", (str(medication_info_id),
                                                                                                 ))
-        self.connection.commit()
         quantity_and_strength = self.cursor.fetchall()
         current_quantity = quantity_and_strength[0][0]
         current_strength = quantity_and_strength[0][1]
         return current_quantity, current_strength
 
-    # COLLECT MEDICATIONS INSTANCES EXPIRY DATES
-    def collect_medications_instances_expiry_dates(self, resident_id):
-        self.cursor.execute("SELECT id FROM medication WHERE resident_id == (?);", (str(resident_id,)))
-        medication_ids_owned_by_resident = self.cursor.fetchall()
-        expiry_dates = []
-        for medication_id in medication_ids_owned_by_resident:
-            self.cursor.execute("SELECT expiry FROM medication_info WHERE medication_id == (?);", medication_id)
-            for date in self.cursor.fetchall():
-                expiry_dates.append(date[0])
-        self.connection.commit()
-        return expiry_dates
+    # COLLECT EXPIRY REPORT ROWS FOR EVERY MEDICATION INSTANCE OWNED BY A RESIDENT
+    def collect_resident_expiry_report_rows(self, resident_id):
+        return list(self.stream_resident_expiry_report_rows(resident_id))
+
+    def stream_resident_expiry_report_rows(self, resident_id):
+        return self.stream_rows("""SELECT medication.name, medication_info.expiry, medication_info.quantity,
+                                          medication_info.strength, medication_info.measurement,
+                                          medication_info.supplier
+                                   FROM resident
+                                   JOIN medication ON medication.resident_id = resident.id
+                                   JOIN medication_info ON medication_info.medication_id = medication.id
+                                   WHERE resident.id == (?)
+                                   ORDER BY medication.name, medication_info.id;""", (resident_id,))
+
+    # COLLECT EXPIRY REPORT ROWS FOR EVERY RESIDENT IN THE HOME, GROUPED BY RESIDENT
+    def collect_home_expiry_report_rows(self):
+        return list(self.stream_home_expiry_report_rows())
+
+    def stream_home_expiry_report_rows(self):
+        return self.stream_rows("""SELECT resident.id, resident.first_name, resident.last_name, resident.dob,
+                                          medication.name, medication_info.expiry, medication_info.quantity,
+                                          medication_info.strength, medication_info.measurement,
+                                          medication_info.supplier
+                                   FROM resident
+                                   LEFT JOIN medication ON medication.resident_id = resident.id
+                                   LEFT JOIN medication_info ON medication_info.medication_id = medication.id
+                                   ORDER BY resident.id, medication.name, medication_info.id;""")
+
+    # YIELD A QUERY'S ROWS batch_size AT A TIME FROM ITS OWN CURSOR, SO A REPORT CAN CONSUME THEM AS THEY ARE READ
+    # WITHOUT THE WHOLE RESULT SET BEING FETCHED FIRST, AND WITHOUT TYING UP self.cursor
+    def stream_rows(self, sql, parameters=(), batch_size=500):
+        cursor = self.connection.cursor(instrumentation.cursor_class)
+        try:
+            cursor.execute(sql, parameters)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+        finally:
+            cursor.close()
+
+    # THE CURRENT data_version COUNTER, SEE migrate_data_version
+    def collect_data_version(self):
+        self.cursor.execute("SELECT version FROM data_version WHERE id == 1;")
+        return self.cursor.fetchone()[0]
+
+    # COLLECT INSTANCES EXPIRING BEFORE A DATE, AS AN INDEXED RANGE SCAN OVER ISO EXPIRY DATES
+    def collect_instances_expiring_before(self, before_date, resident_id=None):
+        return self.collect_instances_expiring_between(date.min, before_date, resident_id)
+
+    # COLLECT INSTANCES EXPIRING ON OR AFTER start_date AND BEFORE end_date, EARLIEST FIRST
+    def collect_instances_expiring_between(self, start_date, end_date, resident_id=None):
+        self.cursor.execute("""SELECT medication.resident_id, medication.id, medication.name, medication_info.id,
+                                      medication_info.expiry, medication_info.quantity
+                               FROM medication_info
+                               JOIN medication ON medication.id = medication_info.medication_id
+                               WHERE medication_info.expiry >= (?) AND medication_info.expiry < (?)
+                                 AND medication_info.expiry GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'
+                                 AND ((?) IS NULL OR medication.resident_id == (?))
+                               ORDER BY medication_info.expiry;""",
+                            (to_iso_date(start_date), to_iso_date(end_date), resident_id, resident_id))
+        return self.cursor.fetchall()
 
-    # COLLECT MEDICATION IDS WHERE DATES MATCH
-    def collect_medication_ids_where_dates_match(self, date):
-        self.cursor.execute("SELECT medication_id FROM medication_info WHERE expiry == (?);", (date,))
-        self.connection.commit()
+    # EVERY INSTANCE AS (id, quantity, strength, expiry) AND EVERY REGULAR DOSE AS (medication_info_id, dose,
+    # frequency_per_day), THE COLUMNS StockForecast IS BUILT FROM. AN expiry THAT IS NOT A YYYY-MM-DD DATE IS NULL
+    def collect_forecast_rows(self):
+        self.cursor.execute("""SELECT id, IFNULL(quantity, 0), IFNULL(strength, 0),
+                                      CASE WHEN expiry GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]' THEN expiry END
+                               FROM medication_info;""")
+        instance_rows = self.cursor.fetchall()
+        self.cursor.execute("""SELECT medication_info_id, IFNULL(dose, 0), IFNULL(frequency_per_day, 0) FROM dose_info
+                               WHERE regular_or_prn != 'PRN' AND medication_info_id IS NOT NULL;""")
+        return instance_rows, self.cursor.fetchall()
+
+    # COLLECT WHO AND WHAT EACH OF medication_info_ids IS, AS A DICTIONARY OF medication_info_id TO
+    # (medication_info_id, first_name, last_name, medication name, expiry, quantity)
+    def collect_instance_descriptions(self, medication_info_ids):
+        self.cursor.execute("""SELECT medication_info.id, resident.first_name, resident.last_name, medication.name,
+                                      medication_info.expiry, medication_info.quantity
+                               FROM medication_info
+                               JOIN medication ON medication.id = medication_info.medication_id
+                               JOIN resident ON resident.id = medication.resident_id
+                               WHERE medication_info.id IN (SELECT value FROM json_each(?));""",
+                            (json.dumps(list(medication_info_ids)),))
+        return {description[0]: description for description in self.cursor.fetchall()}
+
+    # COLLECT INSTANCES WITH FEWER THAN days DAYS OF REGULAR DOSES LEFT, AS A RANGE SCAN OF medication_info_stock
+    # USED-UP AND EXPIRED DELIVERIES ARE LEFT OUT, THEY ARE NOT STOCK THAT IS RUNNING OUT
+    def collect_instances_running_out(self, days, resident_id=None):
+        self.cursor.execute("""SELECT resident.id, resident.first_name, resident.last_name, medication.id,
+                                      medication.name, medication_info.id, medication_info.expiry,
+                                      medication_info.quantity, medication_info_stock.daily_usage,
+                                      medication_info_stock.days_remaining
+                               FROM medication_info_stock
+                               JOIN medication_info ON medication_info.id = medication_info_stock.medication_info_id
+                               JOIN medication ON medication.id = medication_info.medication_id
+                               JOIN resident ON resident.id = medication.resident_id
+                               WHERE medication_info_stock.days_remaining < (?)
+                                 AND medication_info.quantity > 0
+                                 AND (medication_info.expiry IS NULL
+                                      OR NOT (medication_info.expiry < (?) AND medication_info.expiry
+                                              GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'))
+                                 AND ((?) IS NULL OR resident.id == (?))
+                               ORDER BY medication_info_stock.days_remaining;""",
+                            (days, to_iso_date(date.today()), resident_id, resident_id))
+        return self.cursor.fetchall()
+
+    # RECORD ONE DOSE GIVEN, RETURNING THE INSTANCE'S QUANTITY AFTERWARDS, OR None IF THE DOSE DOES NOT EXIST
+    # RAISES NotEnoughStock, RECORDING NOTHING, IF THE INSTANCE HAS LESS STOCK LEFT THAN THE DOSE USES
+    @retry_write_when_busy
+    def administer_dose(self, dose_info_id, administered_by, administered_at=None, quantity_used=None):
+        with self.transaction(), raising_not_enough_stock():
+            self.cursor.execute(ADMINISTER_DOSE, (administered_by,
+                                                  administered_at or datetime.now().isoformat(timespec='seconds'),
+                                                  quantity_used, dose_info_id))
+        if not self.cursor.rowcount:
+            return None
+        self.cursor.execute("SELECT medication_info_id, quantity_after FROM dose_administration WHERE id == (?);",
+                            (self.cursor.lastrowid,))
+        medication_info_id, quantity_after = self.cursor.fetchone()
+        self.publish_change('medication_info', medication_info_id, quantity=quantity_after)
+        return quantity_after
+
+    # RECORD A ROUND OF (dose_info_id, administered_by, administered_at, quantity_used) IN ONE TRANSACTION,
+    # RETURNING HOW MANY WERE RECORDED. administered_at DEFAULTS TO NOW AND quantity_used TO dose / strength UNITS
+    # RAISES NotEnoughStock, RECORDING NONE OF THE ROUND, IF ANY DOSE WOULD TAKE ITS INSTANCE BELOW ZERO
+    def administer_doses(self, administrations):
+        with self.transaction(), raising_not_enough_stock():
+            self.cursor.executemany(ADMINISTER_DOSE, (
+                (administered_by, administered_at or datetime.now().isoformat(timespec='seconds'), quantity_used,
+                 dose_info_id)
+                for dose_info_id, administered_by, administered_at, quantity_used in administrations))
+            administered_count = self.cursor.rowcount
+            self.publish_change('medication_info', None)
+        return administered_count
+
+    # DRAW amount OF A MEDICATION FROM ITS INSTANCES EARLIEST EXPIRY FIRST, SPLITTING ACROSS INSTANCES AS EACH RUNS
+    # OUT AND SKIPPING INSTANCES EXPIRED BEFORE on_date. RETURNS [(medication_info_id, quantity_used, quantity_after)],
+    # WHICH ADDS UP TO LESS THAN amount WHEN THERE IS NOT ENOUGH IN-DATE STOCK. RAISES ValueError UNLESS amount IS A
+    # NUMBER GREATER THAN ZERO. AN INSTANCE WITHOUT AN EXPIRY IS USED LAST, AND ONE WHOSE EXPIRY IS NOT A YYYY-MM-DD
+    # DATE IS NEVER TREATED AS EXPIRED AND IS ORDERED BY ITS EXPIRY TEXT AMONG THE DATES
+    # DATED AND UNDATED INSTANCES ARE READ SEPARATELY, SO EACH IS AN ORDERED SCAN OF
+    # medication_info_medication_id_expiry_index WITH NO SORT STEP. EACH DRAW IS LOGGED IN dose_administration WITHOUT
+    # A dose_info_id, WHOSE TRIGGER TAKES IT OFF THE INSTANCE, SO THE QUANTITY HISTORY STILL ADDS UP
+    def allocate_medication_fefo(self, medication_id, amount, on_date=None, used_by=None):
+        remaining = float(amount)
+        if not 0 < remaining < float('inf'):
+            raise ValueError(f'The amount to use must be a number greater than zero, not {amount}.')
+        allocations = []
+        with self.transaction():
+            for allocation_query, parameters in (
+                    ("""SELECT id, quantity FROM medication_info
+                          WHERE medication_id == (?) AND quantity > 0 AND expiry IS NOT NULL
+                            AND NOT (expiry < (?) AND expiry GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]')
+                          ORDER BY expiry, id;""", (int(medication_id), to_iso_date(on_date or date.today()))),
+                    ("""SELECT id, quantity FROM medication_info
+                          WHERE medication_id == (?) AND quantity > 0 AND expiry IS NULL
+                          ORDER BY id;""", (int(medication_id),))):
+                if remaining <= 0:
+                    break
+                self.cursor.execute(allocation_query, parameters)
+                for medication_info_id, quantity in iter(self.cursor.fetchone, None):
+                    if remaining <= 0:
+                        break
+                    quantity_used = min(quantity, remaining)
+                    allocations.append((medication_info_id, quantity_used, quantity - quantity_used))
+                    remaining -= quantity_used
+
+            used_at = datetime.now().isoformat(timespec='seconds')
+            self.cursor.executemany("INSERT INTO dose_administration (medication_info_id, administered_by, "
+                                    "administered_at, quantity_used) VALUES (?, ?, ?, ?)",
+                                    [(medication_info_id, used_by, used_at, quantity_used)
+                                     for medication_info_id, quantity_used, quantity_after in allocations])
+            for medication_info_id, quantity_used, quantity_after in allocations:
+                self.publish_change('medication_info', medication_info_id, quantity=quantity_after,
+                                    medication_id=int(medication_id))
+        return allocations
+
+    # COLLECT AN INSTANCE'S QUANTITY HISTORY FROM THE ADMINISTRATION LOG, OLDEST FIRST
+    def collect_quantity_history(self, medication_info_id):
+        self.cursor.execute("""SELECT administered_at, administered_by, dose_info_id, quantity_used, quantity_after
+                               FROM dose_administration WHERE medication_info_id == (?)
+                               ORDER BY administered_at, id;""", (medication_info_id,))
         return self.cursor.fetchall()
 
     # COLLECT CURRENTLY SELECTED MEDICATION NAME
     def collect_medication_name(self, medication_id):
         self.cursor.execute("SELECT name FROM medication WHERE id == (?);", (str(medication_id),))
-        self.connection.commit()
         return self.cursor.fetchall()
 
     # COLLECT MEDICATION NOTES
     def collect_medication_notes(self, medication_id):
         self.cursor.execute("SELECT notes FROM medication WHERE id == (?);", (str(medication_id),))
-        self.connection.commit()
         return self.cursor.fetchall()[0][0]
 
     # MODIFY MEDICATION INSTANCE QUANTITY
+    @retry_write_when_busy
     def modify_medication_instance_quantity(self, modify_stock_field, medication_info_id):
         self.cursor.execute('UPDATE medication_info SET quantity=? WHERE id=?', [float(modify_stock_field),
                                                                                  medication_info_id])
-        self.connection.commit()
+        self.commit()
+        self.publish_change('medication_info', int(medication_info_id), quantity=float(modify_stock_field))
+
+
+# IN-MEMORY RESIDENT -> MEDICATION -> INSTANCE -> DOSE TREE BETWEEN THE WINDOWS AND DatabaseManager
+# READS MIRROR DatabaseManager AND ARE SERVED FROM MEMORY AFTER THE FIRST QUERY, WRITES GO STRAIGHT TO THE
+# DATABASE AND THEIR change_feed EVENTS INVALIDATE ONLY THE AFFECTED SUBTREE. change_feed ONLY SEES THIS TERMINAL'S
+# WRITES, SO READS ALSO CHECK THE data_version COUNTER, AT MOST EVERY DATA_VERSION_CHECK_SECONDS, AND DROP EVERYTHING
+# ONCE IT HAS MOVED FOR ANY WRITE BUT THE CACHE'S OWN
+class MedicationCache:
+    def __init__(self, pool=None):
+        self.pool = pool
+        self.lock = threading.RLock()
+
+        # PagedListbox PAGES, KEYED BY (after_id, limit): ALL RESIDENTS, EACH RESIDENT'S MEDICATION WITH ITS STOCK
+        # ROLLUP, AND EACH MEDICATION'S INSTANCES
+        self.resident_pages = {}
+        self.resident_medication = {}
+        self.medication_instances = {}
+        self.medication_instance_doses = {}
+        # SINGLE ROWS BY ID, SO ONE MEDICATION OR INSTANCE IS READ WITHOUT ITS SIBLINGS
+        self.medication_rows = {}
+        self.medication_instance_rows = {}
+
+        # CHILD ID -> PARENT ID, SO A WRITE CAN FIND THE SUBTREE IT INVALIDATES
+        self.medication_resident_ids = {}
+        self.medication_info_medication_ids = {}
+
+        # THE data_version THE CACHED ENTRIES ARE CURRENT AT, AND WHEN IT WAS LAST CHECKED
+        self.data_version = None
+        self.data_version_checked_at = None
+
+    # DROP EVERYTHING IF data_version HAS MOVED ON SINCE THE CACHED ENTRIES WERE LOADED. BETWEEN CHECKS READS ARE
+    # SERVED FROM MEMORY WITHOUT TOUCHING THE DATABASE
+    def check_data_version(self):
+        with self.lock:
+            if self.data_version_checked_at is not None and \
+                    time.monotonic() - self.data_version_checked_at < DATA_VERSION_CHECK_SECONDS:
+                return
+            data_version = DatabaseManager(pool=self.pool).collect_data_version()
+            if data_version != self.data_version:
+                self.clear()
+                self.data_version = data_version
+            self.data_version_checked_at = time.monotonic()
+
+    # RUN write(database) IN ONE transaction(), READING data_version AT ITS START AND END. BEGIN IMMEDIATE HOLDS THE
+    # WRITE LOCK THROUGHOUT, SO IN BETWEEN THE COUNTER ONLY MOVES FOR THIS WRITE, WHOSE SUBTREES change_feed HAS
+    # ALREADY INVALIDATED. IF IT HAD MOVED BEFORE THE START, ANOTHER TERMINAL HAS WRITTEN AND EVERYTHING IS DROPPED
+    def write(self, write):
+        database = DatabaseManager(pool=self.pool)
+        with database.transaction():
+            data_version_before = database.collect_data_version()
+            result = write(database)
+            data_version_after = database.collect_data_version()
+        with self.lock:
+            if data_version_before != self.data_version:
+                self.clear()
+            self.data_version = data_version_after
+        return result
+
+    # RETURN A CACHED VALUE, LOADING IT WITH load() ON A MISS
+    def get(self, store, key, load):
+        with self.lock:
+            self.check_data_version()
+            if key not in store:
+                store[key] = load(DatabaseManager(pool=self.pool))
+            return store[key]
+
+    # DROP EVERYTHING, e.g. AFTER ANOTHER PROGRAM HAS CHANGED THE DATABASE
+    def clear(self):
+        with self.lock:
+            for store in (self.resident_pages, self.resident_medication, self.medication_instances,
+                          self.medication_instance_doses, self.medication_rows, self.medication_instance_rows,
+                          self.medication_resident_ids, self.medication_info_medication_ids):
+                store.clear()
+
+    # CACHED READS. THE PAGES MIRROR DatabaseManager'S KEYSET PAGES, SO A PagedListbox CAN LOAD FROM EITHER
+    def collect_resident_identifiers_page(self, after_id, limit):
+        return self.get(self.resident_pages, (after_id, limit),
+                        lambda database: database.collect_resident_identifiers_page(after_id, limit))
+
+    def collect_resident_medication_page(self, resident_id, after_id, limit):
+        resident_id = int(resident_id)
+        with self.lock:
+            self.check_data_version()
+            medication_page = self.get(
+                self.resident_medication.setdefault(resident_id, {}), (after_id, limit),
+                lambda database: database.collect_resident_medication_page(resident_id, after_id, limit))
+            for medication in medication_page:
+                self.medication_resident_ids[medication[0]] = resident_id
+            return medication_page
+
+    def collect_medication_instances_page(self, medication_id, after_id, limit):
+        medication_id = int(medication_id)
+        with self.lock:
+            self.check_data_version()
+            medication_instance_page = self.get(
+                self.medication_instances.setdefault(medication_id, {}), (after_id, limit),
+                lambda database: database.collect_medication_instances_page(medication_id, after_id, limit))
+            for medication_instance in medication_instance_page:
+                self.medication_info_medication_ids[medication_instance[0]] = medication_id
+            return medication_instance_page
+
+    def collect_medication_instance_doses(self, medication_info_id):
+        medication_info_id = int(medication_info_id)
+        return self.get(self.medication_instance_doses, medication_info_id,
+                        lambda database: database.collect_medication_instance_doses(medication_info_id))
+
+    def collect_medication_instance(self, medication_info_id):
+        medication_info_id = int(medication_info_id)
+        with self.lock:
+            medication_instance = self.get(
+                self.medication_instance_rows, medication_info_id,
+                lambda database: database.collect_medication_instance(medication_info_id))
+            if medication_instance is not None:
+                self.medication_info_medication_ids[medication_info_id] = medication_instance[6]
+            return medication_instance
+
+    def collect_quantity_and_strength(self, medication_info_id):
+        medication_instance = self.collect_medication_instance(medication_info_id)
+        return medication_instance[2], medication_instance[3]
+
+    def collect_medication(self, medication_id):
+        medication_id = int(medication_id)
+        with self.lock:
+            medication = self.get(self.medication_rows, medication_id,
+                                  lambda database: database.collect_medication(medication_id))
+            if medication is not None:
+                self.medication_resident_ids[medication_id] = medication[3]
+            return medication
+
+    def collect_medication_name(self, medication_id):
+        return [(self.collect_medication(medication_id)[1],)]
+
+    def collect_medication_notes(self, medication_id):
+        return self.collect_medication(medication_id)[4]
+
+    # WRITE-THROUGH WRITES. THE CACHE LEARNS WHAT THEY CHANGED FROM change_feed, LIKE ANY OTHER WRITE
+    def add_resident_to_database(self, first_name, last_name, dob):
+        self.write(lambda database: database.add_resident_to_database(first_name, last_name, dob))
+
+    def add_medication_to_database(self, medication_name, medication_other_name, resident_id):
+        self.write(lambda database: database.add_medication_to_database(medication_name, medication_other_name,
+                                                                        resident_id))
+
+    def add_medication_notes_to_database(self, notes_text_box, medication_id):
+        self.write(lambda database: database.add_medication_notes_to_database(notes_text_box, medication_id))
+
+    def add_medication_instance_to_database(self, instance_expiry, instance_quantity, instance_strength,
+                                            instance_medication_type, instance_medication_id, instance_supplier,
+                                            instance_measurement):
+        self.write(lambda database: database.add_medication_instance_to_database(
+            instance_expiry, instance_quantity, instance_strength, instance_medication_type, instance_medication_id,
+            instance_supplier, instance_measurement))
+
+    def add_medication_instance_dose_to_database(self, dose_amount, dose_measurement, dose_frequency, dose_regularity,
+                                                 dose_medication_info_id):
+        self.write(lambda database: database.add_medication_instance_dose_to_database(
+            dose_amount, dose_measurement, dose_frequency, dose_regularity, dose_medication_info_id))
+
+    def modify_medication_instance_quantity(self, modify_stock_field, medication_info_id):
+        self.write(lambda database: database.modify_medication_instance_quantity(modify_stock_field,
+                                                                                 medication_info_id))
+
+    def allocate_medication_fefo(self, medication_id, amount, used_by=None):
+        return self.write(lambda database: database.allocate_medication_fefo(medication_id, amount,
+                                                                             used_by=used_by))
+
+    def administer_dose(self, dose_info_id, administered_by):
+        return self.write(lambda database: database.administer_dose(dose_info_id, administered_by))
+
+    # change_feed SUBSCRIPTION, ON THE WRITING THREAD: DROP THE SUBTREES THE COMMITTED WRITES CHANGED, OR EVERYTHING
+    # WHEN A WRITE'S PARENT IS NOT KNOWN. A MEDICATION PAGE CARRIES ITS INSTANCES' STOCK ROLLUP, SO WRITES TO
+    # INSTANCES AND DOSES ALSO DROP THE PAGES OF THE RESIDENT THEY BELONG TO
+    def apply_changes(self, events):
+        with self.lock:
+            for event in events:
+                if event.entity == 'resident':
+                    self.resident_pages.clear()
+                elif event.entity == 'medication':
+                    resident_id = event.fields.get('resident_id', self.medication_resident_ids.get(event.entity_id))
+                    if resident_id is None:
+                        self.clear()
+                    else:
+                        self.invalidate_resident(resident_id)
+                        self.medication_rows.pop(event.entity_id, None)
+                elif event.entity == 'medication_info':
+                    medication_id = event.fields.get('medication_id',
+                                                     self.medication_info_medication_ids.get(event.entity_id))
+                    if medication_id is None:
+                        self.clear()
+                    else:
+                        self.invalidate_medication(medication_id)
+                        self.medication_instance_rows.pop(event.entity_id, None)
+                elif event.entity == 'dose_info':
+                    medication_info_id = event.fields.get('medication_info_id')
+                    if medication_info_id is None:
+                        self.medication_instance_doses.clear()
+                        self.resident_medication.clear()
+                    else:
+                        self.medication_instance_doses.pop(medication_info_id, None)
+                        medication_id = self.medication_info_medication_ids.get(medication_info_id)
+                        if medication_id is None:
+                            self.resident_medication.clear()
+                        else:
+                            self.invalidate_medication_stock(medication_id)
+
+    # INVALIDATION
+    def invalidate_resident(self, resident_id):
+        with self.lock:
+            self.resident_medication.pop(int(resident_id), None)
+
+    def invalidate_medication(self, medication_id):
+        with self.lock:
+            self.medication_instances.pop(int(medication_id), None)
+            self.invalidate_medication_stock(medication_id)
+
+    # ONLY A RESIDENT WHOSE PAGES ARE CACHED HAS ITS MEDICATION IN medication_resident_ids
+    def invalidate_medication_stock(self, medication_id):
+        with self.lock:
+            resident_id = self.medication_resident_ids.get(int(medication_id))
+            if resident_id is not None:
+                self.invalidate_resident(resident_id)
+
+
+medication_cache = MedicationCache()
+change_feed.subscribe(('resident', 'medication', 'medication_info', 'dose_info'), medication_cache.apply_changes)
+
+
+# REPORT TABLE LAYOUT
+# A FIXED-WIDTH TABLE FOR THE COURIER REPORTS. COURIER IS MONOSPACED, SO COLUMNS ARE SIZED IN CHARACTERS AND EACH
+# ROW IS PADDED INTO ONE LINE OF TEXT, ONE pdf.cell() PER ROW WITHOUT MEASURING ANY TEXT. ONE LAYOUT IS BUILT ONCE AND
+# SHARED BY EVERY PAGE OF EVERY REPORT
+class ReportTable:
+    def __init__(self, columns, font_size=8, row_height=5):
+        # (title, width in characters, align)
+        self.columns = columns
+        self.font_size = font_size
+        self.row_height = row_height
+
+        # A COURIER CHARACTER IS 600/1000 EM, AND FPDF MEASURES IN MILLIMETRES
+        line_length = sum(width for title, width, align in columns) + len(columns) - 1
+        self.row_width = line_length * 0.6 * font_size * 25.4 / 72
+        self.header_line = self.make_line([title for title, width, align in columns])
+
+    def make_line(self, values):
+        return ' '.join(str(value)[:width].ljust(width) if align == 'L' else str(value)[:width].rjust(width)
+                        for value, (title, width, align) in zip(values, self.columns)).rstrip()
+
+    # CREATE A DOCUMENT WITH THE TABLE'S FONT SELECTED ONCE, FOR ALL OF ITS PAGES
+    def make_pdf(self):
+        # FOR PDF, IMPORTED ONLY ONCE A REPORT IS REQUESTED
+        import fpdf
+
+        pdf = fpdf.FPDF(format='letter')
+        pdf.set_font('Courier', size=self.font_size)
+        return pdf
+
+    def add_header(self, pdf):
+        pdf.cell(self.row_width, self.row_height, self.header_line, border='B', ln=1)
+
+    # ADD ONE ROW, STARTING A NEW PAGE WITH THE HEADER REPEATED WHEN THE CURRENT PAGE IS FULL
+    def add_row(self, pdf, values):
+        if pdf.get_y() + self.row_height > pdf.page_break_trigger:
+            pdf.add_page()
+            self.add_header(pdf)
+        pdf.cell(self.row_width, self.row_height, self.make_line(values), ln=1)
+
+
+# FORMAT A QUANTITY OR STRENGTH FOR A REPORT, e.g. 28.0 -> '28', 2.5 -> '2.5'
+def format_report_number(value):
+    if isinstance(value, (int, float)):
+        return f'{value:g}'
+    return '' if value is None else str(value)
+
+
+EXPIRY_REPORT_TABLE = ReportTable((('Medication', 40, 'L'), ('Strength', 14, 'R'), ('Expiry', 12, 'R'),
+                                   ('Quantity', 10, 'R'), ('Supplier', 30, 'L')))
+
+
+# EXPIRY REPORT ENGINE, BUCKETS JOINED REPORT ROWS IN A SINGLE PASS
+class ExpiryReport:
+    def __init__(self, report_rows, today=None):
+        self.today = today or datetime.now().date()
+
+        self.expired = []
+        self.due_to_expire = []
+        self.in_date = []
+        self.no_expiry_date = []
+
+        for report_row in report_rows:
+            self.add_row(report_row)
+
+    # PLACE A (name, expiry, quantity, strength, measurement, supplier) ROW IN ITS BUCKET
+    def add_row(self, report_row):
+        try:
+            day_difference = (date.fromisoformat(report_row[1]) - self.today).days
+        except (TypeError, ValueError):
+            self.no_expiry_date.append(report_row)
+            return
+
+        if day_difference < 0:
+            self.expired.append(report_row)
+        elif day_difference <= 30:
+            self.due_to_expire.append(report_row)
+        else:
+            self.in_date.append(report_row)
+
+    # RENDER THE REPORT AS ONE PAGE PER BUCKET. A BackgroundTask, IF GIVEN, IS CHECKED FOR CANCELLATION AS IT GOES
+    def write_pdf(self, report_owner_and_time, file_path, task=None):
+        pdf = EXPIRY_REPORT_TABLE.make_pdf()
+        self.add_pages(pdf, report_owner_and_time, task)
+        pdf.output(file_path)
+        return file_path
+
+    # ADD THIS REPORT'S PAGES TO AN OPEN PDF, EACH BUCKET AS A TABLE OF name, strength, expiry, quantity AND supplier
+    def add_pages(self, pdf, report_owner_and_time, task=None):
+        def add_page(report_rows, text):
+            pdf.add_page()
+            pdf.write(5, report_owner_and_time)
+            pdf.ln()
+            pdf.write(5, text)
+            pdf.ln()
+            EXPIRY_REPORT_TABLE.add_header(pdf)
+            for row_number, (name, expiry, quantity, strength, measurement, supplier) in enumerate(report_rows):
+                if task is not None and row_number % 100 == 0:
+                    task.check_cancelled()
+                EXPIRY_REPORT_TABLE.add_row(pdf, (name, f'{format_report_number(strength)}{measurement or ""}',
+                                                  expiry or '', format_report_number(quantity), supplier or ''))
+
+        # EXPIRED ITEMS PAGE
+        add_page(self.expired, f'{len(self.expired)} Expired Items:')
+
+        # ITEMS EXPIRING WITHIN 30 DAYS PAGE
+        add_page(self.due_to_expire, f'{len(self.due_to_expire)} Items Expiring Within 30 Days:')
+
+        # ITEMS IN DATE PAGE
+        add_page(self.in_date, f'{len(self.in_date)} Items In-Date:')
+
+        # ITEMS WITHOUT AN EXPIRY DATE PAGE
+        add_page(self.no_expiry_date, f'{len(self.no_expiry_date)} Items Without an Expiry Date:')
+
+
+# BUILD THE REPORT FILE NAME STEM FOR A RESIDENT, e.g. 'Hady Tagg 1988-09-30 10-17-2026, 09-30-00'
+def make_report_owner_and_time(first_name, last_name, dob, report_time=None):
+    report_time = report_time or datetime.now()
+    return f'{first_name} {last_name} {str(dob).replace("/", "-")} {report_time.strftime("%m-%d-%Y, %H-%M-%S")}'
+
+
+# WRITE ONE RESIDENT'S EXPIRY PDF, RUN IN A WORKER PROCESS BY HomeExpiryReport.write_resident_pdfs
+def write_resident_expiry_pdf(expiry_report, report_owner_and_time, file_path):
+    expiry_report.write_pdf(report_owner_and_time, file_path)
+    return file_path
+
+
+# HOME-WIDE EXPIRY REPORT, EVERY RESIDENT'S BUCKETS FROM ONE PASS OVER THE DATABASE
+class HomeExpiryReport:
+    def __init__(self, home_report_rows, today=None, report_time=None):
+        self.today = today or datetime.now().date()
+        self.report_time = report_time or datetime.now()
+
+        # (resident_id, first_name, last_name, dob, ExpiryReport) IN RESIDENT ORDER
+        self.resident_reports = []
+
+        for home_report_row in home_report_rows:
+            if not self.resident_reports or self.resident_reports[-1][0] != home_report_row[0]:
+                self.resident_reports.append((*home_report_row[:4], ExpiryReport([], today=self.today)))
+
+            # RESIDENTS WITHOUT ANY MEDICATION INSTANCES ONLY CONTRIBUTE THEIR DETAILS
+            if home_report_row[5] is not None:
+                self.resident_reports[-1][4].add_row(home_report_row[4:])
+
+    # WRITE EVERY RESIDENT INTO ONE PDF, STARTING WITH A SUMMARY PAGE
+    def write_combined_pdf(self, file_path, task=None):
+        pdf = EXPIRY_REPORT_TABLE.make_pdf()
+
+        pdf.add_page()
+        pdf.write(5, f'Home Expiry Report {self.report_time.strftime("%m-%d-%Y, %H-%M-%S")}')
+        pdf.ln()
+        pdf.write(5, f'{"Resident":<40} {"Expired":>8} {"30 Days":>8} {"In-Date":>8} {"No Date":>8}')
+        pdf.ln()
+        for resident_id, first_name, last_name, dob, expiry_report in self.resident_reports:
+            pdf.write(5, f'{f"{first_name} {last_name} - {dob}":<40} {len(expiry_report.expired):>8} '
+                         f'{len(expiry_report.due_to_expire):>8} {len(expiry_report.in_date):>8} '
+                         f'{len(expiry_report.no_expiry_date):>8}')
+            pdf.ln()
+
+        for resident_number, (resident_id, first_name, last_name, dob, expiry_report) in enumerate(
+                self.resident_reports):
+            if task is not None:
+                task.report_progress(resident_number, len(self.resident_reports))
+            expiry_report.add_pages(pdf, make_report_owner_and_time(first_name, last_name, dob, self.report_time),
+                                    task)
+
+        pdf.output(file_path)
+        return file_path
+
+    # WRITE ONE PDF PER RESIDENT INTO directory, RENDERED IN A PROCESS POOL. CANCELLING A BackgroundTask STOPS
+    # REPORTS THAT HAVE NOT STARTED, REPORTS ALREADY WRITTEN ARE KEPT
+    def write_resident_pdfs(self, directory, max_workers=None, task=None):
+        os.makedirs(directory, exist_ok=True)
+
+        jobs = []
+        for resident_id, first_name, last_name, dob, expiry_report in self.resident_reports:
+            report_owner_and_time = make_report_owner_and_time(first_name, last_name, dob, self.report_time)
+            jobs.append((expiry_report, report_owner_and_time,
+                         os.path.join(directory, f'Expiry Report for {report_owner_and_time}.pdf')))
+
+        # FOR RENDERING RESIDENT REPORTS IN PARALLEL, IMPORTED ONLY FOR PER-RESIDENT REPORTS
+        import concurrent.futures
+
+        file_paths = []
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(write_resident_expiry_pdf, *job) for job in jobs]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    file_paths.append(future.result())
+                    if task is not None:
+                        task.report_progress(len(file_paths), len(jobs))
+                        task.check_cancelled()
+            except TaskCancelled:
+                for future in futures:
+                    future.cancel()
+                raise
+        return sorted(file_paths)
+
+
+# REMEMBERS WHICH REPORT FILE WAS WRITTEN FOR WHICH (report, resident, day, data version), SO A REPORT WHOSE DATA HAS
+# NOT CHANGED IS HANDED BACK INSTEAD OF BEING QUERIED AND RENDERED AGAIN. THE INDEX IS KEPT AS JSON BESIDE THE REPORTS,
+# AND PDFS IN THE DIRECTORY OLDER THAN max_age_days, OR BEYOND max_bytes IN TOTAL, ARE DELETED OLDEST FIRST
+class ReportCache:
+    def __init__(self, directory='Reports', max_age_days=REPORT_MAX_AGE_DAYS, max_bytes=REPORT_MAX_BYTES):
+        self.directory = directory
+        self.index_path = os.path.join(directory, 'report_cache.json')
+        self.max_age_days = max_age_days
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.entries = None
+
+    @staticmethod
+    def make_key(report_name, resident_id, report_day, data_version):
+        return f'{report_name}:{resident_id}:{report_day.isoformat()}:{data_version}'
+
+    def load_entries(self):
+        if self.entries is None:
+            try:
+                with open(self.index_path) as index_file:
+                    self.entries = json.load(index_file)
+            except (OSError, ValueError):
+                self.entries = {}
+        return self.entries
+
+    def save_entries(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.index_path, 'w') as index_file:
+            json.dump(self.entries, index_file, indent=0)
+
+    # THE FILE WRITTEN FOR THIS KEY, OR None IF THERE IS NONE OR IT HAS SINCE BEEN DELETED
+    def get(self, key):
+        with self.lock:
+            file_path = self.load_entries().get(key)
+            return file_path if file_path is not None and os.path.exists(file_path) else None
+
+    def put(self, key, file_path):
+        with self.lock:
+            self.load_entries()[key] = file_path
+            self.evict()
+            self.save_entries()
+
+    # RETURN (file_path, True) FOR A CACHED REPORT, OTHERWISE (write(), False) AFTER RECORDING THE NEW FILE
+    def get_or_write(self, report_name, resident_id, data_version, write, report_day=None, refresh=False):
+        key = self.make_key(report_name, resident_id, report_day or datetime.now().date(), data_version)
+        file_path = None if refresh else self.get(key)
+        if file_path is not None:
+            return file_path, True
+
+        file_path = write()
+        self.put(key, file_path)
+        return file_path, False
+
+    # DELETE STALE PDFS AND FORGET ENTRIES WHOSE FILES ARE GONE. THE NEWEST PDF IS ALWAYS KEPT
+    def evict(self, now=None):
+        now = now or time.time()
+        try:
+            report_files = sorted((entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                                  for entry in os.scandir(self.directory) if entry.name.lower().endswith('.pdf'))
+        except OSError:
+            report_files = []
+
+        total_bytes = sum(size for modified_time, size, file_path in report_files)
+        for modified_time, size, file_path in report_files[:-1]:
+            if now - modified_time < self.max_age_days * 86400 and total_bytes <= self.max_bytes:
+                continue
+            try:
+                os.remove(file_path)
+            except OSError:
+                continue
+            total_bytes -= size
+
+        entries = self.load_entries()
+        for key in [key for key, file_path in entries.items() if not os.path.exists(file_path)]:
+            del entries[key]
+
+
+report_cache = ReportCache()
+
+
+# DELIVERY FILE COLUMNS. THE DOSE COLUMNS MAY BE LEFT BLANK FOR ITEMS WITHOUT A DOSE
+DELIVERY_COLUMNS = ('first_name', 'last_name', 'dob', 'medication_name', 'other_name', 'expiry', 'quantity',
+                    'strength', 'form', 'supplier', 'measurement', 'dose', 'dose_measurement', 'frequency_per_day',
+                    'regularity')
+
+
+# STREAMING IMPORTER FOR PHARMACY DELIVERY (MAR) FILES IN CSV, JSON LINES OR JSON ARRAY FORM
+# ROWS ARE READ ONE AT A TIME AND WRITTEN IN TRANSACTIONS OF batch_size ROWS, SO MEMORY DOES NOT GROW WITH FILE SIZE
+class DeliveryImporter:
+    def __init__(self, database, batch_size=500, task=None):
+        self.database = database
+        self.batch_size = batch_size
+        self.task = task
+
+        self.imported_count = 0
+        # (row number, message) FOR EVERY ROW THAT WAS SKIPPED
+        self.errors = []
+
+        self.resident_ids = None
+        self.medication_ids = {}
+
+    # IMPORT A WHOLE FILE, CHOOSING THE READER FROM ITS EXTENSION
+    def import_file(self, file_path):
+        with open(file_path, newline='', encoding='utf-8-sig') as delivery_file:
+            if file_path.lower().endswith('.jsonl'):
+                self.import_rows(self.read_json_lines(delivery_file))
+            elif file_path.lower().endswith('.json'):
+                self.import_rows(self.read_json_rows(delivery_file))
+            else:
+                self.import_rows(self.read_csv_rows(delivery_file))
+        # LINES THAT ARE NOT JSON ARE RECORDED AS THEY ARE READ, AHEAD OF THEIR BATCH, SO PUT errors BACK IN ROW ORDER
+        self.errors.sort(key=lambda error: error[0])
+        return self
+
+    # YIELD (row number, row dict) FROM A CSV FILE WITH A HEADER LINE
+    @staticmethod
+    def read_csv_rows(delivery_file):
+        reader = csv.DictReader(delivery_file)
+        for row in reader:
+            yield reader.line_num, row
+
+    # YIELD (line number, row dict) FROM A JSON LINES FILE, DECODING EACH LINE ON ITS OWN SO A LINE THAT IS NOT JSON
+    # IS SKIPPED AND RECORDED IN errors LIKE ANY OTHER BAD ROW, INSTEAD OF STOPPING THE IMPORT
+    def read_json_lines(self, delivery_file):
+        for line_number, line in enumerate(delivery_file, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as error:
+                self.errors.append((line_number, f'Line is not valid JSON: {error.msg}.'))
+                continue
+            yield line_number, row
+
+    # YIELD (row number, row dict) FROM JSON LINES OR A TOP LEVEL JSON ARRAY, DECODING ONE OBJECT AT A TIME. A FILE
+    # THAT STOPS BEING JSON, e.g. ONE CUT SHORT, RECORDS THE ROW IT FAILED ON IN errors AND ENDS THE IMPORT THERE,
+    # KEEPING THE ROWS BEFORE IT
+    def read_json_rows(self, delivery_file, chunk_size=65536):
+        decoder = json.JSONDecoder()
+        buffer = ''
+        row_number = 0
+        end_of_file = False
+        while True:
+            buffer = buffer.lstrip(' \t\r\n,[]')
+            if not buffer:
+                if end_of_file:
+                    return
+                chunk = delivery_file.read(chunk_size)
+                end_of_file = not chunk
+                buffer += chunk
+                continue
+            try:
+                row, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError as error:
+                if end_of_file:
+                    self.errors.append((row_number + 1, f'Row is not valid JSON: {error.msg}.'))
+                    return
+                chunk = delivery_file.read(chunk_size)
+                end_of_file = not chunk
+                buffer += chunk
+                continue
+            row_number += 1
+            buffer = buffer[end:]
+            yield row_number, row
+
+    # IMPORT (row number, row dict) PAIRS IN BATCHED TRANSACTIONS
+    def import_rows(self, rows):
+        batch = []
+        for row_number, row in rows:
+            batch.append((row_number, row))
+            if len(batch) >= self.batch_size:
+                self.import_batch(batch)
+                batch = []
+        if batch:
+            self.import_batch(batch)
+
+    def import_batch(self, batch):
+        # A CANCELLED IMPORT STOPS BETWEEN BATCHES, KEEPING THE BATCHES ALREADY COMMITTED
+        if self.task is not None:
+            self.task.check_cancelled()
+            self.task.report_progress(self.imported_count + len(self.errors), 0)
+
+        with self.database.transaction():
+            for row_number, row in batch:
+                try:
+                    delivery_item = self.validate_row(row)
+                except ValueError as error:
+                    self.errors.append((row_number, str(error)))
+                    continue
+                self.import_item(*delivery_item)
+                self.imported_count += 1
+
+    # CHECK ONE ROW, RETURNING ITS CLEANED VALUES OR RAISING ValueError WITH A MESSAGE FOR THE USER
+    @staticmethod
+    def validate_row(row):
+        if not isinstance(row, dict):
+            raise ValueError('Row is not an object.')
+        row = {column: str(row.get(column) if row.get(column) is not None else '').strip()
+               for column in DELIVERY_COLUMNS}
+
+        for column in ('first_name', 'last_name', 'medication_name'):
+            if not row[column]:
+                raise ValueError(f'{column} is required.')
+
+        dob = to_iso_date(row['dob'], past_only=True)
+        if dob is None:
+            raise ValueError(f'dob "{row["dob"]}" is not a date.')
+
+        expiry = to_iso_date(row['expiry']) if row['expiry'] else None
+        if row['expiry'] and expiry is None:
+            raise ValueError(f'expiry "{row["expiry"]}" is not a date.')
+
+        numbers = {}
+        for column in ('quantity', 'strength', 'dose', 'frequency_per_day'):
+            try:
+                numbers[column] = float(row[column]) if row[column] else None
+            except ValueError:
+                raise ValueError(f'{column} "{row[column]}" is not a number.') from None
+            if numbers[column] is not None and not math.isfinite(numbers[column]):
+                raise ValueError(f'{column} "{row[column]}" is not a number.')
+            if numbers[column] is not None and numbers[column] < 0:
+                raise ValueError(f'{column} cannot be negative.')
+        if numbers['quantity'] is None or numbers['strength'] is None:
+            raise ValueError('quantity and strength are required.')
+
+        dose = None
+        if numbers['dose'] is not None:
+            if row['regularity'] not in ('Regular', 'PRN'):
+                raise ValueError('regularity must be Regular or PRN.')
+            dose = (numbers['dose'], row['dose_measurement'] or row['measurement'],
+                    numbers['frequency_per_day'] or 0, row['regularity'])
+
+        return ((row['first_name'], row['last_name'], dob), (row['medication_name'], row['other_name']),
+                (expiry, numbers['quantity'], numbers['strength'], row['form'], row['supplier'], row['measurement']),
+                dose)
+
+    # WRITE ONE VALIDATED ITEM, CREATING ITS RESIDENT AND MEDICATION IF THEY ARE NEW
+    def import_item(self, resident, medication, instance, dose):
+        resident_id = self.resolve_resident_id(*resident)
+        medication_id = self.resolve_medication_id(resident_id, *medication)
+
+        expiry, quantity, strength, form, supplier, measurement = instance
+        medication_info_id = self.database.add_medication_instance_to_database(
+            expiry, quantity, strength, form, medication_id, supplier, measurement)
+
+        if dose is not None:
+            self.database.add_medication_instance_dose_to_database(*dose, medication_info_id)
+
+    def resolve_resident_id(self, first_name, last_name, dob):
+        if self.resident_ids is None:
+            self.resident_ids = {}
+            for resident_id, known_first_name, known_last_name, known_dob in \
+                    self.database.collect_resident_identifiers():
+                self.resident_ids.setdefault((known_first_name, known_last_name, known_dob), resident_id)
+
+        if (first_name, last_name, dob) not in self.resident_ids:
+            self.resident_ids[(first_name, last_name, dob)] = self.database.add_resident_to_database(
+                first_name, last_name, dob)
+        return self.resident_ids[(first_name, last_name, dob)]
+
+    def resolve_medication_id(self, resident_id, medication_name, other_name):
+        if resident_id not in self.medication_ids:
+            self.medication_ids[resident_id] = {}
+            for medication in self.database.collect_resident_medication(resident_id):
+                self.medication_ids[resident_id].setdefault(medication[1].lower(), medication[0])
+
+        known_medication_ids = self.medication_ids[resident_id]
+        if medication_name.lower() not in known_medication_ids:
+            known_medication_ids[medication_name.lower()] = self.database.add_medication_to_database(
+                medication_name, other_name, resident_id)
+        return known_medication_ids[medication_name.lower()]
+
+
+# CALCULATES HOW MANY DAYS WORTH OF A MEDICATION INSTANCE REMAINS AT ONE DOSE, 'N/A' FOR PRN OR NO DAILY FREQUENCY
+def calculate_days_remaining(quantity, strength, dose, frequency_per_day, regular_or_prn):
+    if regular_or_prn != 'PRN' and frequency_per_day != 0:
+        return round((strength * quantity) / (dose * frequency_per_day), 2)
+    return 'N/A'
+
+
+# FORMAT ONE collect_instances_running_out ROW FOR DISPLAY
+def format_low_stock_alert(instance):
+    return f'{instance[1]} {instance[2]} - {instance[4]} (Expiry: {instance[6]}, Quantity: {instance[7]}) - ' \
+           f'Days Remaining: {round(instance[9], 2)}'
+
+
+# ONE ROW OF collect_instances_expiring_between AS A LINE OF THE EXPIRY TRIAGE LIST
+def format_expiring_instance(instance):
+    return f'{instance[4]} - Resident {instance[0]} - {instance[2]} (Medication {instance[1]}) - ' \
+           f'Instance {instance[3]}, Quantity: {instance[5]}'
+
+
+# FORECASTS WHEN EVERY INSTANCE IN THE HOME RUNS OUT IN ONE PASS OVER COLUMN ARRAYS, FROM collect_forecast_rows
+# AN INSTANCE'S DAILY USAGE IS THE SUM OF ALL OF ITS REGULAR DOSES, IT RUNS OUT WHEN THAT USES UP ITS QUANTITY OR ON
+# ITS EXPIRY, WHICHEVER IS SOONER, AND IT IS DUE FOR REORDERING lead_days BEFORE IT RUNS OUT. USED-UP AND EXPIRED
+# INSTANCES ARE LEFT OUT. INSTANCES WITHOUT REGULAR DOSES OR AN EXPIRY NEVER RUN OUT, SO THEIR DATES ARE NaT AND THEY
+# ARE NEVER REORDERED
+class StockForecast:
+    def __init__(self, instance_rows, dose_rows, lead_days=REORDER_LEAD_DAYS, today=None):
+        # FOR VECTORISED FORECASTING, IMPORTED ONLY ONCE A FORECAST IS REQUESTED
+        import numpy
+
+        instance_rows = list(instance_rows)
+        instances = numpy.fromiter(itertools.chain.from_iterable(instance_row[:3] for instance_row in instance_rows),
+                                   dtype=float).reshape(-1, 3)
+        expiries = numpy.array([instance_row[3] for instance_row in instance_rows], dtype='datetime64[D]')
+        self.today = numpy.datetime64(today or date.today(), 'D')
+        # NaT NEVER COMPARES AS BEFORE today, SO INSTANCES WITHOUT AN EXPIRY ARE KEPT
+        kept = (instances[:, 1] > 0) & ~(expiries < self.today)
+        instances, expiries = instances[kept], expiries[kept]
+        order = numpy.argsort(instances[:, 0], kind='stable')
+        instances, expiries = instances[order], expiries[order]
+        doses = numpy.fromiter(itertools.chain.from_iterable(dose_rows), dtype=float).reshape(-1, 3)
+        self.medication_info_ids = instances[:, 0].astype(numpy.int64)
+
+        # FIND EACH DOSE'S INSTANCE ROW BY BINARY SEARCH, DROPPING DOSES WHOSE INSTANCE IS NOT IN instance_rows
+        dose_medication_info_ids = doses[:, 0].astype(numpy.int64)
+        dose_indexes = numpy.zeros(len(doses), dtype=numpy.int64)
+        matched = numpy.zeros(len(doses), dtype=bool)
+        if len(self.medication_info_ids):
+            dose_indexes = numpy.minimum(numpy.searchsorted(self.medication_info_ids, dose_medication_info_ids),
+                                         len(self.medication_info_ids) - 1)
+            matched = self.medication_info_ids[dose_indexes] == dose_medication_info_ids
+
+        self.daily_usage = numpy.bincount(dose_indexes[matched], weights=doses[matched, 1] * doses[matched, 2],
+                                          minlength=len(self.medication_info_ids))
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            self.days_remaining = numpy.where(self.daily_usage > 0,
+                                              numpy.maximum(instances[:, 1] * instances[:, 2], 0) / self.daily_usage,
+                                              numpy.inf)
+
+        running_out = numpy.isfinite(self.days_remaining)
+        whole_days = numpy.floor(numpy.where(running_out, self.days_remaining, 0)).astype(numpy.int64)
+        self.runs_out = self.today + whole_days.astype('timedelta64[D]')
+        self.runs_out[~running_out] = numpy.datetime64('NaT')
+        # fmin SKIPS NaT, SO AN INSTANCE RUNS OUT ON WHICHEVER OF ITS TWO DATES IT HAS THAT COMES FIRST
+        self.runs_out = numpy.fmin(self.runs_out, expiries)
+        has_expiry = ~numpy.isnat(expiries)
+        self.days_remaining[has_expiry] = numpy.minimum(
+            self.days_remaining[has_expiry], (expiries[has_expiry] - self.today).astype(numpy.int64))
+        self.reorder_on = self.runs_out - numpy.timedelta64(lead_days, 'D')
+
+    # INSTANCES DUE FOR REORDERING WITHIN within_DAYS OF TODAY, OVERDUE ONES INCLUDED, SOONEST TO RUN OUT FIRST, AS
+    # (medication_info_id, daily_usage, days_remaining, runs_out, reorder_on) WITH THE DATES AS datetime.date
+    def reorder_list(self, within_days=0):
+        import numpy
+
+        due_indexes = numpy.flatnonzero(self.reorder_on <= self.today + numpy.timedelta64(int(within_days), 'D'))
+        due_indexes = due_indexes[numpy.argsort(self.runs_out[due_indexes], kind='stable')]
+        return list(zip(self.medication_info_ids[due_indexes].tolist(), self.daily_usage[due_indexes].tolist(),
+                        self.days_remaining[due_indexes].tolist(), self.runs_out[due_indexes].tolist(),
+                        self.reorder_on[due_indexes].tolist()))
+
+
+# FORMAT ONE reorder_list ROW FOR DISPLAY WITH ITS collect_instance_descriptions DESCRIPTION
+def format_reorder_row(reorder_row, description):
+    medication_info_id, daily_usage, days_remaining, runs_out, reorder_on = reorder_row
+    return f'Reorder by {reorder_on}: {description[1]} {description[2]} - {description[3]} ' \
+           f'(Expiry: {description[4]}, Quantity: {description[5]}) - Runs Out: {runs_out} ' \
+           f'({round(days_remaining, 2)} days)'
+
+
+# RAISED INSIDE BACKGROUND WORK ONCE ITS TASK HAS BEEN CANCELLED
+class TaskCancelled(Exception):
+    pass
+
+
+# ONE PIECE OF WORK HANDED TO TaskRunner. THE WORK FUNCTION RECEIVES IT TO REPORT PROGRESS AND CHECK FOR CANCELLING
+class BackgroundTask:
+    def __init__(self, key=None):
+        self.key = key
+        self.cancel_event = threading.Event()
+        # (done, total), A total OF 0 MEANS THE AMOUNT OF WORK IS UNKNOWN
+        self.progress = (0, 0)
+        self.future = None
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise TaskCancelled()
+
+    def report_progress(self, done, total):
+        self.progress = (done, total)
+
+
+# RUNS DATABASE AND REPORT WORK ON WORKER THREADS SO THE TK LOOP NEVER BLOCKS, AND HANDS RESULTS BACK TO THE TK
+# THREAD BY POLLING WITH after(). WORK MUST OPEN ITS OWN DatabaseManager(), THE POOL GIVES EACH THREAD A CONNECTION
+class TaskRunner:
+    def __init__(self, max_workers=2, poll_milliseconds=50):
+        self.max_workers = max_workers
+        self.poll_milliseconds = poll_milliseconds
+        self.executor = None
+        self.latest_tasks = {}
+
+    # RUN work(task) IN THE BACKGROUND, THEN on_success(result) OR on_error(exception) ON THE TK THREAD
+    # progress_title SHOWS A ProgressWindow WITH A CANCEL BUTTON, AND A NEWER TASK WITH THE SAME key SUPERSEDES AN
+    # OLDER ONE, WHOSE RESULT IS THEN DISCARDED
+    def run(self, window, work, on_success=None, on_error=None, progress_title=None, key=None):
+        if self.executor is None:
+            # FOR WORKER THREADS, IMPORTED ONLY ONCE THE FIRST TASK RUNS
+            import concurrent.futures
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers,
+                                                                  thread_name_prefix='nurse_aid_worker')
+
+        task = BackgroundTask(key)
+        if key is not None:
+            if key in self.latest_tasks:
+                self.latest_tasks[key].cancel()
+            self.latest_tasks[key] = task
+
+        progress_window = None
+        if progress_title is not None:
+            progress_window = ProgressWindow(master=window, title=progress_title, geometry='300x100',
+                                             previous_window=window, task=task)
+            progress_window.center_window(x=300, y=100)
+
+        task.future = self.executor.submit(work, task)
+        window.after(self.poll_milliseconds, self.poll, window, task, on_success, on_error, progress_window)
+        return task
+
+    def poll(self, window, task, on_success, on_error, progress_window):
+        if not task.future.done():
+            if progress_window is not None:
+                progress_window.show_progress()
+            window.after(self.poll_milliseconds, self.poll, window, task, on_success, on_error, progress_window)
+            return
+
+        if progress_window is not None:
+            progress_window.close()
+
+        superseded = task.key is not None and self.latest_tasks.get(task.key) is not task
+        if task.key is not None and not superseded:
+            del self.latest_tasks[task.key]
+        if superseded or not window.winfo_exists():
+            return
+
+        error = task.future.exception()
+        if isinstance(error, TaskCancelled):
+            WindowManager.make_message_box(title='Cancelled', message='The task was cancelled.', icon='info')
+        elif error is not None:
+            if on_error is not None:
+                on_error(error)
+            else:
+                WindowManager.make_message_box(title='Error', message=str(error), icon='error')
+        elif on_success is not None:
+            on_success(task.future.result())
+
+    # STOP ACCEPTING WORK AND CANCEL ANYTHING STILL RUNNING
+    def shutdown(self):
+        for task in self.latest_tasks.values():
+            task.cancel()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+
+task_runner = TaskRunner()
+
+
+# A LISTBOX WHOSE ROWS EACH STAND FOR ONE DATABASE ROW. keys HOLDS EVERY ROW'S PRIMARY KEY IN ROW ORDER AND
+# key_indexes MAPS IT BACK, SO SELECTIONS ARE READ AND RESTORED BY ID RATHER THAN BY ROW NUMBER
+class KeyedListbox(tk.Listbox):
+    def __init__(self, master, **options):
+        super().__init__(master, **options)
+        self.keys = array.array('q')
+        self.key_indexes = {}
+
+    # THE ID OF THE SELECTED ROW, OR None WHEN NOTHING IS SELECTED
+    def selected_key(self):
+        selected_indexes = self.curselection()
+        return self.keys[selected_indexes[0]] if selected_indexes else None
+
+    def append_rows(self, keyed_texts):
+        if keyed_texts:
+            self.insert(tk.END, *(text for key, text in keyed_texts))
+            for key, text in keyed_texts:
+                self.key_indexes[key] = len(self.keys)
+                self.keys.append(key)
+
+    # REWRITE ONE ROW'S TEXT IF IT CHANGED, KEEPING IT SELECTED IF IT WAS
+    def update_row(self, index, text):
+        if self.get(index) != text:
+            selected = self.selection_includes(index)
+            self.delete(index)
+            self.insert(index, text)
+            if selected:
+                self.selection_set(index)
+
+    # MAKE THE LISTBOX SHOW keyed_TEXTS, A LIST OF (key, text), REWRITING ONLY THE ROWS THAT DIFFER AND KEEPING THE
+    # SAME IDS SELECTED
+    def replace_rows(self, keyed_texts):
+        selected_keys = {self.keys[index] for index in self.curselection()}
+
+        for index, (key, text) in enumerate(keyed_texts):
+            if index >= len(self.keys):
+                self.insert(tk.END, text)
+                self.keys.append(key)
+            elif self.keys[index] != key or self.get(index) != text:
+                self.delete(index)
+                self.insert(index, text)
+                self.keys[index] = key
+        if len(keyed_texts) < len(self.keys):
+            self.delete(len(keyed_texts), tk.END)
+            del self.keys[len(keyed_texts):]
+
+        self.key_indexes = {key: index for index, key in enumerate(self.keys)}
+        self.selection_clear(0, tk.END)
+        for key in selected_keys:
+            if key in self.key_indexes:
+                self.selection_set(self.key_indexes[key])
+
+    def clear(self):
+        self.delete(first=0, last=tk.END)
+        del self.keys[:]
+        self.key_indexes = {}
+
+
+# A KeyedListbox THAT LOADS ITS ROWS A PAGE AT A TIME AS IT IS SCROLLED, KEYSET PAGED ON EACH ROW'S ID, AND THAT ONLY
+# REWRITES THE ROWS THAT CHANGED WHEN IT IS REFRESHED
+class PagedListbox(KeyedListbox):
+    def __init__(self, master, format_row, page_size=100, **options):
+        super().__init__(master, **options)
+        self.format_row = format_row
+        self.page_size = page_size
+        self.query_key = None
+        self.load_page = None
+        self.exhausted = True
+        self.page_pending = False
+        self.configure(yscrollcommand=self.view_changed)
+
+    # SHOW THE ROWS RETURNED BY load_page(after_id, limit). SHOWING THE SAME query_key AGAIN REFRESHES IN PLACE
+    def show(self, query_key, load_page):
+        self.load_page = load_page
+        if query_key == self.query_key:
+            self.refresh()
+            return
+
+        KeyedListbox.clear(self)
+        self.query_key = query_key
+        self.exhausted = False
+        self.load_next_page()
+
+    # EMPTY THE LISTBOX UNTIL THE NEXT show()
+    def clear(self):
+        super().clear()
+        self.query_key = None
+        self.load_page = None
+        self.exhausted = True
+
+    def load_next_page(self):
+        self.page_pending = False
+        if self.exhausted or self.load_page is None:
+            return
+
+        rows = self.load_page(self.keys[-1] if self.keys else None, self.page_size)
+        self.exhausted = len(rows) < self.page_size
+        first_index = len(self.keys)
+        self.append_rows([(row[0], self.format_row(first_index + i, row)) for i, row in enumerate(rows)])
+
+    # RE-READ EVERY LOADED ROW IN ONE QUERY AND APPLY ONLY THE DIFFERENCES
+    def refresh(self):
+        limit = max(len(self.keys), self.page_size)
+        rows = self.load_page(None, limit)
+        self.exhausted = len(rows) < limit
+        self.replace_rows([(row[0], self.format_row(i, row)) for i, row in enumerate(rows)])
+
+    # PATCH IN ROWS A WRITE CHANGED, e.g. FROM change_feed: LOADED ROWS WITH THE SAME IDS ARE REWRITTEN IN PLACE, AND
+    # ROWS WITH IDS AFTER EVERY LOADED ROW ARE APPENDED ONCE THE LAST PAGE IS LOADED. ANY OTHERS LOAD AS THEY SCROLL IN
+    # THE CALLER PASSES ONLY ROWS THAT BELONG TO THE CURRENT QUERY
+    def patch_rows(self, rows):
+        for row in rows:
+            index = self.key_indexes.get(row[0])
+            if index is not None:
+                self.update_row(index, self.format_row(index, row))
+            elif self.exhausted and self.load_page is not None and (not self.keys or row[0] > self.keys[-1]):
+                self.append_rows([(row[0], self.format_row(len(self.keys), row))])
+
+    # yscrollcommand: FETCH THE NEXT PAGE ONCE THE VIEW NEARS THE LAST LOADED ROW
+    def view_changed(self, first, last):
+        if not self.exhausted and not self.page_pending and float(last) > 0.9:
+            self.page_pending = True
+            self.after_idle(self.load_next_page)
 
 
 # PARENT CLASS FOR WINDOW CREATION AND MANAGEMENT
@@ -192,6 +2362,8 @@ class WindowManager:
         self.window.resizable(False, False)
         self.window.protocol('WM_DELETE_WINDOW', self.on_exit)
         self.previous_window = previous_window
+        self.database = DatabaseManager()
+        self.medication_cache = medication_cache
 
     # ON WINDOW EXIT
     def on_exit(self):
@@ -215,10 +2387,17 @@ class WindowManager:
         button.pack(padx=pad_x, pady=pad_y, side=side)
         return button
 
-    # CREATE A LISTBOX
+    # CREATE A LISTBOX, SEE KeyedListbox
     def make_listbox(self, height, width, pad_x, pad_y, side):
-        listbox = tk.Listbox(master=self.window, width=width, height=height, exportselection=False,
-                             highlightcolor='blue', highlightthickness=2, bd=4)
+        listbox = KeyedListbox(master=self.window, width=width, height=height, exportselection=False,
+                               highlightcolor='blue', highlightthickness=2, bd=4)
+        listbox.pack(padx=pad_x, pady=pad_y, side=side)
+        return listbox
+
+    # CREATE A LISTBOX THAT LOADS ITS ROWS A PAGE AT A TIME, SEE PagedListbox
+    def make_paged_listbox(self, height, width, pad_x, pad_y, side, format_row):
+        listbox = PagedListbox(master=self.window, format_row=format_row, width=width, height=height,
+                               exportselection=False, highlightcolor='blue', highlightthickness=2, bd=4)
         listbox.pack(padx=pad_x, pady=pad_y, side=side)
         return listbox
 
@@ -236,6 +2415,9 @@ class WindowManager:
 
     # CREATE A DATE PICKER
     def make_date_picker(self, start_year):
+        # FOR DATE PICKER, IMPORTED ONLY BY WINDOWS THAT SHOW ONE
+        import tkcalendar
+
         date_picker = tkcalendar.Calendar(master=self.window, selectmode='day', year=start_year)
         date_picker.pack()
         return date_picker
@@ -264,6 +2446,16 @@ class WindowManager:
     def make_message_box(title, message, icon):
         tk.messagebox.showinfo(title=title, message=message, icon=icon)
 
+    # TELL THE USER WHERE A REPORT FROM ReportCache.get_or_write IS, AND WHETHER IT WAS ALREADY UP TO DATE
+    @staticmethod
+    def show_report_result(report_title, file_path, from_cache):
+        if from_cache:
+            WindowManager.make_message_box(
+                title='Up To Date', message=f'Nothing has changed since this {report_title} was created today:\n'
+                                            f'{os.path.basename(file_path.strip())}', icon='info')
+        else:
+            WindowManager.make_message_box(title='Success', message=f'{report_title} Created.', icon='info')
+
 
 # CHILD WINDOWS OF WindowManager
 class PrimaryWindow(WindowManager):
@@ -274,12 +2466,137 @@ class PrimaryWindow(WindowManager):
         WindowManager.make_button(self, text='Residents', command=self.show_resident_selection_window, state='active',
                                   pad_x=0, pad_y=20, side=tk.TOP)
 
+        WindowManager.make_button(self, text='Home Expiry Report', command=self.create_home_expiry_pdf_report,
+                                  state='active', pad_x=0, pad_y=5, side=tk.TOP)
+
+        WindowManager.make_button(self, text='Per-Resident Expiry Reports',
+                                  command=self.create_resident_expiry_pdf_reports, state='active', pad_x=0, pad_y=5,
+                                  side=tk.TOP)
+
+        WindowManager.make_button(self, text='Import Delivery', command=self.import_delivery, state='active',
+                                  pad_x=0, pad_y=5, side=tk.TOP)
+
+        WindowManager.make_button(self, text='Low Stock Alert', command=self.show_low_stock_alert, state='active',
+                                  pad_x=0, pad_y=5, side=tk.TOP)
+
     # BUTTON COMMANDS
     def show_resident_selection_window(self):
         self.window.withdraw()
         resident_selection_window = ResidentSelectionWindow(master=self.window, title='Resident Selection',
-                                                            geometry='275x400', previous_window=self.window)
-        resident_selection_window.center_window(x=275, y=400)
+                                                            geometry='275x425', previous_window=self.window)
+        resident_selection_window.center_window(x=275, y=425)
+
+    # CREATE ONE EXPIRY REPORT COVERING EVERY RESIDENT
+    def create_home_expiry_pdf_report(self):
+        def work(task):
+            database = DatabaseManager()
+            os.makedirs('Reports', exist_ok=True)
+            return report_cache.get_or_write(
+                'home', None, database.collect_data_version(),
+                lambda: HomeExpiryReport(database.stream_home_expiry_report_rows()).write_combined_pdf(
+                    f'Reports/Home Expiry Report {datetime.now().strftime("%m-%d-%Y, %H-%M-%S")}.pdf', task))
+
+        task_runner.run(self.window, work, progress_title='Creating Home Expiry Report',
+                        on_success=lambda result: WindowManager.show_report_result('Home Expiry Report', *result))
+
+    # CREATE A SEPARATE EXPIRY REPORT FOR EVERY RESIDENT
+    def create_resident_expiry_pdf_reports(self):
+        def work(task):
+            home_expiry_report = HomeExpiryReport(DatabaseManager().stream_home_expiry_report_rows())
+            return home_expiry_report.write_resident_pdfs('Reports', task=task)
+
+        task_runner.run(self.window, work, progress_title='Creating Expiry Reports',
+                        on_success=lambda file_paths: WindowManager.make_message_box(
+                            title='Success', message=f'{len(file_paths)} Expiry Reports Created.', icon='info'))
+
+    # LIST EVERY INSTANCE IN THE HOME WITH LESS THAN LOW_STOCK_ALERT_DAYS OF REGULAR DOSES LEFT
+    def show_low_stock_alert(self):
+        task_runner.run(self.window, lambda task: DatabaseManager().collect_instances_running_out(LOW_STOCK_ALERT_DAYS),
+                        on_success=self.show_running_out, key='low_stock_alert')
+
+    def show_running_out(self, running_out):
+        if running_out:
+            message = '\n'.join(format_low_stock_alert(instance) for instance in running_out[:20])
+            if len(running_out) > 20:
+                message += f'\n...and {len(running_out) - 20} more.'
+            WindowManager.make_message_box(
+                title=f'{len(running_out)} Items With Under {LOW_STOCK_ALERT_DAYS} Days Remaining', message=message,
+                icon='warning')
+        else:
+            WindowManager.make_message_box(
+                title='Low Stock Alert', message=f'No items have under {LOW_STOCK_ALERT_DAYS} days remaining.',
+                icon='info')
+
+    # IMPORT A PHARMACY DELIVERY FILE
+    def import_delivery(self):
+        # FOR CHOOSING THE DELIVERY FILE, IMPORTED ONLY WHEN IMPORTING
+        import tkinter.filedialog
+
+        file_path = tkinter.filedialog.askopenfilename(
+            parent=self.window, title='Select Delivery File',
+            filetypes=[('Delivery Files', '*.csv *.json *.jsonl'), ('All Files', '*.*')])
+        if not file_path:
+            return
+
+        def work(task):
+            try:
+                return DeliveryImporter(DatabaseManager(), task=task).import_file(file_path)
+            finally:
+                # A CANCELLED IMPORT STILL KEEPS ITS COMMITTED BATCHES
+                self.medication_cache.clear()
+
+        task_runner.run(self.window, work, on_success=self.show_import_result, progress_title='Importing Delivery')
+
+    def show_import_result(self, delivery_importer):
+        message = f'{delivery_importer.imported_count} items imported, {len(delivery_importer.errors)} rows skipped.'
+        for row_number, error in delivery_importer.errors[:10]:
+            message += f'\nRow {row_number}: {error}'
+        WindowManager.make_message_box(title='Import Complete', message=message,
+                                       icon='warning' if delivery_importer.errors else 'info')
+
+
+# SHOWS A RUNNING BackgroundTask'S PROGRESS WITH A BUTTON TO CANCEL IT
+class ProgressWindow(WindowManager):
+    def __init__(self, master, title, geometry, previous_window, task):
+        super().__init__(master, title, geometry, previous_window)
+        self.task = task
+        self.window.transient(previous_window)
+
+        # WIDGETS
+        self.progress_label = WindowManager.make_label(self, text='Working...', pad_x=0, pad_y=5)
+
+        self.progress_bar = tkinter.ttk.Progressbar(master=self.window, orient='horizontal', length=250,
+                                                    mode='indeterminate')
+        self.progress_bar.pack()
+        self.progress_bar.start()
+
+        self.cancel_button = WindowManager.make_button(self, text='Cancel', command=self.on_exit, state='active',
+                                                       pad_x=0, pad_y=5, side=tk.TOP)
+
+    # CLOSING THE WINDOW CANCELS THE TASK, THE WINDOW STAYS UNTIL THE WORK NOTICES AND STOPS
+    def on_exit(self):
+        self.task.cancel()
+        self.progress_label.configure(text='Cancelling...')
+        self.cancel_button.configure(state='disabled')
+
+    # SWITCH TO A DETERMINATE BAR ONCE THE WORK KNOWS ITS TOTAL
+    def show_progress(self):
+        done, total = self.task.progress
+        if self.task.cancelled() or not self.window.winfo_exists():
+            return
+        if total:
+            if str(self.progress_bar.cget('mode')) != 'determinate':
+                self.progress_bar.stop()
+                self.progress_bar.configure(mode='determinate', maximum=total)
+            self.progress_bar.configure(value=done)
+            self.progress_label.configure(text=f'{done} of {total}')
+        elif done:
+            self.progress_label.configure(text=f'{done} done')
+
+    def close(self):
+        if self.window.winfo_exists():
+            self.progress_bar.stop()
+            self.window.destroy()
 
 
 class ResidentSelectionWindow(WindowManager):
@@ -287,10 +2604,13 @@ class ResidentSelectionWindow(WindowManager):
         super().__init__(master, title, geometry, previous_window)
 
         # WIDGETS
-        # LIST BOXES AND BUTTONS
-        self.resident_selection_listbox = WindowManager.make_listbox(self, width=95, height=19, pad_x=0, pad_y=0,
-                                                                     side=tk.TOP)
+        # SEARCH FIELD, LIST BOXES AND BUTTONS
+        self.resident_search_field = WindowManager.make_entry_field(self)
+
+        self.resident_selection_listbox = WindowManager.make_paged_listbox(
+            self, width=95, height=19, pad_x=0, pad_y=0, side=tk.TOP, format_row=self.format_resident_row)
         self.populate_resident_listbox()
+        change_feed.subscribe_window(self, ('resident',), self.residents_changed)
 
         self.view_medications_button = WindowManager.make_button(self, text='View Medications',
                                                                  command=self.show_medication_window, state='active',
@@ -301,16 +2621,29 @@ class ResidentSelectionWindow(WindowManager):
                                                              pad_x=0, pad_y=5, side=tk.TOP)
         # BINDINGS
         self.resident_selection_listbox.bind('<<ListboxSelect>>', self.resident_listbox_selected)
+        self.resident_search_field.bind('<KeyRelease>', self.resident_search_changed)
 
     # EVENT HANDLERS
     def resident_listbox_selected(self, event):
-        print(event)
+        instrumentation.record_event(event)
         self.resident_selection()
 
+    # THE SELECTED RESIDENT'S (id, details), RAISES IndexError WHEN NO RESIDENT IS SELECTED
     def resident_selection(self):
-        selected_resident_id = self.resident_selection_listbox.curselection()[0] + 1
-        selected_resident_details = self.resident_selection_listbox.get(selected_resident_id - 1)
-        return selected_resident_id, selected_resident_details
+        selected_index = self.resident_selection_listbox.curselection()[0]
+        return self.resident_selection_listbox.keys[selected_index], self.resident_selection_listbox.get(selected_index)
+
+    def resident_search_changed(self, event):
+        self.populate_resident_listbox()
+
+    # change_feed: PATCH THE CHANGED RESIDENTS' ROWS. A SEARCH IS RE-RUN INSTEAD, AS THEY MAY NOW MATCH IT OR NOT
+    def residents_changed(self, events):
+        if make_search_query(self.resident_search_field.get()) is not None or \
+                any(event.entity_id is None for event in events):
+            self.populate_resident_listbox()
+            return
+        residents = [self.database.collect_resident(event.entity_id) for event in events]
+        self.resident_selection_listbox.patch_rows(resident for resident in residents if resident is not None)
 
     # BUTTON COMMANDS
     def show_medication_window(self):
@@ -319,9 +2652,9 @@ class ResidentSelectionWindow(WindowManager):
             self.window.withdraw()
 
             resident_medication_window = ResidentMedicationWindow(
-                master=self.window, title=f'Medication List For {self.resident_selection()[1]}', geometry='1350x700',
+                master=self.window, title=f'Medication List For {self.resident_selection()[1]}', geometry='1350x725',
                 previous_window=self.window, resident_selection_window=self)
-            resident_medication_window.center_window(x=1350, y=700)
+            resident_medication_window.center_window(x=1350, y=725)
 
         except IndexError:
             WindowManager.make_message_box(title='Error', message='Please select a resident before trying to view '
@@ -333,15 +2666,24 @@ class ResidentSelectionWindow(WindowManager):
                                                 previous_window=self.window, resident_selection_window=self)
         add_resident_window.center_window(x=600, y=400)
 
-    # RESIDENT SELECTION LIST BOX POPULATION
+    # RESIDENT SELECTION LIST BOX POPULATION, PAGED THROUGH medication_cache AND FILTERED BY THE SEARCH FIELD, WHOSE
+    # RESULTS ARE READ STRAIGHT FROM THE DATABASE
     def populate_resident_listbox(self):
-        self.resident_selection_listbox.delete(first=0, last=tk.END)
-        for i, resident in enumerate(DatabaseManager().collect_resident_identifiers()):
-            # resident_id = resident[0]
-            resident_first_name = resident[1]
-            resident_last_name = resident[2]
-            resident_dob = resident[3]
-            self.resident_selection_listbox.insert(i, f"{resident_first_name} {resident_last_name} - {resident_dob}")
+        search_text = self.resident_search_field.get()
+        if make_search_query(search_text) is None:
+            self.resident_selection_listbox.show('resident', self.medication_cache.collect_resident_identifiers_page)
+        else:
+            self.resident_selection_listbox.show(
+                ('resident_search', search_text),
+                lambda after_id, limit: self.database.search_residents_page(search_text, after_id, limit))
+
+    @staticmethod
+    def format_resident_row(i, resident):
+        # resident_id = resident[0]
+        resident_first_name = resident[1]
+        resident_last_name = resident[2]
+        resident_dob = resident[3]
+        return f"{resident_first_name} {resident_last_name} - {resident_dob}"
 
 
 class AddResidentWindow(WindowManager):
@@ -366,15 +2708,13 @@ class AddResidentWindow(WindowManager):
     # BUTTON COMMANDS
     def add_resident_to_database(self):
         if self.first_name_field.get().isalpha() and self.last_name_field.get().isalpha():
-            DatabaseManager.add_resident_to_database(self=DatabaseManager(), first_name=self.first_name_field.get(),
-                                                     last_name=self.last_name_field.get(),
-                                                     dob=self.dob_date_picker.get_date())
+            self.medication_cache.add_resident_to_database(first_name=self.first_name_field.get(),
+                                                           last_name=self.last_name_field.get(),
+                                                           dob=self.dob_date_picker.selection_get())
 
             self.window.destroy()
             self.previous_window.deiconify()
 
-            ResidentSelectionWindow.populate_resident_listbox(self=self.resident_selection_window)
-
             WindowManager.make_message_box(title='Success', message='Resident added to database.', icon='info')
 
         else:
@@ -391,16 +2731,12 @@ class ResidentMedicationWindow(WindowManager):
         self.resident_selection_details = ResidentSelectionWindow.resident_selection(
             self.resident_selection_window)[1]
 
-        self.medication_ids = []
         self.selected_medication_id = ''
-
-        self.medication_info_ids = []
         self.selected_medication_info_id = ''
 
         self.last_selected_medication_name = ''
         self.last_selected_medication_id = ''
         self.last_selected_medication_info_id = ''
-        self.last_selected_medication_instance_index = ''
 
         self.medication_notes_window_open = False
 
@@ -408,12 +2744,15 @@ class ResidentMedicationWindow(WindowManager):
         # LABELS AND LIST BOXES
         WindowManager.make_label(self, text=self.resident_selection_details, pad_x=0, pad_y=5)
 
-        self.medication_selection_listbox = WindowManager.make_listbox(self, width=95, height=20, pad_x=0, pad_y=5,
-                                                                       side=tk.TOP)
+        self.medication_search_field = WindowManager.make_entry_field(self)
+
+        self.medication_selection_listbox = WindowManager.make_paged_listbox(
+            self, width=95, height=20, pad_x=0, pad_y=5, side=tk.TOP, format_row=self.format_medication_row)
         self.populate_medication_listbox()
+        change_feed.subscribe_window(self, ('medication', 'medication_info', 'dose_info'), self.records_changed)
 
-        self.medication_instance_selection_listbox = WindowManager.make_listbox(self, width=95, height=20, pad_x=0,
-                                                                                pad_y=0, side=tk.LEFT)
+        self.medication_instance_selection_listbox = WindowManager.make_paged_listbox(
+            self, width=95, height=20, pad_x=0, pad_y=0, side=tk.LEFT, format_row=self.format_medication_instance_row)
 
         self.medication_instance_dose_selection_listbox = WindowManager.make_listbox(self, width=95, height=20, pad_x=0,
                                                                                      pad_y=0, side=tk.RIGHT)
@@ -438,6 +2777,13 @@ class ResidentMedicationWindow(WindowManager):
             self, text='Modify Instance Stock', command=self.modify_instance_stock_level, pad_y=5, pad_x=0,
             state='active', side=tk.TOP)
         self.modify_medication_instance_stock_field = WindowManager.make_entry_field(self)
+        self.use_medication_stock_button = WindowManager.make_button(
+            self, text='Use Stock, Earliest Expiry First', command=self.use_medication_stock, pad_y=5, pad_x=0,
+            state='active', side=tk.TOP)
+
+        self.administer_dose_button = WindowManager.make_button(
+            self, text='Administer Selected Dose', command=self.administer_selected_dose, pad_y=5, pad_x=0,
+            state='active', side=tk.TOP)
 
         self.lookup_medication_button = WindowManager.make_button(
             self, text='Lookup Medication', command=self.lookup_medication, pad_y=5, pad_x=0, state='active',
@@ -450,45 +2796,52 @@ class ResidentMedicationWindow(WindowManager):
         # BINDINGS
         self.medication_selection_listbox.bind('<<ListboxSelect>>', self.medication_listbox_selected)
         self.medication_instance_selection_listbox.bind('<<ListboxSelect>>', self.medication_instances_listbox_selected)
+        self.medication_search_field.bind('<KeyRelease>', self.medication_search_changed)
         self.medication_selection_listbox.bind('<FocusOut>', self.clear_selected_medication_id)
         self.medication_instance_selection_listbox.bind('<FocusOut>', self.clear_selected_medication_info_id)
 
     # EVENT HANDLERS
     # MEDICATION LISTBOX EVENTS
     def medication_listbox_selected(self, event):
-        print(event)
+        instrumentation.record_event(event)
         self.medication_selection()
 
     def medication_selection(self):
-        self.selected_medication_id = self.medication_ids[self.medication_selection_listbox.curselection()[0]]
+        self.selected_medication_id = self.medication_selection_listbox.selected_key()
+        if self.selected_medication_id is None:
+            self.selected_medication_id = ''
+            return
 
-        self.last_selected_medication_id = copy.copy(self.selected_medication_id)
+        self.last_selected_medication_id = self.selected_medication_id
         self.get_last_selected_medication_name()
 
         self.populate_medication_instance_listbox()
-        self.medication_instance_dose_selection_listbox.delete(0, tk.END)
+        self.medication_instance_dose_selection_listbox.clear()
+
+    def medication_search_changed(self, event):
+        self.populate_medication_listbox()
 
     def clear_selected_medication_id(self, event):
-        print(event)
+        instrumentation.record_event(event)
         self.selected_medication_id = ''
 
     # MEDICATION INSTANCES LISTBOX EVENTS
     def medication_instances_listbox_selected(self, event):
-        print(event)
+        instrumentation.record_event(event)
         self.medication_instance_selection()
 
     def medication_instance_selection(self):
-        self.last_selected_medication_instance_index = self.medication_instance_selection_listbox.curselection()[0]
-
-        self.selected_medication_info_id = self.medication_info_ids[
-            self.medication_instance_selection_listbox.curselection()[0]]
+        self.selected_medication_info_id = self.medication_instance_selection_listbox.selected_key()
+        if self.selected_medication_info_id is None:
+            self.selected_medication_info_id = ''
+            return
 
-        self.last_selected_medication_info_id = copy.copy(self.selected_medication_info_id)
+        self.last_selected_medication_info_id = self.selected_medication_info_id
 
         self.populate_medication_instance_dose_listbox()
 
     def clear_selected_medication_info_id(self, event):
-        print(event)
+        instrumentation.record_event(event)
         self.selected_medication_info_id = ''
 
     # BUTTON COMMANDS
@@ -507,8 +2860,8 @@ class ResidentMedicationWindow(WindowManager):
 
             self.window.withdraw()
 
-            currently_selected_medication_name = DatabaseManager.collect_medication_name(
-                DatabaseManager(), self.selected_medication_id)[0][0]
+            currently_selected_medication_name = self.medication_cache.collect_medication_name(
+                self.selected_medication_id)[0][0]
 
             add_medication_instance_window = AddMedicationInstanceWindow(
                 master=self.window, title=f'Add {currently_selected_medication_name} Instance for '
@@ -541,109 +2894,177 @@ class ResidentMedicationWindow(WindowManager):
 
     # CREATE EXPIRY DATE PDF REPORT
     def create_expiry_date_pdf_report(self):
-        expiry_dates = (DatabaseManager.collect_medications_instances_expiry_dates(DatabaseManager(),
-                                                                                   self.resident_selection_id))
-        expired = []
-        expired_medication_names = []
-
-        due_to_expire = []
-        due_to_expire_medication_names = []
-
-        in_date = []
-        in_date_medication_names = []
-
-        no_expiry_date = []
-        no_expiry_date_medication_names = []
-
-        for date in expiry_dates:
-            matched_medication_id = DatabaseManager.collect_medication_ids_where_dates_match(DatabaseManager(),
-                                                                                             date=date)[0][0]
-            matched_medication_name = DatabaseManager.collect_medication_name(DatabaseManager(),
-                                                                              medication_id=matched_medication_id)[0][0]
-            try:
-                date_time_obj = datetime.strptime(date, '%m/%d/%y').date()
-                day_difference = (date_time_obj - datetime.now().date()).days
-
-                if day_difference < 0:
-                    expired.append(date_time_obj)
-                    expired_medication_names.append(matched_medication_name)
-
-                elif day_difference <= 30:
-                    due_to_expire.append(date_time_obj)
-                    due_to_expire_medication_names.append(matched_medication_name)
-
-                else:
-                    in_date.append(date_time_obj)
-                    in_date_medication_names.append(matched_medication_name)
-
-            except ValueError:
-                no_expiry_date.append(date)
-                no_expiry_date_medication_names.append(matched_medication_name)
-
-        # GENERATE EXPIRY PDF REPORT
+        resident_id = self.resident_selection_id
         report_owner_and_time = f'{self.resident_selection_details.split()[0]} '\
             f'{self.resident_selection_details.split()[1]} '\
             f'{self.resident_selection_details.split()[3].replace("/", "-")} '\
             f'{datetime.now().strftime("%m-%d-%Y, %H-%M-%S")}'
 
-        pdf = fpdf.FPDF(format='letter')
-        pdf.set_font("Courier", size=8)
+        # AN UNCHANGED RESIDENT HANDS BACK TODAY'S EXISTING REPORT INSTEAD OF WRITING ANOTHER
+        def work(task):
+            database = DatabaseManager()
+            os.makedirs('Reports', exist_ok=True)
+            return report_cache.get_or_write(
+                'resident', resident_id, database.collect_data_version(),
+                lambda: ExpiryReport(database.stream_resident_expiry_report_rows(resident_id)).write_pdf(
+                    report_owner_and_time, f'Reports/Expiry Report for {report_owner_and_time}.pdf ', task))
 
-        def add_page(values, text):
-            pdf.add_page()
-            pdf.write(5, report_owner_and_time)
-            pdf.ln()
-            pdf.write(5, text)
-            pdf.ln()
-            for medication_name in values:
-                pdf.write(5, medication_name)
-                pdf.ln()
-
-        # EXPIRED ITEMS PAGE
-        add_page(expired_medication_names, f'{len(expired)} Expired Items:')
-
-        # ITEMS EXPIRING WITHIN 30 DAYS PAGE
-        add_page(due_to_expire_medication_names, f'{len(due_to_expire)} Items Expiring Within 30 Days:')
-
-        # ITEMS IN DATE PAGE
-        add_page(in_date_medication_names, f'{len(in_date)} Items In-Date:')
-
-        # ITEMS WITHOUT AN EXPIRY DATE PAGE
-        add_page(no_expiry_date_medication_names, f'{len(no_expiry_date)} Items Without an Expiry Date:')
-
-        pdf.output(f'Reports/Expiry Report for {report_owner_and_time}.pdf ')
-
-        WindowManager.make_message_box(
-            title='Success', message=f'Expiry Date Report Created.', icon='info')
+        task_runner.run(self.window, work, progress_title='Creating Expiry Date Report',
+                        on_success=lambda result: WindowManager.show_report_result('Expiry Date Report', *result))
 
     # MODIFY INSTANCE STOCK LEVEL
     def modify_instance_stock_level(self):
         if self.selected_medication_info_id:
             try:
                 float(self.modify_medication_instance_stock_field.get())
+            except ValueError:
+                WindowManager.make_message_box(title="Error", message='Please enter a number and try again.',
+                                               icon='error')
+                return
 
-                DatabaseManager.modify_medication_instance_quantity(
-                    self=DatabaseManager(), modify_stock_field=self.modify_medication_instance_stock_field.get(),
-                    medication_info_id=self.selected_medication_info_id)
+            modify_stock_field = self.modify_medication_instance_stock_field.get()
+            medication_info_id = self.selected_medication_info_id
 
-                self.populate_medication_instance_listbox()
-                self.medication_instance_selection_listbox.selection_set(
-                    first=self.last_selected_medication_instance_index)
-                self.populate_medication_instance_dose_listbox()
+            def work(task):
+                self.medication_cache.modify_medication_instance_quantity(
+                    modify_stock_field=modify_stock_field, medication_info_id=medication_info_id)
+                self.preload_medication_instance(medication_info_id)
 
+            def on_success(result):
                 self.modify_medication_instance_stock_field.delete(0, 'end')
 
                 WindowManager.make_message_box(
                     title='Success', message=f'{self.last_selected_medication_name} quantity updated.', icon='info')
 
-            except ValueError:
-                WindowManager.make_message_box(title="Error", message='Please enter a number and try again.',
-                                               icon='error')
+            task_runner.run(self.window, work, on_success=on_success)
         else:
             WindowManager.make_message_box(
                 title="Error", message='Please select a medication instance before trying to modify stock level.',
                 icon='error')
 
+    # USE THE AMOUNT IN THE STOCK FIELD FROM THE SELECTED MEDICATION, TAKEN FROM ITS EARLIEST EXPIRING INSTANCES FIRST
+    def use_medication_stock(self):
+        if not self.last_selected_medication_id:
+            WindowManager.make_message_box(
+                title="Error", message='Please select a medication before trying to use stock.', icon='error')
+            return
+        try:
+            amount = float(self.modify_medication_instance_stock_field.get())
+        except ValueError:
+            WindowManager.make_message_box(title="Error", message='Please enter a number and try again.',
+                                           icon='error')
+            return
+        if not 0 < amount < float('inf'):
+            WindowManager.make_message_box(title="Error", message='Please enter an amount greater than zero.',
+                                           icon='error')
+            return
+
+        medication_id = self.last_selected_medication_id
+
+        def work(task):
+            allocations = self.medication_cache.allocate_medication_fefo(medication_id, amount)
+            for allocation in allocations:
+                self.medication_cache.collect_medication_instance(allocation[0])
+            return allocations
+
+        def on_success(allocations):
+            self.modify_medication_instance_stock_field.delete(0, 'end')
+
+            used = sum(allocation[1] for allocation in allocations)
+            if used < amount:
+                WindowManager.make_message_box(
+                    title='Low Stock Alert', message=f'Only {round(used, 2)} of {round(amount, 2)} '
+                                                     f'{self.last_selected_medication_name} was in date and in stock.',
+                    icon='warning')
+            else:
+                WindowManager.make_message_box(
+                    title='Success', message=f'{round(used, 2)} {self.last_selected_medication_name} used from '
+                                             f'{len(allocations)} instances.', icon='info')
+
+        task_runner.run(self.window, work, on_success=on_success)
+
+    # ADMINISTER SELECTED DOSE
+    def administer_selected_dose(self):
+        dose_info_id = self.medication_instance_dose_selection_listbox.selected_key()
+        if dose_info_id is None:
+            WindowManager.make_message_box(
+                title="Error", message='Please select a dose before trying to administer it.', icon='error')
+            return
+
+        # FOR ASKING WHO GAVE THE DOSE, IMPORTED ONLY WHEN A DOSE IS ADMINISTERED
+        import tkinter.simpledialog
+
+        administered_by = tkinter.simpledialog.askstring(title='Administer Dose', prompt='Administered by:',
+                                                         parent=self.window)
+        if not administered_by:
+            return
+
+        medication_info_id = self.last_selected_medication_info_id
+
+        def work(task):
+            quantity_after = self.medication_cache.administer_dose(dose_info_id=dose_info_id,
+                                                                   administered_by=administered_by)
+            self.preload_medication_instance(medication_info_id)
+            return quantity_after
+
+        def on_success(quantity_after):
+            WindowManager.make_message_box(
+                title='Success', message=f'{self.last_selected_medication_name} dose administered. '
+                                         f'{quantity_after} remaining.', icon='info')
+
+        task_runner.run(self.window, work, on_success=on_success)
+
+    # RELOAD THE CACHE ENTRIES A WRITE INVALIDATED, ON THE WORKER, SO THE DOSE REFILL ON THE TK THREAD IS FROM MEMORY
+    def preload_medication_instance(self, medication_info_id):
+        self.medication_cache.collect_medication_instance(medication_info_id)
+        self.medication_cache.collect_medication_instance_doses(medication_info_id=medication_info_id)
+
+    # change_feed: PATCH ONLY THE ROWS THE COMMITTED WRITES CHANGED. AN INSTANCE ROW CHANGES WITH ITS OWN WRITES, ITS
+    # MEDICATION'S STOCK ROLLUP WITH ANY WRITE TO ITS INSTANCES OR THEIR DOSES, AND THE DOSE LISTBOX, WHICH SHOWS THE
+    # SELECTED INSTANCE, WITH THAT INSTANCE'S QUANTITY OR DOSES. BULK WRITES REFRESH THE LOADED ROWS INSTEAD
+    def records_changed(self, events):
+        medication_instance_selection_listbox = self.medication_instance_selection_listbox
+        if any(event.entity_id is None for event in events):
+            self.populate_medication_listbox()
+            if medication_instance_selection_listbox.load_page is not None:
+                medication_instance_selection_listbox.refresh()
+            if medication_instance_selection_listbox.selected_key() is not None:
+                self.populate_medication_instance_dose_listbox()
+            return
+
+        medication_ids = set()
+        medication_info_ids = set()
+        dose_medication_info_ids = set()
+        for event in events:
+            if event.entity == 'medication':
+                medication_ids.add(event.entity_id)
+            elif event.entity == 'medication_info':
+                medication_info_ids.add(event.entity_id)
+            else:
+                dose_medication_info_ids.add(event.fields['medication_info_id'])
+
+        medication_instances = [self.medication_cache.collect_medication_instance(medication_info_id)
+                                for medication_info_id in medication_info_ids | dose_medication_info_ids]
+        medication_instances = [medication_instance for medication_instance in medication_instances
+                                if medication_instance is not None]
+        medication_instance_selection_listbox.patch_rows(
+            medication_instance for medication_instance in medication_instances
+            if medication_instance[0] in medication_info_ids
+            and medication_instance_selection_listbox.query_key == ('medication_info', medication_instance[6]))
+
+        medication_ids.update(medication_instance[6] for medication_instance in medication_instances)
+        if make_search_query(self.medication_search_field.get()) is not None:
+            self.populate_medication_listbox()
+        else:
+            medications = [self.database.collect_medication_with_stock(medication_id)
+                           for medication_id in medication_ids]
+            self.medication_selection_listbox.patch_rows(
+                medication for medication in medications
+                if medication is not None and medication[3] == int(self.resident_selection_id))
+
+        if medication_instance_selection_listbox.selected_key() in medication_info_ids | dose_medication_info_ids:
+            self.populate_medication_instance_dose_listbox()
+
     # SHOW MEDICATION NOTES WINDOW
     def show_medication_notes_window(self):
         if self.medication_notes_window_open is True:
@@ -678,6 +3099,9 @@ class ResidentMedicationWindow(WindowManager):
 
             medicine_repository = 'https://www.medicines.org.uk/emc/search?q='
 
+            # FOR MEDICATION LOOKUP, IMPORTED ONLY WHEN A LOOKUP IS MADE
+            import webbrowser
+
             webbrowser.open(medicine_repository + self.last_selected_medication_name)
 
         else:
@@ -687,105 +3111,110 @@ class ResidentMedicationWindow(WindowManager):
 
     # GET LAST SELECTED MEDICATION NAME
     def get_last_selected_medication_name(self):
-        self.last_selected_medication_name = DatabaseManager.collect_medication_name(
-            DatabaseManager(), self.selected_medication_id)[0][0]
+        self.last_selected_medication_name = self.medication_cache.collect_medication_name(
+            self.selected_medication_id)[0][0]
 
     # SET self.medication_notes_window_open TO FALSE
     def set_medication_notes_window_open_to_false(self):
         self.medication_notes_window_open = False
 
-    # POPULATE MEDICATION LISTBOX
+    # POPULATE MEDICATION LISTBOX, PAGED THROUGH medication_cache AND FILTERED BY THE SEARCH FIELD. REPOPULATING ONLY
+    # DIFFS
     def populate_medication_listbox(self):
-        self.medication_selection_listbox.delete(first=0, last=tk.END)
-
-        collected_medication = DatabaseManager().collect_resident_medication(resident_id=self.resident_selection_id)
-
-        self.medication_ids = []
-
-        for i, medication in enumerate(collected_medication):
-            medication_id = medication[0]
-            medication_name = medication[1]
-            medication_other_name = medication[2]
-
-            self.medication_selection_listbox.insert(i, f'{medication_name} - {medication_other_name}')
-            self.medication_ids.append(medication_id)
+        resident_id = self.resident_selection_id
+        search_text = self.medication_search_field.get()
+        if make_search_query(search_text) is None:
+            self.medication_selection_listbox.show(
+                ('medication', resident_id),
+                lambda after_id, limit: self.medication_cache.collect_resident_medication_page(resident_id, after_id,
+                                                                                               limit))
+        else:
+            self.medication_selection_listbox.show(
+                ('medication_search', resident_id, search_text),
+                lambda after_id, limit: self.database.search_resident_medication_page(resident_id, search_text,
+                                                                                      after_id, limit))
 
-    # POPULATE MEDICATION INSTANCE LISTBOX
+    @staticmethod
+    def format_medication_row(i, medication):
+        # medication_id = medication[0]
+        medication_name = medication[1]
+        medication_other_name = medication[2]
+        total_strength = medication[5]
+        total_quantity = medication[6]
+        measurement = medication[7] or ''
+        earliest_expiry = medication[8] or 'N/A'
+        days_remaining = 'N/A' if medication[9] is None else round(medication[9], 2)
+        return f'{medication_name} - {medication_other_name} - In-Date Stock: {round(total_quantity, 2)} ' \
+               f'({round(total_strength, 2)}{measurement}) - Earliest Expiry: {earliest_expiry} - ' \
+               f'Days Remaining: {days_remaining}'
+
+    # POPULATE MEDICATION INSTANCE LISTBOX, PAGED SO A LONG HISTORY OF DELIVERIES IS ONLY READ AS IT IS SCROLLED, AND
+    # THROUGH medication_cache SO CLICKING BACK TO A MEDICATION IS SERVED FROM MEMORY
     def populate_medication_instance_listbox(self):
-        self.medication_instance_selection_listbox.delete(first=0, last=tk.END)
-
-        collected_medication_instances = DatabaseManager().collect_medication_instances(
-            medication_id=self.last_selected_medication_id)
+        medication_id = self.last_selected_medication_id
+        self.medication_instance_selection_listbox.show(
+            ('medication_info', medication_id),
+            lambda after_id, limit: self.medication_cache.collect_medication_instances_page(medication_id, after_id,
+                                                                                            limit))
 
-        self.medication_info_ids = []
-
-        for i, medication_instance in enumerate(collected_medication_instances):
-            instance_id = medication_instance[0]
-            instance_expiry = medication_instance[1]
-            instance_quantity = medication_instance[2]
-            instance_strength = medication_instance[3]
-            instance_type = medication_instance[4]
-            # instance_notes = medication_instance[5]
-            # instance_medication_id = medication_instance[6]
-            instance_supplier = medication_instance[7]
-            instance_measurement = medication_instance[8]
-
-            self.medication_instance_selection_listbox.insert(i, f'{str(i + 1)}: - Expiry: {instance_expiry} - '
-                                                                 f'Quantity: {str(instance_quantity)} '
-                                                                 f'{instance_type} - Strength: '
-                                                                 f'{str(instance_strength)}{instance_measurement} - '
-                                                                 f'Supplier: {instance_supplier}')
-
-            self.medication_info_ids.append(instance_id)
+    @staticmethod
+    def format_medication_instance_row(i, medication_instance):
+        # instance_id = medication_instance[0]
+        instance_expiry = medication_instance[1]
+        instance_quantity = medication_instance[2]
+        instance_strength = medication_instance[3]
+        instance_type = medication_instance[4]
+        # instance_notes = medication_instance[5]
+        # instance_medication_id = medication_instance[6]
+        instance_supplier = medication_instance[7]
+        instance_measurement = medication_instance[8]
+
+        return f'{str(i + 1)}: - Expiry: {instance_expiry} - Quantity: {str(instance_quantity)} {instance_type} - ' \
+               f'Strength: {str(instance_strength)}{instance_measurement} - Supplier: {instance_supplier}'
 
     # POPULATE MEDICATION INSTANCE DOSE LISTBOX
     def populate_medication_instance_dose_listbox(self):
-        current_strength = DatabaseManager().collect_quantity_and_strength(self.last_selected_medication_info_id)[0]
-        current_quantity = DatabaseManager().collect_quantity_and_strength(self.last_selected_medication_info_id)[1]
-
-        self.medication_instance_dose_selection_listbox.delete(first=0, last=tk.END)
+        current_quantity, current_strength = self.medication_cache.collect_quantity_and_strength(
+            self.last_selected_medication_info_id)
 
-        collected_medication_instance_doses = DatabaseManager().collect_medication_instance_doses(
+        collected_medication_instance_doses = self.medication_cache.collect_medication_instance_doses(
             medication_info_id=self.last_selected_medication_info_id)
 
+        keyed_texts = []
         for i, medication_instance_dose_info in enumerate(collected_medication_instance_doses):
-            # dose_info_id = medication_instance_dose_info[0]
+            dose_info_id = medication_instance_dose_info[0]
             dose_info_dose = medication_instance_dose_info[1]
             dose_info_measurement = medication_instance_dose_info[2]
             dose_info_frequency_per_day = medication_instance_dose_info[3]
             dose_info_regular_or_prn = medication_instance_dose_info[4]
 
-            # CALCULATES HOW MANY DAYS WORTH OF A MEDICATION INSTANCE REMAINS AT DOSE SELECTED
-            if dose_info_regular_or_prn != 'PRN' and dose_info_frequency_per_day != 0:
-                how_many_days_remaining = round((current_strength * current_quantity) /
-                                                (dose_info_dose * dose_info_frequency_per_day), 2)
-            else:
-                how_many_days_remaining = 'N/A'
+            how_many_days_remaining = calculate_days_remaining(current_quantity, current_strength, dose_info_dose,
+                                                               dose_info_frequency_per_day, dose_info_regular_or_prn)
+
+            keyed_texts.append((dose_info_id, f'{str(i + 1)}: - Dose: {str(dose_info_dose)}{dose_info_measurement} - '
+                                              f'Frequency Per Day: {str(dose_info_frequency_per_day)} - '
+                                              f'Regularity: {dose_info_regular_or_prn} - Days Remaining: '
+                                              f'{str(how_many_days_remaining)}'))
 
-            self.medication_instance_dose_selection_listbox.insert(i, f'{str(i + 1)}: - Dose: {str(dose_info_dose)}'
-                                                                      f'{dose_info_measurement} - Frequency Per Day: '
-                                                                      f'{str(dose_info_frequency_per_day)} - '
-                                                                      f'Regularity: {dose_info_regular_or_prn} '
-                                                                      f'- Days Remaining: '
-                                                                      f'{str(how_many_days_remaining)}')
+        self.medication_instance_dose_selection_listbox.replace_rows(keyed_texts)
 
     # CLEAR MEDICATION LIST BOX
     def clear_medication_listbox(self):
-        self.medication_selection_listbox.delete(first=0, last=tk.END)
+        self.medication_selection_listbox.clear()
 
     # CLEAR MEDICATION INSTANCES LIST BOX
     def clear_medication_instances_listbox(self):
-        self.medication_instance_selection_listbox.delete(first=0, last=tk.END)
+        self.medication_instance_selection_listbox.clear()
 
     # CLEAR MEDICATION INSTANCE DOSES LIST BOX
     def clear_medication_instance_doses_listbox(self):
-        self.medication_instance_dose_selection_listbox.delete(first=0, last=tk.END)
+        self.medication_instance_dose_selection_listbox.clear()
 
     # CLEAR LIST BOXES
     def clear_boxes(self):
-        self.medication_selection_listbox.delete(first=0, last=tk.END)
-        self.medication_instance_selection_listbox.delete(first=0, last=tk.END)
-        self.medication_instance_dose_selection_listbox.delete(first=0, last=tk.END)
+        self.medication_selection_listbox.clear()
+        self.medication_instance_selection_listbox.clear()
+        self.medication_instance_dose_selection_listbox.clear()
 
 
 class AddMedicationWindow(WindowManager):
@@ -809,14 +3238,12 @@ class AddMedicationWindow(WindowManager):
     # BUTTON COMMANDS
     def add_medication_to_database(self):
         if self.medication_name_field.get().isalpha() and self.medication_other_name_field.get().isalpha():
-            DatabaseManager.add_medication_to_database(self=DatabaseManager(),
-                                                       medication_name=self.medication_name_field.get(),
-                                                       medication_other_name=self.medication_other_name_field.get(),
-                                                       resident_id=self.selected_resident_id)
+            self.medication_cache.add_medication_to_database(
+                medication_name=self.medication_name_field.get(),
+                medication_other_name=self.medication_other_name_field.get(),
+                resident_id=self.selected_resident_id)
             self.window.destroy()
             self.previous_window.deiconify()
-            ResidentMedicationWindow.clear_boxes(self=self.resident_medication_window)
-            ResidentMedicationWindow.populate_medication_listbox(self=self.resident_medication_window)
             WindowManager.make_message_box(title='Success', message='Medication added to database.', icon='info')
         else:
             WindowManager.make_message_box(title="Error", message='Please fill in all fields correctly and try again.',
@@ -859,20 +3286,17 @@ class AddMedicationInstanceWindow(WindowManager):
 
 # BUTTON COMMANDS
     def add_medication_instance_to_database(self):
-        DatabaseManager.add_medication_instance_to_database(self=DatabaseManager(),
-                                                            instance_expiry=self.expiry_date_picker.get_date(),
-                                                            instance_measurement=self.measurement_combo_box.get(),
-                                                            instance_medication_id=self.selected_medication_id,
-                                                            instance_medication_type=self.form_combo_box.get(),
-                                                            instance_quantity=self.quantity_scale.get(),
-                                                            instance_strength=self.strength_scale.get(),
-                                                            instance_supplier=self.supplier_entry_field.get())
+        self.medication_cache.add_medication_instance_to_database(
+            instance_expiry=self.expiry_date_picker.selection_get(),
+            instance_measurement=self.measurement_combo_box.get(),
+            instance_medication_id=self.selected_medication_id,
+            instance_medication_type=self.form_combo_box.get(),
+            instance_quantity=self.quantity_scale.get(),
+            instance_strength=self.strength_scale.get(),
+            instance_supplier=self.supplier_entry_field.get())
         self.window.destroy()
         self.previous_window.deiconify()
 
-        ResidentMedicationWindow.populate_medication_instance_listbox(self.resident_medication_window)
-        ResidentMedicationWindow.clear_medication_instance_doses_listbox(self.resident_medication_window)
-
         WindowManager.make_message_box(title='Success', message='Medication instance added to database.', icon='info')
 
 
@@ -908,17 +3332,15 @@ class AddMedicationInstanceDoseWindow(WindowManager):
 
 # BUTTON COMMANDS
     def add_medication_instance_dose_to_database(self):
-        DatabaseManager.add_medication_instance_dose_to_database(self=DatabaseManager(),
-                                                                 dose_amount=self.dose_scale.get(),
-                                                                 dose_frequency=self.frequency_per_day_combobox.get(),
-                                                                 dose_measurement=self.measurement_combobox.get(),
-                                                                 dose_medication_info_id=self.
-                                                                 selected_medication_info_id,
-                                                                 dose_regularity=self.regularity_combobox.get())
+        self.medication_cache.add_medication_instance_dose_to_database(
+            dose_amount=self.dose_scale.get(),
+            dose_frequency=self.frequency_per_day_combobox.get(),
+            dose_measurement=self.measurement_combobox.get(),
+            dose_medication_info_id=self.selected_medication_info_id,
+            dose_regularity=self.regularity_combobox.get())
         self.window.destroy()
         self.previous_window.deiconify()
 
-        ResidentMedicationWindow.populate_medication_instance_dose_listbox(self.resident_medication_window)
         WindowManager.make_message_box(title='Success', message='Medication instance dose added to database.',
                                        icon='info')
 
@@ -936,6 +3358,7 @@ class MedicationNotesWindow(WindowManager):
 # TEXT BOX AND BUTTON
         self.medication_notes_text_box = WindowManager.make_text_box(self, width=70, height=22)
         self.populate_medication_notes_text_box()
+        change_feed.subscribe_window(self, ('medication',), self.medication_changed)
 
         WindowManager.make_button(self, text='Save Notes', command=self.add_medication_notes_to_database,
                                   state='active', side=tk.TOP, pad_x=0, pad_y=5)
@@ -947,8 +3370,8 @@ class MedicationNotesWindow(WindowManager):
 
 # BUTTON COMMANDS
     def add_medication_notes_to_database(self):
-        DatabaseManager.add_medication_notes_to_database(
-            self=DatabaseManager(), notes_text_box=self.medication_notes_text_box.get('1.0', 'end'),
+        self.medication_cache.add_medication_notes_to_database(
+            notes_text_box=self.medication_notes_text_box.get('1.0', 'end'),
             medication_id=self.selected_medication_id)
         self.on_exit()
         WindowManager.make_message_box(title='Success', message='Notes successfully updated.', icon='info')
@@ -956,31 +3379,238 @@ class MedicationNotesWindow(WindowManager):
 # POPULATE MEDICATION NOTES TEXTBOX
     def populate_medication_notes_text_box(self):
         self.medication_notes_text_box.delete(1.0, "end")
-        self.medication_notes_text_box.insert("end", DatabaseManager.
-                                              collect_medication_notes(DatabaseManager(),
-                                                                       medication_id=self.selected_medication_id))
+        self.medication_notes_text_box.insert("end", self.medication_cache.collect_medication_notes(
+            medication_id=self.selected_medication_id))
+        self.medication_notes_text_box.edit_modified(False)
+
+# change_feed: RELOAD NOTES SAVED ELSEWHERE, UNLESS THEY ARE BEING EDITED HERE
+    def medication_changed(self, events):
+        if not self.medication_notes_text_box.edit_modified() and any(
+                event.entity_id == int(self.selected_medication_id) and 'notes' in event.fields for event in events):
+            self.populate_medication_notes_text_box()
+
+
+# HEADLESS COMMAND LINE, e.g. "nurse_aid.py report expiry --all" OR "nurse_aid.py stock set 12 56"
+def make_argument_parser():
+    # FOR THE HEADLESS COMMAND LINE, IMPORTED ONLY WHEN ARGUMENTS ARE GIVEN
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='nurse_aid', description='Nurse Aid. Run without arguments for the GUI.')
+    parser.add_argument('--database', default=DATABASE_PATH, help='database file (default: %(default)s)')
+    parser.add_argument('--busy-timeout', type=int, default=5000,
+                        help='milliseconds to wait for another terminal to release the database (default: %(default)s)')
+    parser.add_argument('--profile', metavar='PATH', default=os.environ.get('NURSE_AID_PROFILE'),
+                        help='time every query and method and write a profile to PATH, or to stderr for -')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    report_parser = commands.add_parser('report', help='create reports without opening the GUI')
+    reports = report_parser.add_subparsers(dest='report', required=True)
+    expiry_parser = reports.add_parser('expiry', help='medication expiry report')
+    expiry_scope = expiry_parser.add_mutually_exclusive_group(required=True)
+    expiry_scope.add_argument('--all', action='store_true', help='report on every resident')
+    expiry_scope.add_argument('--resident', type=int, metavar='RESIDENT_ID', help='report on one resident')
+    expiry_parser.add_argument('--per-resident', action='store_true',
+                               help='with --all, write one PDF per resident instead of one combined PDF')
+    expiry_parser.add_argument('--output', default='Reports', help='report directory (default: %(default)s)')
+    expiry_parser.add_argument('--refresh', action='store_true',
+                               help="write a new report even if today's report is still up to date")
+    expiry_parser.add_argument('--before', type=date.fromisoformat, metavar='YYYY-MM-DD',
+                               help='list the instances expiring before this date instead of writing a PDF')
+    expiry_parser.add_argument('--from', dest='from_date', type=date.fromisoformat, metavar='YYYY-MM-DD',
+                               help='with --before, leave out instances expiring before this date')
+
+    import_parser = commands.add_parser('import', help='import data files')
+    imports = import_parser.add_subparsers(dest='import_type', required=True)
+    delivery_parser = imports.add_parser('delivery', help='import a pharmacy delivery CSV, JSON or JSON Lines file')
+    delivery_parser.add_argument('file')
+    delivery_parser.add_argument('--batch-size', type=int, default=500, help='rows per transaction '
+                                                                             '(default: %(default)s)')
+
+    low_stock_parser = reports.add_parser('low-stock', help='instances running out of regular doses')
+    low_stock_parser.add_argument('--days', type=float, default=LOW_STOCK_ALERT_DAYS,
+                                  help='alert threshold in days (default: %(default)s)')
+    reorder_parser = reports.add_parser('reorder', help='instances to reorder before their regular doses run out')
+    reorder_parser.add_argument('--lead-days', type=int, default=REORDER_LEAD_DAYS,
+                                help='days between reordering and running out (default: %(default)s)')
+    reorder_parser.add_argument('--within', type=int, default=0, metavar='DAYS',
+                                help='also list instances due for reordering in the next DAYS days')
+
+    dose_parser = commands.add_parser('dose', help='record and review dose administration')
+    dose_commands = dose_parser.add_subparsers(dest='dose_command', required=True)
+    administer_parser = dose_commands.add_parser('administer', help='record doses given, decrementing stock')
+    administer_parser.add_argument('dose_info_ids', type=int, nargs='+')
+    administer_parser.add_argument('--by', required=True, help='who administered the doses')
+    history_parser = dose_commands.add_parser('history', help="show a medication instance's quantity history")
+    history_parser.add_argument('medication_info_id', type=int)
+
+    stock_parser = commands.add_parser('stock', help='change medication stock levels')
+    stock_commands = stock_parser.add_subparsers(dest='stock_command', required=True)
+    stock_set_parser = stock_commands.add_parser('set', help='set the quantity of a medication instance')
+    stock_set_parser.add_argument('medication_info_id', type=int)
+    stock_set_parser.add_argument('quantity', type=float)
+    stock_use_parser = stock_commands.add_parser('use', help="use a medication's stock, earliest expiry first")
+    stock_use_parser.add_argument('medication_id', type=int)
+    stock_use_parser.add_argument('amount', type=float)
+    stock_use_parser.add_argument('--by', help='who used the stock')
+
+    return parser
+
+
+# RUN ONE COMMAND LINE COMMAND, RETURNING THE PROCESS EXIT CODE
+def run_command_line(arguments):
+    arguments = make_argument_parser().parse_args(arguments)
+
+    with ConnectionPool(arguments.database, busy_timeout=arguments.busy_timeout) as pool, \
+            profiling(arguments.profile, pool):
+        database = DatabaseManager(pool=pool)
+        database.create_tables()
+
+        if arguments.command == 'report' and arguments.report == 'low-stock':
+            for instance in database.collect_instances_running_out(arguments.days):
+                print(format_low_stock_alert(instance))
+
+        elif arguments.command == 'report' and arguments.before is not None:
+            if arguments.per_resident:
+                print('--per-resident writes PDFs and cannot be used with --before.', file=sys.stderr)
+                return 1
+            if arguments.resident is not None and database.collect_resident(arguments.resident) is None:
+                print(f'No resident with id {arguments.resident}.', file=sys.stderr)
+                return 1
+            if arguments.from_date is None:
+                instances = database.collect_instances_expiring_before(arguments.before, arguments.resident)
+            else:
+                instances = database.collect_instances_expiring_between(arguments.from_date, arguments.before,
+                                                                        arguments.resident)
+            for instance in instances:
+                print(format_expiring_instance(instance))
+
+        elif arguments.command == 'report' and arguments.from_date is not None:
+            print('--from needs --before.', file=sys.stderr)
+            return 1
+
+        elif arguments.command == 'report' and arguments.report == 'reorder':
+            reorder_rows = StockForecast(*database.collect_forecast_rows(), lead_days=arguments.lead_days).reorder_list(
+                arguments.within)
+            descriptions = database.collect_instance_descriptions(reorder_row[0] for reorder_row in reorder_rows)
+            for reorder_row in reorder_rows:
+                # INSTANCES LEFT BEHIND BY A DELETED RESIDENT OR MEDICATION HAVE NO DESCRIPTION AND NO ONE TO ORDER FOR
+                if reorder_row[0] in descriptions:
+                    print(format_reorder_row(reorder_row, descriptions[reorder_row[0]]))
+
+        elif arguments.command == 'report':
+            os.makedirs(arguments.output, exist_ok=True)
+            output_report_cache = ReportCache(arguments.output)
+            data_version = database.collect_data_version()
+
+            if arguments.all and arguments.per_resident:
+                file_paths = HomeExpiryReport(database.stream_home_expiry_report_rows()).write_resident_pdfs(
+                    arguments.output)
+            elif arguments.all:
+                file_paths = [output_report_cache.get_or_write(
+                    'home', None, data_version,
+                    lambda: HomeExpiryReport(database.stream_home_expiry_report_rows()).write_combined_pdf(
+                        os.path.join(arguments.output,
+                                     f'Home Expiry Report {datetime.now().strftime("%m-%d-%Y, %H-%M-%S")}.pdf')),
+                    refresh=arguments.refresh)[0]]
+            else:
+                resident = database.collect_resident(arguments.resident)
+                if resident is None:
+                    print(f'No resident with id {arguments.resident}.', file=sys.stderr)
+                    return 1
+                report_owner_and_time = make_report_owner_and_time(*resident[1:])
+                file_paths = [output_report_cache.get_or_write(
+                    'resident', arguments.resident, data_version,
+                    lambda: write_resident_expiry_pdf(
+                        ExpiryReport(database.stream_resident_expiry_report_rows(arguments.resident)),
+                        report_owner_and_time,
+                        os.path.join(arguments.output, f'Expiry Report for {report_owner_and_time}.pdf')),
+                    refresh=arguments.refresh)[0]]
+
+            for file_path in file_paths:
+                print(file_path)
+
+        elif arguments.command == 'import':
+            delivery_importer = DeliveryImporter(database, batch_size=arguments.batch_size).import_file(
+                arguments.file)
+            for row_number, message in delivery_importer.errors:
+                print(f'Row {row_number}: {message}', file=sys.stderr)
+            print(f'{delivery_importer.imported_count} items imported, {len(delivery_importer.errors)} rows skipped.')
+            if delivery_importer.errors:
+                return 1
+
+        elif arguments.command == 'dose' and arguments.dose_command == 'administer':
+            try:
+                recorded_count = database.administer_doses((dose_info_id, arguments.by, None, None)
+                                                           for dose_info_id in arguments.dose_info_ids)
+            except NotEnoughStock as error:
+                print(f'{error} No doses recorded.', file=sys.stderr)
+                return 1
+            print(f'{recorded_count} doses recorded.')
+            if recorded_count != len(arguments.dose_info_ids):
+                print(f'{len(arguments.dose_info_ids) - recorded_count} dose ids were not found.', file=sys.stderr)
+                return 1
+
+        elif arguments.command == 'dose':
+            for administered_at, administered_by, dose_info_id, quantity_used, quantity_after in \
+                    database.collect_quantity_history(arguments.medication_info_id):
+                used_for = 'stock use' if dose_info_id is None else f'dose {dose_info_id}'
+                print(f'{administered_at} {administered_by}: {used_for}, used {quantity_used}, {quantity_after} left')
+
+        elif arguments.command == 'stock' and arguments.stock_command == 'use':
+            try:
+                allocations = database.allocate_medication_fefo(arguments.medication_id, arguments.amount,
+                                                                used_by=arguments.by)
+            except ValueError as error:
+                print(error, file=sys.stderr)
+                return 1
+            for medication_info_id, quantity_used, quantity_after in allocations:
+                print(f'Medication instance {medication_info_id}: used {quantity_used}, {quantity_after} left.')
+            used = sum(allocation[1] for allocation in allocations)
+            if used < arguments.amount:
+                print(f'Only {used} of {arguments.amount} was in date and in stock.', file=sys.stderr)
+                return 1
 
+        elif arguments.command == 'stock':
+            if database.collect_medication_instance(arguments.medication_info_id) is None:
+                print(f'No medication instance with id {arguments.medication_info_id}.', file=sys.stderr)
+                return 1
+            database.modify_medication_instance_quantity(arguments.quantity, arguments.medication_info_id)
+            print(f'Medication instance {arguments.medication_info_id} quantity set to {arguments.quantity}.')
 
-# MAIN LOOP
-def main():
-    database = DatabaseManager()
-    database.create_tables()
+    return 0
 
-    root = tk.Tk()
-    root.iconbitmap(r'icon.ico')
-    root.withdraw()
 
-    primary_window = PrimaryWindow(master=root, title='Nurse Aid', geometry='220x70', previous_window=root)
-    primary_window.center_window(x=220, y=70)
+# START THE GUI
+def run_gui():
+    with connection_pool, profiling(os.environ.get('NURSE_AID_PROFILE')):
+        with DatabaseManager() as database:
+            database.create_tables()
 
-    root.mainloop()
+        root = tk.Tk()
+        root.iconbitmap(r'icon.ico')
+        root.withdraw()
 
-    database.connection.close()
+        primary_window = PrimaryWindow(master=root, title='Nurse Aid', geometry='220x230', previous_window=root)
+        primary_window.center_window(x=220, y=230)
+
+        root.mainloop()
+        task_runner.shutdown()
+
+
+# MAIN LOOP
+def main(arguments=None):
+    arguments = sys.argv[1:] if arguments is None else arguments
+    if arguments:
+        return run_command_line(arguments)
+    run_gui()
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    # LETS THE REPORT PROCESS POOL START WORKERS FROM THE PYINSTALLER EXECUTABLE
+    if getattr(sys, 'frozen', False):
+        import multiprocessing
+        multiprocessing.freeze_support()
+    sys.exit(main())
 
-# TODO Low remaining days worth alert
 # TODO Expiry date traffic light system
-# TODO Dose administration system